@@ -0,0 +1,143 @@
+'''
+Compare the column by column Biopython scans clean.py and make_report.py used to do with postbox.alignment on
+synthetic poliovirus length (7.4 kb) reference/consensus alignments, checking that both give the same output.
+
+    python benchmarks/alignment_columns.py --alignments 20
+'''
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from Bio import AlignIO
+from postbox.alignment import Alignment
+
+
+def write_alignment(path, length, random_generator):
+    reference = [random_generator.choice("ACGT") for i in range(length)]
+    consensus = list(reference)
+    for i in range(length):
+        roll = random_generator.random()
+        if roll < 0.01:
+            consensus[i] = random_generator.choice("ACGT")
+        elif roll < 0.012:
+            consensus[i] = "-"
+        elif roll < 0.014:
+            reference[i] = "-"
+        elif roll < 0.015:
+            consensus[i] = "N"
+    # ragged ends as left by mafft
+    for i in range(random_generator.randrange(1, 40)):
+        consensus[i] = "-"
+    for i in range(random_generator.randrange(1, 40)):
+        reference[-1 - i] = "-"
+    with open(path, "w") as f:
+        f.write(">Sabin1_vacc display_name=Sabin1\n%s\n" % "".join(reference))
+        f.write(">Sabin1:racon1 round=1\n%s\n" % "".join(consensus).lower())
+
+def old_clean(aln):
+    untrimmed = AlignIO.read(aln, "fasta")
+    for col in range(untrimmed.get_alignment_length()):
+        if not "-" in untrimmed[:, col]:
+            start_position = col
+            break
+    for col in range(untrimmed.get_alignment_length()):
+        end_index = col+1
+        if not "-" in untrimmed[:, -end_index]:
+            end_position = col
+            break
+    print(f"\nTrimming trailing gaps in alignment.\nAlignment now from {start_position} to "
+          f"{untrimmed.get_alignment_length()-end_position}.\n")
+    trimmed = untrimmed[:, start_position:] if end_position == 0 else untrimmed[:, start_position:-end_position]
+
+    print(f"Reading in {aln}.\n\nGaps found:")
+    cns_string = ""
+    for i in range(len(trimmed[0])):
+        col = trimmed[:,i]
+        if len(set(col))>1 and '-' in col:
+            print(f"Position {i+1}:\tReference:\t{col[0]}\tConsensus:\t{col[1]}")
+            if col[0] != '-':
+                cns_string += 'N'
+        else:
+            cns_string+= col[1]
+    return trimmed[1].id, cns_string
+
+def new_clean(aln):
+    untrimmed = Alignment.from_fasta(aln)
+    start_position, end_position = untrimmed.trailing_gaps()
+    print(f"\nTrimming trailing gaps in alignment.\nAlignment now from {start_position} to "
+          f"{len(untrimmed)-end_position}.\n")
+    trimmed = untrimmed.trim_trailing_gaps()
+
+    print(f"Reading in {aln}.\n\nGaps found:")
+    reference, consensus = trimmed.row(0), trimmed.row(1)
+    for i in trimmed.gap_positions():
+        print(f"Position {i+1}:\tReference:\t{reference[i]}\tConsensus:\t{consensus[i]}")
+    return trimmed.ids[1], trimmed.remove_gaps()
+
+def old_snps(aln, outfile):
+    alignment = AlignIO.read(aln, "fasta")
+    snps = 0
+    for i in range(len(alignment[0])):
+        col = alignment[:,i]
+        if len(set(col))>1:
+            if 'N' not in col and '-' not in col:
+                outfile.write(f"Position {i+1}:\tReference:\t{col[0]}\tConsensus:\t{col[1]}\n")
+                snps+=1
+    outfile.write(f"\nTotal number of snps from {alignment[0].id}:\t{snps}\n\n")
+
+def new_snps(aln, outfile):
+    alignment = Alignment.from_fasta(aln)
+    reference, consensus = alignment.row(0), alignment.row(1)
+    snps = 0
+    for i in alignment.snp_positions():
+        outfile.write(f"Position {i+1}:\tReference:\t{reference[i]}\tConsensus:\t{consensus[i]}\n")
+        snps+=1
+    outfile.write(f"\nTotal number of snps from {alignment.ids[0]}:\t{snps}\n\n")
+
+def run(function, paths, with_outfile=False):
+    outputs = []
+    start = time.perf_counter()
+    for path in paths:
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            if with_outfile:
+                outfile = io.StringIO()
+                function(path, outfile)
+                outputs.append((stdout.getvalue(), outfile.getvalue()))
+            else:
+                outputs.append((stdout.getvalue(), function(path)))
+    return time.perf_counter() - start, outputs
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark alignment column scans')
+    parser.add_argument('--alignments', dest='alignments', default=20, type=int)
+    parser.add_argument('--length', dest='length', default=7400, type=int)
+    args = parser.parse_args()
+
+    random_generator = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(args.alignments):
+            paths.append(os.path.join(tmp_dir, "%d.aln.fasta" % i))
+            write_alignment(paths[-1], args.length, random_generator)
+        print("%d alignments of %d columns" % (args.alignments, args.length))
+
+        for name, old, new, with_outfile in [("clean.py", old_clean, new_clean, False),
+                                             ("make_report.py", old_snps, new_snps, True)]:
+            old_seconds, old_outputs = run(old, paths, with_outfile)
+            new_seconds, new_outputs = run(new, paths, with_outfile)
+            if old_outputs != new_outputs:
+                sys.exit("Error: %s output differs" % name)
+            print("%-15s Biopython columns: %.3fs  numpy: %.3fs  (%.0fx, identical output)" % (
+                name, old_seconds, new_seconds, old_seconds / new_seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Compare the os.walk and stat scan postbox used to find basecalled files with the parallel postbox.barcodes.scan_fastq,
+and time building the input manifest from scratch and bringing it up to date, on a synthetic basecalled directory.
+Local disks hide most of the difference; point --work_dir at a network filesystem to see what runs on NFS pay.
+
+    python benchmarks/directory_scan.py --barcodes 96 --files 200 --work_dir /mnt/nfs/scratch
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from postbox.barcodes import is_fastq, scan_fastq
+from postbox.manifest import update_manifest
+
+READ = "@read\nACGTACGTAC\n+\n5555555555\n"
+
+
+def write_tree(basecalled_path, barcodes, files, reads):
+    for barcode in range(1, barcodes + 1):
+        directory = os.path.join(basecalled_path, "barcode%02d" % barcode)
+        os.makedirs(directory)
+        for number in range(files):
+            with open(os.path.join(directory, "FAK00000_pass_barcode%02d_%d.fastq" % (barcode, number)), "w") as f:
+                f.write(READ * reads)
+
+def walk(basecalled_path):
+    files = {}
+    for root, directories, file_names in os.walk(basecalled_path):
+        for file_name in file_names:
+            if is_fastq(file_name):
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def timed(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark scanning a basecalled directory')
+    parser.add_argument('--barcodes', dest='barcodes', default=24, type=int)
+    parser.add_argument('--files', dest='files', default=200, type=int, help='Files per barcode')
+    parser.add_argument('--reads', dest='reads', default=100, type=int, help='Reads per file')
+    parser.add_argument('--threads', dest='threads', default=8, type=int)
+    parser.add_argument('--work_dir', dest='work_dir', default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp_dir:
+        basecalled_path = os.path.join(tmp_dir, "fastq_pass")
+        write_tree(basecalled_path, args.barcodes, args.files, args.reads)
+        print("%d barcodes x %d files" % (args.barcodes, args.files))
+
+        old, walked = timed(walk, basecalled_path)
+        print("os.walk and stat (old):    %.3fs" % old)
+        new, scanned = timed(scan_fastq, basecalled_path, args.threads)
+        print("parallel scan:             %.3fs (%.1fx)" % (new, old / new))
+        if walked != scanned:
+            sys.exit("Error: the scans found different files")
+
+        cold, (entries, changed) = timed(update_manifest, basecalled_path, None, args.threads)
+        print("manifest from scratch:     %.3fs (%d files, %d reads)" % (
+            cold, changed, sum(entry["reads"] for entry in entries.values())))
+        warm, (entries, changed) = timed(update_manifest, basecalled_path, entries, args.threads)
+        print("manifest update:           %.3fs (%d files changed)" % (warm, changed))
+
+if __name__ == '__main__':
+    main()
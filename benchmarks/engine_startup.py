@@ -0,0 +1,62 @@
+'''
+Compare wall-clock time of a postbox dry run through the subprocess engine against the in-process snakemake API
+engine, using the bundled example protocol.
+
+    python benchmarks/engine_startup.py --repeats 5
+'''
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from postbox.postbox import resolve_run, build_command, build_config_list, syscall
+from postbox.engine import run_api
+
+data_dir = os.path.join(os.path.dirname(this_dir), 'tests', 'data')
+
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        function(*args)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark postbox engine startup')
+    parser.add_argument('--repeats', dest='repeats', default=5, type=int)
+    args = parser.parse_args()
+
+    protocol = "%s/example_protocol" % data_dir
+    run_directory = "%s/example_run_directory" % data_dir
+
+    with tempfile.TemporaryDirectory() as workdir:
+        basecalled_path = os.path.join(workdir, "fastq_pass")
+        os.mkdir(basecalled_path)
+        os.chdir(workdir)
+
+        pipeline_dict, config, sample_dict = resolve_run(protocol, "analysis", run_directory,
+                                                         "%s/run_configuration.json" % run_directory,
+                                                         basecalled_path, None,
+                                                         "%s/barcodes.csv" % run_directory)
+        command = build_command(pipeline_dict, config, sample_dict, 1, [], dry_run=True)
+        config_list = build_config_list(pipeline_dict, config, sample_dict, [])
+
+        timings = {"subprocess": [], "api": []}
+        for i in range(args.repeats):
+            timings["subprocess"].append(time_call(syscall, command))
+            timings["api"].append(time_call(run_api, pipeline_dict, config_list, 1, True))
+
+    print("engine\tfirst(s)\tmedian(s)\tmedian_after_first(s)")
+    for engine, values in timings.items():
+        rest = values[1:] if len(values) > 1 else values
+        print("%s\t%.3f\t%.3f\t%.3f" % (engine, values[0], statistics.median(values), statistics.median(rest)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Compare the per reference read extraction parse_ref_and_depth.py used to do (one SeqIO pass over the binned fastq
+per reference, testing each read against a list of names) with the single pass of postbox.reads.split_reads, on a
+synthetic fastq with reads spread over several references.
+
+    python benchmarks/read_extraction.py --reads 20000 --references 3
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from Bio import SeqIO
+from postbox.reads import split_reads
+
+
+def write_fastq(path, reads, read_length, references, seed=1):
+    random_generator = random.Random(seed)
+    read_bins = {}
+    with open(path, "w") as f:
+        for read in range(reads):
+            name = "%08x-read-%d" % (random_generator.getrandbits(32), read)
+            sequence = "".join(random_generator.choice("ACGT") for i in range(read_length))
+            f.write("@%s runid=synthetic read=%d ch=1\n%s\n+\n%s\n" % (name, read, sequence, "5" * read_length))
+            # a tenth of the reads map to none of the analysed references
+            if read % 10:
+                read_bins[name] = "ref%d" % random_generator.randrange(references)
+    return read_bins
+
+def extract_per_reference(reads_path, read_bins, output_paths):
+    read_dict = defaultdict(list)
+    for name, ref in read_bins.items():
+        read_dict[ref].append(name)
+    for ref in output_paths:
+        with open(output_paths[ref], "w") as fw:
+            records = []
+            for record in SeqIO.parse(reads_path, "fastq"):
+                if record.id in read_dict[ref]:
+                    records.append(record)
+            SeqIO.write(records, fw, "fastq")
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def same_reads(path, other_path):
+    return [(record.id, str(record.seq)) for record in SeqIO.parse(path, "fastq")] == \
+           [(record.id, str(record.seq)) for record in SeqIO.parse(other_path, "fastq")]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark read extraction by reference')
+    parser.add_argument('--reads', dest='reads', default=20000, type=int)
+    parser.add_argument('--read_length', dest='read_length', default=500, type=int)
+    parser.add_argument('--references', dest='references', default=3, type=int)
+    parser.add_argument('--skip_old', dest='skip_old', action="store_true",
+                        help='Only time the single pass, e.g. for read counts the old approach cannot handle')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reads_path = os.path.join(tmp_dir, "binned.fastq")
+        read_bins = write_fastq(reads_path, args.reads, args.read_length, args.references)
+        refs = ["ref%d" % i for i in range(args.references)]
+        new_paths = {ref: os.path.join(tmp_dir, "%s.new.fastq" % ref) for ref in refs}
+        old_paths = {ref: os.path.join(tmp_dir, "%s.old.fastq" % ref) for ref in refs}
+        size = os.path.getsize(reads_path) / 1024 / 1024
+        print("%d reads (%.1f MB) over %d references" % (args.reads, size, args.references))
+
+        new = timed(split_reads, reads_path, read_bins, new_paths)
+        print("single pass:               %.3fs" % new)
+        indexed = timed(split_reads, reads_path, read_bins, new_paths, 1024 * 1024,
+                        os.path.join(tmp_dir, "binned.fastq.idx"))
+        print("single pass with index:    %.3fs" % indexed)
+        if not args.skip_old:
+            old = timed(extract_per_reference, reads_path, read_bins, old_paths)
+            print("pass per reference (old):  %.3fs (%.0fx)" % (old, old / new))
+            for ref in refs:
+                if not same_reads(old_paths[ref], new_paths[ref]):
+                    sys.exit("Error: reads extracted for %s differ" % ref)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+Compare what parse_ref_and_depth.py did for every sample, parsing the whole reference panel with Biopython, with
+opening postbox's reference store and reading only the sequences a sample needs. Building the store is paid once
+per panel.
+
+    python benchmarks/reference_store.py --references 2000 --length 7500
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from postbox.references import ReferenceStore, reference_store
+
+
+def write_panel(path, references, length):
+    random.seed(1)
+    with open(path, "w") as f:
+        for number in range(references):
+            sequence = "".join(random.choice("ACGT") for i in range(length))
+            f.write(">ref%d display_name=type%d\n" % (number, number % 20))
+            f.write("\n".join(sequence[i:i + 60] for i in range(0, length, 60)) + "\n")
+
+def biopython(path, wanted):
+    from Bio import SeqIO
+    refs = {record.id: str(record.seq) for record in SeqIO.parse(path, "fasta")}
+    return [refs[ref] for ref in wanted]
+
+def store(directory, wanted):
+    references = ReferenceStore(directory)
+    references.display_names()
+    return [references.sequence(ref) for ref in wanted]
+
+def timed(function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    return time.perf_counter() - start, value
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading a reference panel per sample')
+    parser.add_argument('--references', dest='references', default=2000, type=int)
+    parser.add_argument('--length', dest='length', default=7500, type=int)
+    parser.add_argument('--wanted', dest='wanted', default=3, type=int, help='Sequences each sample needs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        panel = os.path.join(tmp_dir, "references.fasta")
+        write_panel(panel, args.references, args.length)
+        wanted = ["ref%d" % number for number in range(args.wanted)]
+        print("%d references of %d bases" % (args.references, args.length))
+
+        build, directory = timed(reference_store, panel, tmp_dir)
+        print("build the store (once per panel): %.3fs" % build)
+        old, old_sequences = timed(biopython, panel, wanted)
+        print("Biopython parse (old):            %.3fs" % old)
+        new, new_sequences = timed(store, directory, wanted)
+        print("reference store:                  %.3fs (%.0fx)" % (new, old / new))
+        if old_sequences != new_sequences:
+            sys.exit("Error: the sequences differ")
+
+if __name__ == '__main__':
+    main()
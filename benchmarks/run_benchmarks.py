@@ -0,0 +1,146 @@
+'''
+End-to-end benchmarks of postbox on synthetic runs.
+
+For each run size (samples x barcodes per sample x reads per barcode) this records
+  resolve:  resolving the protocol, run configuration and barcodes csv (cold and cached)
+  dry_run:  postbox with --dry_run, i.e. process startup, snakemake DAG building and launch overhead
+  run:      a full postbox run with stub executables in place of the bioinformatics tools
+
+Results are written as JSON together with the git commit, so runs at two commits can be compared:
+
+    python benchmarks/run_benchmarks.py --sizes 1x1x100 4x2x200 --output before.json
+    git checkout other-branch
+    python benchmarks/run_benchmarks.py --sizes 1x1x100 4x2x200 --output after.json --compare before.json
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(this_dir)
+sys.path.insert(0, repo_dir)
+
+from benchmarks.synthetic import write_stubs, write_run, write_protocol
+from postbox.postbox import resolve_run
+from postbox.cache import cached_resolve_run
+
+
+def parse_size(value):
+    samples, barcodes, reads = [int(part) for part in value.lower().split("x")]
+    return {"samples": samples, "barcodes_per_sample": barcodes, "reads_per_barcode": reads}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def timed(function, repeats):
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def run_postbox(arguments, run_directory, bin_dir):
+    environment = dict(os.environ)
+    environment["PATH"] = bin_dir + os.pathsep + environment["PATH"]
+    environment["PYTHONPATH"] = repo_dir + os.pathsep + environment.get("PYTHONPATH", "")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-m", "postbox.postbox"] + arguments, cwd=run_directory,
+                            env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout[-5000:], file=sys.stderr)
+        raise RuntimeError("postbox %s failed" % " ".join(arguments))
+    return elapsed
+
+def benchmark_size(size, args, work_dir):
+    name = "%(samples)dx%(barcodes_per_sample)dx%(reads_per_barcode)d" % size
+    size_dir = os.path.join(work_dir, name)
+    protocol = write_protocol(os.path.join(size_dir, "protocol"))
+    run_directory = os.path.join(size_dir, "run")
+    os.makedirs(run_directory)
+    write_run(run_directory, size["samples"], size["barcodes_per_sample"], size["reads_per_barcode"],
+              files_per_barcode=args.files_per_barcode)
+    bin_dir = write_stubs(os.path.join(size_dir, "bin"))
+    cache_dir = os.path.join(size_dir, "cache")
+
+    resolve_arguments = (protocol, "analysis", run_directory, "%s/run_configuration.json" % run_directory,
+                         None, None, "%s/barcodes.csv" % run_directory)
+    result = dict(size)
+    result["resolve_seconds"] = timed(lambda: resolve_run(*resolve_arguments), args.repeats)
+    # the first call fills the cache, later ones measure hits
+    result["resolve_cached_seconds"] = timed(lambda: cached_resolve_run(*resolve_arguments, cache_dir=cache_dir),
+                                             args.repeats + 1)
+
+    postbox_arguments = ["-p", protocol, "-q", "analysis", "-t", str(args.threads), "--cache_dir", cache_dir,
+                         "--log_level", "ERROR"]
+    # the extra arguments go last, as they may end in key=value pipeline config that takes the rest of the line
+    result["dry_run_seconds"] = statistics.median(
+        run_postbox(postbox_arguments + ["--dry_run"] + args.postbox_arguments, run_directory, bin_dir)
+        for i in range(args.repeats))
+    if not args.skip_run:
+        result["run_seconds"] = run_postbox(postbox_arguments + args.postbox_arguments, run_directory, bin_dir)
+    print("%s\t%s" % (name, "\t".join("%s=%.4f" % (key, result[key]) for key in sorted(result)
+                                       if key.endswith("seconds"))))
+    return name, result
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print("\nsize\tmetric\t%s\t%s\tratio" % (baseline["commit"], results["commit"]))
+    for name in results["sizes"]:
+        if name not in baseline["sizes"]:
+            continue
+        for key in sorted(results["sizes"][name]):
+            if not key.endswith("seconds") or key not in baseline["sizes"][name]:
+                continue
+            old, new = baseline["sizes"][name][key], results["sizes"][name][key]
+            print("%s\t%s\t%.4f\t%.4f\t%.2f" % (name, key, old, new, new / old if old else float("nan")))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark postbox end to end on synthetic runs')
+    parser.add_argument('--sizes', dest='sizes', nargs='+', type=parse_size, default=[parse_size("2x1x100")],
+                        help='Run sizes as SAMPLESxBARCODESxREADS, e.g. 8x2x500')
+    parser.add_argument('--files_per_barcode', dest='files_per_barcode', default=1, type=int)
+    parser.add_argument('--threads', dest='threads', default=2, type=int)
+    parser.add_argument('--repeats', dest='repeats', default=3, type=int)
+    parser.add_argument('--skip_run', dest='skip_run', action="store_true",
+                        help='Only measure resolution and dry runs')
+    parser.add_argument('--postbox_arguments', dest='postbox_arguments', nargs=argparse.REMAINDER, default=[],
+                        help='Extra arguments passed to every postbox invocation')
+    parser.add_argument('--work_dir', dest='work_dir', default=None,
+                        help='Keep the synthetic runs here instead of a temporary directory')
+    parser.add_argument('--output', dest='output', default=None, help='Write results as JSON to this file')
+    parser.add_argument('--compare', dest='compare', default=None, help='Earlier results JSON to compare against')
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "python": platform.python_version(), "threads": args.threads,
+               "postbox_arguments": args.postbox_arguments, "sizes": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        for size in args.sizes:
+            name, result = benchmark_size(size, args, work_dir)
+            results["sizes"][name] = result
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
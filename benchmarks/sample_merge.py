@@ -0,0 +1,90 @@
+'''
+Compare the rename_to_samples rule the example pipeline used to run (cat for the fastq files, a line by line copy
+for the csv files) with postbox.merge, on synthetic per barcode files. On btrfs, xfs or NFS 4.2, copy_file_range
+does not copy the data at all; elsewhere it still keeps it out of user space.
+
+    python benchmarks/sample_merge.py --barcodes 12 --reads 200000 --pool 3
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from postbox.merge import merge_samples
+
+READ = "@read%d\n" + "ACGT" * 100 + "\n+\n" + "5" * 400 + "\n"
+CSV_ROW = "read%d,400,2026-01-01T00:00:00Z,BC01,Sabin1,0.98\n"
+CSV_HEADER = "read_name,read_len,start_time,barcode,best_reference,ref_len\n"
+
+
+def write_barcodes(input_prefix, barcodes, reads):
+    for barcode in barcodes:
+        with open("%s_%s.fastq" % (input_prefix, barcode), "w") as f:
+            f.write("".join(READ % number for number in range(reads)))
+        with open("%s_%s.csv" % (input_prefix, barcode), "w") as f:
+            f.write(CSV_HEADER + "".join(CSV_ROW % number for number in range(reads)))
+
+def old_merge(input_prefix, output_prefix, sample_dict):
+    for sample, barcodes in sample_dict.items():
+        read_files = ["%s_%s.fastq" % (input_prefix, barcode) for barcode in barcodes]
+        csv_files = ["%s_%s.csv" % (input_prefix, barcode) for barcode in barcodes]
+        subprocess.run("cat %s > %s_%s.fastq" % (" ".join(read_files), output_prefix, sample), shell=True,
+                       check=True)
+        if len(csv_files) > 1:
+            write_headers = True
+            with open("%s_%s.csv" % (output_prefix, sample), "w") as fw:
+                for csv_file in csv_files:
+                    with open(csv_file) as fr:
+                        for l in fr:
+                            l = l.rstrip('\n')
+                            if l.startswith("read_name"):
+                                if write_headers:
+                                    write_headers = False
+                                    fw.write(l + '\n')
+                            else:
+                                fw.write(l + '\n')
+        else:
+            subprocess.run(["cp", csv_files[0], "%s_%s.csv" % (output_prefix, sample)], check=True)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark merging per barcode files into per sample files')
+    parser.add_argument('--barcodes', dest='barcodes', default=12, type=int)
+    parser.add_argument('--reads', dest='reads', default=50000, type=int, help='Reads per barcode')
+    parser.add_argument('--pool', dest='pool', default=1, type=int, help='Barcodes per sample')
+    parser.add_argument('--threads', dest='threads', default=4, type=int)
+    parser.add_argument('--work_dir', dest='work_dir', default=None)
+    args = parser.parse_args()
+
+    barcodes = ["BC%02d" % number for number in range(1, args.barcodes + 1)]
+    sample_dict = {"sample%02d" % (index + 1): barcodes[start:start + args.pool]
+                   for index, start in enumerate(range(0, len(barcodes), args.pool))}
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp_dir:
+        input_prefix = os.path.join(tmp_dir, "binned")
+        write_barcodes(input_prefix, barcodes, args.reads)
+        size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+        print("%d barcodes, %d samples, %.0f MB" % (len(barcodes), len(sample_dict), size / 1e6))
+
+        old = timed(old_merge, input_prefix, os.path.join(tmp_dir, "old"), sample_dict)
+        print("cat and line by line csv (old): %.3fs" % old)
+        new = timed(merge_samples, input_prefix, os.path.join(tmp_dir, "new"), sample_dict, args.threads)
+        print("postbox.merge:                  %.3fs (%.1fx)" % (new, old / new))
+        for sample in sample_dict:
+            for extension in ["fastq", "csv"]:
+                with open("%s/old_%s.%s" % (tmp_dir, sample, extension), "rb") as f:
+                    old_output = f.read()
+                with open("%s/new_%s.%s" % (tmp_dir, sample, extension), "rb") as f:
+                    if f.read() != old_output:
+                        sys.exit("Error: the merges wrote different %s files for %s" % (extension, sample))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Compare starting a postbox run from the command line with submitting it to a running postbox serve, on a synthetic
+run with stub executables: how long the submission takes to be accepted, and how long a dry run (or with --full, a
+whole run) takes from the moment it is asked for to the moment it is done.
+
+    python benchmarks/serve_latency.py --repeats 5
+    python benchmarks/serve_latency.py --repeats 3 --full --size 2x3x100
+    python benchmarks/serve_latency.py --repeats 5 --engine api
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(this_dir)
+sys.path.insert(0, repo_dir)
+
+from benchmarks.synthetic import write_stubs, write_run, write_protocol
+from postbox.serve import call
+
+
+def environment(bin_dir):
+    env = dict(os.environ)
+    env["PATH"] = bin_dir + os.pathsep + env["PATH"]
+    env["PYTHONPATH"] = repo_dir + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+def run_cli(arguments, run_directory, bin_dir):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-m", "postbox.postbox"] + arguments, cwd=run_directory,
+                            env=environment(bin_dir), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stdout[-5000:], file=sys.stderr)
+        raise RuntimeError("postbox %s failed" % " ".join(arguments))
+    return time.perf_counter() - start
+
+def wait_for_socket(socket_path, daemon, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if daemon.poll() is not None:
+            raise RuntimeError("postbox serve exited with %d" % daemon.returncode)
+        try:
+            return call(socket_path, "GET", "/status")
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("postbox serve did not start")
+
+def submit(socket_path, request):
+    '''
+    Submit a run and wait for it, returning the seconds the submission and the whole run took.
+    '''
+    start = time.perf_counter()
+    status, run, headers = call(socket_path, "POST", "/runs", request)
+    accepted = time.perf_counter() - start
+    if status != 202:
+        raise RuntimeError("submission refused: %s" % run["error"])
+    while run["status"] in ("queued", "running"):
+        time.sleep(0.01)
+        status, run, headers = call(socket_path, "GET", "/runs/%d" % run["id"])
+    if run["status"] != "success":
+        raise RuntimeError("run %d failed: %s" % (run["id"], run["error"]))
+    return accepted, time.perf_counter() - start
+
+def consensus(run_directory):
+    sequences = []
+    for root, directories, files in sorted(os.walk(run_directory)):
+        if os.path.basename(root) == "consensus_sequences":
+            for name in sorted(files):
+                with open(os.path.join(root, name)) as f:
+                    sequences.append(f.read())
+    return "".join(sequences)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark postbox serve against the command line')
+    parser.add_argument('--size', dest='size', default="2x2x50", help='samples x barcodes per sample x reads')
+    parser.add_argument('--repeats', dest='repeats', default=5, type=int)
+    parser.add_argument('--threads', dest='threads', default=2, type=int)
+    parser.add_argument('--full', dest='full', action="store_true", help='Time full runs rather than dry runs')
+    parser.add_argument('--engine', dest='engine', choices=['subprocess', 'api'], default='subprocess',
+                        help='Engine of both the command line runs and the daemon, which keeps snakemake imported')
+    parser.add_argument('--work_dir', dest='work_dir', default=None)
+    args = parser.parse_args()
+
+    samples, barcodes, reads = [int(part) for part in args.size.lower().split("x")]
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as tmp_dir:
+        protocol = write_protocol(os.path.join(tmp_dir, "protocol"))
+        # every run gets its own directory, so that none finds the outputs of another already there
+        run_directories = []
+        for number in range(2 * args.repeats):
+            run_directories.append(os.path.join(tmp_dir, "run%d" % number))
+            os.makedirs(run_directories[-1])
+            write_run(run_directories[-1], samples, barcodes, reads)
+        bin_dir = write_stubs(os.path.join(tmp_dir, "bin"))
+        cache_dir = os.path.join(tmp_dir, "cache")
+        socket_path = os.path.join(tmp_dir, "postbox.sock")
+        run_options = [] if args.full else ["--dry_run"]
+
+        cli = [run_cli(["-p", protocol, "-q", "analysis", "-t", str(args.threads), "--cache_dir", cache_dir,
+                        "--log_level", "ERROR", "--engine", args.engine] + run_options, run_directory, bin_dir)
+               for run_directory in run_directories[:args.repeats]]
+
+        daemon = subprocess.Popen([sys.executable, "-m", "postbox.postbox", "serve", "-p", protocol, "-q", "analysis",
+                                   "-t", str(args.threads), "--cache_dir", cache_dir, "--socket", socket_path,
+                                   "--engine", args.engine],
+                                  env=environment(bin_dir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_socket(socket_path, daemon)
+            served = [submit(socket_path, {"run_directory": run_directory, "arguments": run_options})
+                      for run_directory in run_directories[args.repeats:]]
+        finally:
+            daemon.terminate()
+            daemon.wait()
+        if args.full:
+            outputs = set(consensus(run_directory) for run_directory in run_directories)
+            if len(outputs) != 1:
+                sys.exit("Error: the runs made different consensus sequences")
+
+    kind = "full run" if args.full else "dry run"
+    print("%s %s with the %s engine, median of %d" % (args.size, kind, args.engine, args.repeats))
+    print("command line:          %.3fs" % statistics.median(cli))
+    print("serve, accepted:       %.1fms" % (1000 * statistics.median(accepted for accepted, done in served)))
+    print("serve, done:           %.3fs (%.1fx)" % (statistics.median(done for accepted, done in served),
+                                                   statistics.median(cli) /
+                                                   statistics.median(done for accepted, done in served)))
+
+if __name__ == '__main__':
+    main()
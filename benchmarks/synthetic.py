@@ -0,0 +1,157 @@
+'''
+Generate synthetic postbox runs: a copy of the bundled example protocol, a run directory with N samples of M
+barcodes each and K reads per barcode, and stub executables standing in for binlorry, minimap2, racon, mafft,
+medaka and samtools so that the pipelines can run end to end in seconds.
+'''
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(this_dir))
+
+from postbox.barcodes import find_barcode_files
+
+example_protocol = os.path.join(os.path.dirname(this_dir), 'tests', 'data', 'example_protocol')
+
+STUBS = {
+    # binlorry: bin reads per barcode and write the per read report parse_ref_and_depth.py reads
+    "binlorry": '''
+import argparse, sys
+sys.path.insert(0, %(repo)r)
+from postbox.barcodes import find_barcode_files
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i", dest="inputs", nargs="+")
+parser.add_argument("-o", dest="prefix")
+parser.add_argument("--filter-by", dest="filter_by", nargs="+", default=[])
+args, unknown = parser.parse_known_args()
+
+barcodes = args.filter_by[1:]
+barcode_files = {}
+for path in args.inputs:
+    for barcode, files in find_barcode_files(path, barcodes).items():
+        barcode_files.setdefault(barcode, []).extend(files)
+for barcode in barcodes:
+    with open("%%s_%%s.fastq" %% (args.prefix, barcode), "w") as reads, \\
+            open("%%s_%%s.csv" %% (args.prefix, barcode), "w") as report:
+        report.write("read_name,read_len,start_time,barcode,best_reference,display_name\\n")
+        for path in barcode_files.get(barcode, []):
+            with open(path) as f:
+                lines = f.readlines()
+            reads.writelines(lines)
+            for i in range(0, len(lines), 4):
+                name = lines[i][1:].split()[0]
+                display_name = "Sabin1" if i %% 40 else "*"
+                reference = "Sabin1_vacc" if display_name == "Sabin1" else "*"
+                report.write("%%s,%%d,0,%%s,%%s,%%s\\n" %% (name, len(lines[i + 1]) - 1, barcode, reference,
+                                                      display_name))
+''',
+    # minimap2: an empty mapping is enough for the racon stub; -d writes the reference as its "index"
+    "minimap2": '''
+import shutil, sys
+if "-d" in sys.argv:
+    shutil.copy(sys.argv[-1], sys.argv[sys.argv.index("-d") + 1])
+''',
+    # racon: the "polished" sequence is the draft
+    "racon": '''
+import sys
+with open(sys.argv[-1]) as f:
+    sys.stdout.write(f.read())
+''',
+    # mafft: sequences in these runs already have equal length, so the input is its own alignment
+    "mafft": '''
+import sys
+with open(sys.argv[-1]) as f:
+    sys.stdout.write(f.read())
+''',
+    "medaka_consensus": '''
+import argparse, os, shutil
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", dest="draft")
+parser.add_argument("-o", dest="outdir")
+args, unknown = parser.parse_known_args()
+os.makedirs(args.outdir, exist_ok=True)
+shutil.copy(args.draft, os.path.join(args.outdir, "consensus.fasta"))
+''',
+    "samtools": '''
+import sys
+'''
+}
+
+
+def write_stubs(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    repo = os.path.dirname(this_dir)
+    for name, body in STUBS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write("#!%s\n" % sys.executable)
+            # so that postbox check sees a version
+            f.write("import sys\nif sys.argv[1:] == ['--version']:\n"
+                    "    print('%s synthetic')\n    sys.exit(0)\n" % name)
+            f.write(body % {"repo": repo} if "%(repo)" in body else body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+def read_reference(references, name):
+    sequence, keep = [], False
+    with open(references) as f:
+        for line in f:
+            if line.startswith(">"):
+                keep = line[1:].split()[0] == name
+            elif keep:
+                sequence.append(line.strip())
+    return "".join(sequence)
+
+def write_run(run_directory, samples, barcodes_per_sample, reads_per_barcode, read_length=1000,
+              files_per_barcode=1, seed=1):
+    '''
+    A run directory with barcodes.csv, run_configuration.json and fastq_pass/barcodeNN/*.fastq holding reads
+    sampled from the Sabin1 reference. Returns the sample to barcode map.
+    '''
+    random_generator = random.Random(seed)
+    reference = read_reference(os.path.join(example_protocol, "rampart", "references.fasta"), "Sabin1_vacc")
+    read_length = min(read_length, len(reference))
+
+    sample_dict = {}
+    barcode = 0
+    for sample in range(samples):
+        name = "sample%03d" % (sample + 1)
+        sample_dict[name] = []
+        for i in range(barcodes_per_sample):
+            barcode += 1
+            sample_dict[name].append("BC%02d" % barcode)
+
+    basecalled_path = os.path.join(run_directory, "fastq_pass")
+    for sample in sample_dict:
+        for barcode in sample_dict[sample]:
+            barcode_dir = os.path.join(basecalled_path, "barcode%s" % barcode[2:])
+            os.makedirs(barcode_dir, exist_ok=True)
+            per_file = max(1, reads_per_barcode // files_per_barcode)
+            for file_index in range(files_per_barcode):
+                with open(os.path.join(barcode_dir, "FAK00000_pass_%d.fastq" % file_index), "w") as f:
+                    for read in range(per_file):
+                        start = random_generator.randrange(0, len(reference) - read_length + 1)
+                        sequence = reference[start:start + read_length]
+                        f.write("@%s_%s_%d_%d\n%s\n+\n%s\n" % (sample, barcode, file_index, read, sequence,
+                                                              "5" * len(sequence)))
+
+    with open(os.path.join(run_directory, "barcodes.csv"), "w") as f:
+        f.write("sample,barcode\n")
+        for sample in sample_dict:
+            for barcode in sample_dict[sample]:
+                f.write("%s,%s\n" % (sample, barcode))
+    with open(os.path.join(run_directory, "run_configuration.json"), "w") as f:
+        json.dump({"title": "synthetic", "basecalledPath": "fastq_pass"}, f, indent=2)
+    os.makedirs(os.path.join(run_directory, "annotations"), exist_ok=True)
+    return sample_dict
+
+def write_protocol(protocol_directory):
+    if os.path.exists(protocol_directory):
+        shutil.rmtree(protocol_directory)
+    shutil.copytree(example_protocol, protocol_directory)
+    return protocol_directory
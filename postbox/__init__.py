@@ -1,8 +1,11 @@
-from pkg_resources import get_distribution
-
-try:
-    __version__ = get_distribution("postbox").version
-except:
-    __version__ = "local"
+def __getattr__(name):
+    # looked up on first use so that importing postbox does not pay for importlib.metadata
+    if name == "__version__":
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            return version("postbox")
+        except PackageNotFoundError:
+            return "local"
+    raise AttributeError("module 'postbox' has no attribute %r" % name)
 
 from postbox import *
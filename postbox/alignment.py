@@ -0,0 +1,116 @@
+import numpy
+
+GAP = ord("-")
+N = ord("N")
+
+
+def parse_fasta(lines):
+    '''
+    Ids and sequences of fasta lines, parsed as Biopython does: the id is the first word of the header, sequence
+    lines are joined with spaces removed, and anything before the first header is skipped.
+    '''
+    ids = []
+    sequences = []
+    parts = None
+    for line in lines:
+        if line.startswith(">"):
+            title = line[1:].strip()
+            ids.append(title.split(None, 1)[0] if title else "")
+            parts = []
+            sequences.append(parts)
+        elif parts is not None:
+            parts.append(line.strip().replace(" ", "").replace("\r", ""))
+    return ids, ["".join(parts) for parts in sequences]
+
+def read_fasta(path):
+    from postbox.compression import open_file
+    with open_file(path) as f:
+        return parse_fasta(f)
+
+class Alignment:
+    '''
+    A fasta alignment held as a byte matrix with one row per sequence, so whole columns can be compared at once
+    instead of slicing the alignment one column at a time.
+    '''
+    def __init__(self, ids, matrix):
+        self.ids = ids
+        self.matrix = matrix
+
+    @classmethod
+    def from_fasta(cls, path):
+        ids, sequences = read_fasta(path)
+        return cls.from_sequences(ids, sequences, path)
+
+    @classmethod
+    def from_text(cls, text, source="alignment"):
+        ids, sequences = parse_fasta(text.splitlines())
+        return cls.from_sequences(ids, sequences, source)
+
+    @classmethod
+    def from_sequences(cls, ids, sequences, source="alignment"):
+        if not sequences:
+            raise ValueError("No sequences found in %s" % source)
+        if len(set(len(sequence) for sequence in sequences)) > 1:
+            raise ValueError("Sequences in %s are different lengths, not an alignment" % source)
+        matrix = numpy.frombuffer("".join(sequences).encode("ascii"), dtype=numpy.uint8)
+        return cls(ids, matrix.reshape(len(sequences), -1))
+
+    def __len__(self):
+        return self.matrix.shape[1]
+
+    def row(self, index):
+        return self.matrix[index].tobytes().decode("ascii")
+
+    def gap_columns(self):
+        return (self.matrix == GAP).any(axis=0)
+
+    def variable_columns(self):
+        return (self.matrix != self.matrix[0]).any(axis=0)
+
+    def trailing_gaps(self):
+        '''
+        The index of the first column without a gap and the number of columns from the last one without a gap to
+        the end.
+        '''
+        complete = numpy.flatnonzero(~self.gap_columns())
+        if len(complete) == 0:
+            raise ValueError("Every column of the alignment has a gap")
+        return int(complete[0]), len(self) - 1 - int(complete[-1])
+
+    def trim_trailing_gaps(self):
+        start, end = self.trailing_gaps()
+        return Alignment(self.ids, self.matrix[:, start:len(self) - end])
+
+    def gap_positions(self):
+        '''
+        Columns that vary and contain a gap.
+        '''
+        return numpy.flatnonzero(self.variable_columns() & self.gap_columns())
+
+    def remove_gaps(self, row=1):
+        '''
+        The sequence of row with gaps it has against the first row replaced by N, and bases that put a gap into the
+        first row deleted.
+        '''
+        gaps = self.variable_columns() & self.gap_columns()
+        sequence = numpy.where(gaps, N, self.matrix[row])
+        keep = ~(gaps & (self.matrix[0] == GAP))
+        return sequence[keep].tobytes().decode("ascii")
+
+    def snp_positions(self):
+        '''
+        Columns that vary without any gap or N.
+        '''
+        masked = ((self.matrix == GAP) | (self.matrix == N)).any(axis=0)
+        return numpy.flatnonzero(self.variable_columns() & ~masked)
+
+def clean_consensus(alignment, name, round_name=None):
+    '''
+    The fasta record clean.py writes for a reference/consensus alignment: trailing gaps trimmed, gaps in the
+    consensus as N, insertions against the reference removed.
+    '''
+    trimmed = alignment.trim_trailing_gaps()
+    sequence = trimmed.remove_gaps().upper()
+    round_name = " round_name=%s" % round_name if round_name else ""
+    return ">%s accession=%s%s length=%d\n%s\n" % (name, trimmed.ids[1].split(":")[0], round_name, len(sequence),
+                                                   sequence)
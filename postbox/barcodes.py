@@ -0,0 +1,103 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+FASTQ_EXTENSIONS = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+barcode_pattern = re.compile(r'(?:barcode|bc|nb|rb)?(\d+)$', re.IGNORECASE)
+directory_barcode_pattern = re.compile(r'(?:barcode|bc|nb|rb)\d+$', re.IGNORECASE)
+file_barcode_pattern = re.compile(r'barcode(\d+)', re.IGNORECASE)
+
+
+def normalise_barcode(barcode):
+    '''
+    Map the barcode names used in run configurations (BC01, NB01, barcode01, 1) to the barcodeNN names that
+    guppy uses for demultiplexed output. Anything else (e.g. unclassified) is just lower cased.
+    '''
+    barcode = str(barcode).strip()
+    match = barcode_pattern.match(barcode)
+    if match:
+        return "barcode%02d" % int(match.group(1))
+    return barcode.lower()
+
+def is_fastq(file_name):
+    return file_name.endswith(FASTQ_EXTENSIONS)
+
+def barcode_of_path(relative_path):
+    '''
+    The normalised barcode a basecalled file belongs to, taken from the closest directory named after a barcode
+    or else from a barcodeNN token in the file name. None if it cannot be told.
+    '''
+    parts = relative_path.split(os.sep)
+    for directory in reversed(parts[:-1]):
+        if directory_barcode_pattern.match(directory) or directory.lower() == "unclassified":
+            return normalise_barcode(directory)
+    match = file_barcode_pattern.search(parts[-1])
+    if match:
+        return "barcode%02d" % int(match.group(1))
+    return None
+
+def unassigned_files(basecalled_path, files):
+    '''
+    The sorted fastq files (of files, as scan_fastq returns them) whose barcode cannot be told from their path, as in a
+    flat directory that binlorry demultiplexes from the read annotations. Any of them may hold reads of any barcode.
+    '''
+    return sorted(path for path in files if barcode_of_path(os.path.relpath(path, basecalled_path)) is None)
+
+def list_directory(directory):
+    '''
+    The subdirectories of directory and {path: (size, mtime_ns)} of the fastq files in it.
+    '''
+    directories = []
+    files = {}
+    try:
+        entries = list(os.scandir(directory))
+    except (FileNotFoundError, NotADirectoryError):
+        return directories, files
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif is_fastq(entry.name):
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return directories, files
+
+def scan_fastq(basecalled_path, threads=8):
+    '''
+    {path: (size, mtime_ns)} of every fastq file under basecalled_path. Directories are listed in parallel, as on
+    network filesystems each listing and stat is a round trip to the server.
+    '''
+    files = {}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = {executor.submit(list_directory, basecalled_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directories, found = future.result()
+                files.update(found)
+                pending.update(executor.submit(list_directory, directory) for directory in directories)
+    return files
+
+def find_barcode_files(basecalled_path, barcodes, files=None):
+    '''
+    Scan basecalled_path (unless the files are already known) and return a dict from each requested barcode (as
+    given) to the sorted list of its fastq files.
+    '''
+    wanted = {}
+    for barcode in barcodes:
+        wanted.setdefault(normalise_barcode(barcode), []).append(barcode)
+
+    if files is None:
+        files = scan_fastq(basecalled_path)
+    barcode_files = {barcode: [] for barcode in barcodes}
+    for path in files:
+        barcode = barcode_of_path(os.path.relpath(path, basecalled_path))
+        for name in wanted.get(barcode, []):
+            barcode_files[name].append(path)
+
+    for barcode in barcode_files:
+        barcode_files[barcode].sort()
+    return barcode_files
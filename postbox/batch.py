@@ -0,0 +1,165 @@
+import argparse
+import copy
+import glob
+import os
+import sys
+
+from postbox.postbox import add_protocol_arguments, add_run_configuration_arguments, add_sample_arguments, \
+    add_cache_arguments, add_resource_arguments, add_manifest_arguments, add_compression_arguments, \
+    add_journal_arguments, add_executor_arguments, add_logging_arguments, add_metrics_arguments, resolve_run_paths, \
+    run_resolved, Error
+from postbox.executors import make_executor
+from postbox.cache import cached_resolve_run
+from postbox.resources import available_memory_mb
+from postbox.scheduler import run_fair_share
+
+
+def get_arguments(argv=None):
+    '''
+    Parse the command line arguments for postbox batch.
+    '''
+    parser = argparse.ArgumentParser(prog='postbox batch',
+                                     description='Runs the pipeline on many run directories concurrently under one \
+                                                  core budget')
+
+    main_group = parser.add_argument_group('Main options')
+    add_protocol_arguments(main_group)
+
+    run_group = parser.add_argument_group('Run configuration options',
+                                          'Paths are relative to each run directory')
+    run_group.add_argument('run_directories', nargs='*',
+                           help='Run directories or glob patterns matching run directories')
+    run_group.add_argument('--run_list', dest='run_list', default=None,
+                           help='File listing one run directory or glob pattern per line')
+    add_run_configuration_arguments(run_group)
+    run_group.add_argument('-t', '--threads', dest='threads', default=1, type=int,
+                           help='Total number of cores shared by all runs')
+    run_group.add_argument('--max_concurrent', dest='max_concurrent', default=None, type=int,
+                           help='Maximum number of runs in flight at once. Defaults to as many as there are cores')
+    run_group.add_argument('-n', '--dry_run', dest='dry_run', action="store_true",
+                           help='Make these snakemake dry runs')
+    run_group.add_argument('--overrides', dest='overrides', nargs='*', default=[],
+                           help='key=value pairs to override snakemake config parameters with in every run')
+    add_sample_arguments(run_group)
+    add_resource_arguments(run_group)
+    add_manifest_arguments(run_group)
+    add_compression_arguments(run_group)
+    add_journal_arguments(run_group)
+    add_cache_arguments(run_group)
+    add_executor_arguments(run_group)
+
+    add_logging_arguments(parser, default_log_file='postbox.log', default_log_level='WARNING')
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+    # snakemake runs inside each run directory, so paths given relative to where batch started are made absolute
+    args.protocol = os.path.abspath(args.protocol.rstrip("/"))
+    for option in ["cache_dir", "queue"]:
+        if getattr(args, option) is not None:
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    # snakemake is not safe to run from several threads of one process, so runs are always separate processes
+    args.engine = "subprocess"
+
+    patterns = list(args.run_directories)
+    if args.run_list is not None:
+        with open(args.run_list) as f:
+            patterns.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    args.run_directories = expand_run_directories(patterns)
+    if len(args.run_directories) == 0:
+        parser.error("no run directories given or matched")
+
+    return args
+
+def expand_run_directories(patterns):
+    run_directories = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if not os.path.isdir(match):
+                print("Warning: %s is not a directory, skipping" % match, file=sys.stderr)
+                continue
+            run_directory = os.path.abspath(match.rstrip("/"))
+            if run_directory not in run_directories:
+                run_directories.append(run_directory)
+    return run_directories
+
+def run_name(run_directory):
+    return os.path.basename(run_directory)
+
+def prepare_run(args, run_directory):
+    '''
+    Resolve the pipeline, run configuration and samples for one run directory, as the single run CLI would.
+    '''
+    run_directory, run_configuration, csv, log_file = resolve_run_paths(run_directory, args.run_configuration,
+                                                                        args.csv, args.log_file)
+    pipeline_dict, config, sample_dict = cached_resolve_run(args.protocol, args.pipeline, run_directory,
+                                                            run_configuration, args.basecalled_path, args.fast5_path,
+                                                            csv, cache_dir=args.cache_dir, use_cache=args.use_cache)
+    return {
+        "name": run_name(run_directory),
+        "run_directory": run_directory,
+        "log_file": log_file,
+        "pipeline_dict": pipeline_dict,
+        "config": config,
+        "sample_dict": sample_dict
+    }
+
+def run_arguments(args, run, cores):
+    '''
+    The arguments of the single run CLI for one run of the batch, given cores of the budget.
+    '''
+    run_args = copy.copy(args)
+    run_args.run_directory = run["run_directory"]
+    run_args.cwd = run["run_directory"]
+    run_args.run_name = run["name"]
+    run_args.log_file = run["log_file"]
+    run_args.threads = cores
+    run_args.remainder = list(args.overrides)
+    # runs side by side get memory in proportion to their cores
+    memory_mb = args.memory_mb or available_memory_mb()
+    run_args.memory_mb = int(memory_mb * min(1.0, cores / args.threads)) if memory_mb else None
+    return run_args
+
+def make_job(args, run, executor):
+    def job(cores):
+        print("[%s] Starting with %d cores" % (run["name"], cores))
+        # each run gets its own copy of the configuration, which preparing the run fills in
+        run_resolved(run_arguments(args, run, cores), run["pipeline_dict"], copy.deepcopy(run["config"]),
+                     run["sample_dict"], executor)
+        return 0
+    return job
+
+def main(argv=None):
+    args = get_arguments(argv)
+
+    failed = []
+    jobs = []
+    executor = make_executor(args)
+    for run_directory in args.run_directories:
+        try:
+            run = prepare_run(args, run_directory)
+        except (SystemExit, Error) as e:
+            print("[%s] Could not resolve run: %s" % (run_name(run_directory), e), file=sys.stderr)
+            failed.append(run_name(run_directory))
+            continue
+        jobs.append((run["name"], make_job(args, run, executor)))
+
+    try:
+        results = run_fair_share(jobs, args.threads, args.max_concurrent)
+    finally:
+        executor.close()
+
+    print("\nBatch summary:")
+    for name in failed:
+        print("%s\tFAILED (configuration)" % name)
+    for name, result, exception in results:
+        if exception is None:
+            print("%s\tOK" % name)
+        else:
+            print("%s\tFAILED (%s)" % (name, exception))
+            failed.append(name)
+
+    if failed:
+        sys.exit("Error: %d of %d runs failed: %s" % (len(failed), len(args.run_directories), ", ".join(failed)))
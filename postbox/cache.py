@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    if os.environ.get("POSTBOX_CACHE_DIR"):
+        return os.environ["POSTBOX_CACHE_DIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "postbox")
+
+def file_fingerprint(path):
+    '''
+    mtime, size and content hash of a file, or None if it does not exist.
+    '''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+
+def cache_key(arguments, paths):
+    '''
+    Key built from the arguments of a call and the fingerprints of the files it reads.
+    '''
+    fingerprints = [[os.path.abspath(path), file_fingerprint(path)] for path in paths]
+    material = json.dumps([CACHE_VERSION, arguments, fingerprints], sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+class Cache:
+    '''
+    A directory of JSON entries, evicting the least recently used once there are more than max_entries. Hits
+    touch the entry so that its modification time records when it was last used.
+    '''
+    def __init__(self, cache_dir=None, namespace="resolved", max_entries=256):
+        self.directory = os.path.join(cache_dir or default_cache_dir(), namespace)
+        self.max_entries = max_entries
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path) as json_file:
+                value = json.load(json_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.entry_path(key)
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "w") as json_file:
+                json.dump(value, json_file)
+            os.replace(tmp_path, path)
+            self.evict()
+        except OSError as e:
+            # the cache is only an optimisation, never fail a run over it
+            print("Warning: could not write to cache %s: %s" % (self.directory, e))
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def cached_resolve_run(protocol, pipeline, run_directory, run_configuration, basecalled_path, fast5_path, csv,
+                       cache_dir=None, use_cache=True):
+    '''
+    resolve_run, reusing the resolved pipeline_dict, config and sample_dict of an earlier call with the same
+    arguments while pipelines.json, the run configuration and the barcodes csv are unchanged.
+    '''
+    from postbox.postbox import resolve_run
+
+    if not use_cache:
+        return resolve_run(protocol, pipeline, run_directory, run_configuration, basecalled_path, fast5_path, csv)
+
+    # the resolution holds paths built from the protocol as given, which a relative protocol only shares with runs
+    # started from the same directory
+    protocol_key = protocol if os.path.isabs(protocol) else [os.getcwd(), protocol]
+    arguments = [protocol_key, pipeline, os.path.abspath(run_directory), run_configuration, basecalled_path,
+                 fast5_path, csv]
+    paths = [os.path.join(protocol, "rampart", "pipelines.json"), run_configuration, csv]
+    key = cache_key(arguments, paths)
+
+    cache = Cache(cache_dir)
+    value = cache.get(key)
+    if value is not None:
+        print("Using cached run resolution %s" % key[:12])
+        return value["pipeline_dict"], value["config"], value["sample_dict"]
+
+    pipeline_dict, config, sample_dict = resolve_run(protocol, pipeline, run_directory, run_configuration,
+                                                     basecalled_path, fast5_path, csv)
+    cache.put(key, {"pipeline_dict": pipeline_dict, "config": config, "sample_dict": sample_dict})
+    return pipeline_dict, config, sample_dict
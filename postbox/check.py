@@ -0,0 +1,314 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from postbox.postbox import add_protocol_arguments, add_run_configuration_arguments, add_cache_arguments, \
+    resolve_run_paths, load_run_configuration, update_config_with_basecalled_path, update_config_with_fast5_path, \
+    update_sample_dict_with_csv, filter_sample_dict, comma_list, pipeline_name_error
+from postbox.cache import Cache, cache_key
+from postbox.barcodes import find_barcode_files, unassigned_files, scan_fastq, is_fastq
+
+OK = "OK"
+WARNING = "WARN"
+FAIL = "FAIL"
+
+# executable as it appears in pipeline shell commands: command printing its version
+TOOLS = {
+    "snakemake": ["snakemake", "--version"],
+    "binlorry": ["binlorry", "--version"],
+    "minimap2": ["minimap2", "--version"],
+    "racon": ["racon", "--version"],
+    "mafft": ["mafft", "--version"],
+    "medaka_consensus": ["medaka", "--version"],
+    "samtools": ["samtools", "--version"]
+}
+VERSION_TIMEOUT = 30
+
+include_pattern = re.compile(r'^\s*include:\s*["\'](.+?)["\']', re.MULTILINE)
+
+
+def result(check, status, detail):
+    return {"check": check, "status": status, "detail": detail}
+
+def exit_message(function, *args):
+    '''
+    Call one of the postbox resolution functions, which exit on bad input, returning (value, None) or (None, the
+    error message) instead.
+    '''
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args), None
+    except SystemExit as e:
+        return None, str(e.code).replace("Error: ", "", 1)
+
+def check_protocol(protocol, pipeline_name):
+    '''
+    The checks find_pipeline makes, reported instead of exiting, plus the files named by config_file and requires.
+    Returns the results and the pipeline entry with its Snakefile path, or None if there is no usable pipeline.
+    '''
+    pipeline_json = os.path.join(protocol, "rampart", "pipelines.json")
+    if not os.path.isdir(protocol):
+        return [result("protocol", FAIL, "%s does not exist" % protocol)], None
+    try:
+        with open(pipeline_json) as json_file:
+            pipelines = json.load(json_file)
+    except FileNotFoundError:
+        return [result("protocol", FAIL, "%s does not exist" % pipeline_json)], None
+    except ValueError as e:
+        return [result("protocol", FAIL, "%s is not valid JSON: %s" % (pipeline_json, e))], None
+    results = [result("protocol", OK, pipeline_json)]
+
+    error = pipeline_name_error(pipelines, pipeline_name, pipeline_json)
+    if error is not None:
+        return results + [result("pipeline", FAIL, error)], None
+    if pipeline_name is None:
+        pipeline_name = list(pipelines)[0]
+
+    pipeline = dict(pipelines[pipeline_name])
+    pipeline_dir = os.path.join(protocol, "rampart", pipeline.get("path", ""))
+    pipeline["path"] = os.path.join(pipeline_dir, "Snakefile")
+    if not os.path.exists(pipeline["path"]):
+        return results + [result("pipeline", FAIL, "%s: %s does not exist"
+                                 % (pipeline_name, pipeline["path"]))], None
+    results.append(result("pipeline", OK, "%s: %s" % (pipeline_name, pipeline["path"])))
+
+    if "config_file" in pipeline:
+        config_file = os.path.join(pipeline_dir, pipeline["config_file"])
+        if os.path.exists(config_file):
+            results.append(result("config_file", OK, config_file))
+        else:
+            results.append(result("config_file", FAIL, "%s does not exist" % config_file))
+
+    for requirement in pipeline.get("requires", []):
+        if "file" not in requirement:
+            results.append(result("requires", FAIL, "entry without a file: %s" % json.dumps(requirement)))
+            continue
+        path = os.path.join(protocol, "rampart", requirement["file"])
+        name = requirement["file"]
+        if "config_key" in requirement:
+            name += " (%s)" % requirement["config_key"]
+        if not os.path.isfile(path):
+            results.append(result("requires", FAIL, "%s: %s does not exist" % (name, path)))
+        elif os.path.getsize(path) == 0:
+            results.append(result("requires", FAIL, "%s: %s is empty" % (name, path)))
+        else:
+            results.append(result("requires", OK, "%s: %s" % (name, path)))
+    return results, pipeline
+
+def pipeline_sources(snakefile):
+    '''
+    The Snakefile and every file it includes, directly or through other includes.
+    '''
+    sources = []
+    pending = [os.path.abspath(snakefile)]
+    while pending:
+        path = pending.pop()
+        if path in sources or not os.path.exists(path):
+            continue
+        sources.append(path)
+        with open(path) as f:
+            for include in include_pattern.findall(f.read()):
+                pending.append(os.path.normpath(os.path.join(os.path.dirname(path), include)))
+    return sources
+
+def pipeline_tools(snakefile):
+    '''
+    The known tools named anywhere in the pipeline sources, plus snakemake itself.
+    '''
+    text = ""
+    for path in pipeline_sources(snakefile):
+        with open(path) as f:
+            text += f.read()
+    return ["snakemake"] + sorted(tool for tool in TOOLS if tool != "snakemake"
+                                  and re.search(r'(?<![\w./-])%s\b' % re.escape(tool), text))
+
+def tool_version(command):
+    '''
+    The first line a tool prints for its version command, or None if it fails.
+    '''
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=VERSION_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    lines = [line.strip() for line in process.stdout.splitlines() if line.strip()]
+    if process.returncode != 0 or not lines:
+        return None
+    return lines[0]
+
+def check_tool(tool, cache=None):
+    '''
+    Whether a tool is on the PATH and what version it reports. Versions are cached against the size and
+    modification time of the executable, as some tools (medaka) take seconds just to print one.
+    '''
+    path = shutil.which(tool)
+    if path is None:
+        return result("tool", FAIL, "%s not found on the PATH" % tool)
+    # medaka_consensus has no --version of its own, so ask medaka, or the script itself when medaka is not there
+    command = [shutil.which(TOOLS[tool][0]) or path] + TOOLS[tool][1:]
+    stat = os.stat(command[0])
+    key = cache_key([tool, os.path.realpath(command[0]), stat.st_mtime_ns, stat.st_size] + command[1:], [])
+
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        entry = {"version": tool_version(command)}
+        if cache is not None:
+            cache.put(key, entry)
+    if entry["version"] is None:
+        return result("tool", WARNING, "%s (%s) did not report a version with %s" % (tool, path, " ".join(command)))
+    return result("tool", OK, "%s %s (%s)" % (tool, entry["version"], path))
+
+def check_run(args):
+    '''
+    Resolve the run as postbox would, reporting problems instead of exiting. Returns the results, the basecalled
+    path and the sample to barcode map (both None when the run cannot be resolved).
+    '''
+    config, message = exit_message(load_run_configuration, args.run_configuration)
+    if message is not None:
+        return [result("run_configuration", FAIL, message)], None, None
+    config, sample_dict = config
+    config, message = exit_message(update_config_with_basecalled_path, args.run_directory, config,
+                                   args.basecalled_path)
+    if message is not None:
+        return [result("basecalled_path", FAIL, message)], None, None
+    config = update_config_with_fast5_path(args.run_directory, config, args.fast5_path)
+    results = [result("basecalled_path", OK, config["basecalledPath"])]
+    if config["fast5Path"] is not None and not os.path.exists(config["fast5Path"]):
+        results.append(result("fast5_path", FAIL, "%s does not exist" % config["fast5Path"]))
+
+    sample_dict, message = exit_message(update_sample_dict_with_csv, args.csv, sample_dict)
+    if message is not None:
+        return results + [result("samples", FAIL, message)], None, None
+    sample_dict, message = exit_message(filter_sample_dict, sample_dict, args.samples, args.barcodes)
+    if message is not None:
+        return results + [result("samples", FAIL, message)], None, None
+    if sample_dict == {}:
+        results.append(result("samples", WARNING, "no sample to barcode map, the run is treated as unbarcoded"))
+    else:
+        results.append(result("samples", OK, "%d samples, %d barcodes" % (
+            len(sample_dict), sum(len(barcodes) for barcodes in sample_dict.values()))))
+    return results, config["basecalledPath"], sample_dict
+
+def file_sizes(paths):
+    total = 0
+    for path in paths:
+        try:
+            total += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return total
+
+def check_barcodes(basecalled_path, sample_dict, min_bytes=1):
+    '''
+    One result per barcode: FAIL if it has no fastq files or less than min_bytes of them, which would otherwise
+    give the sample empty outputs. Files with no barcode in their path (a flat directory demultiplexed by binlorry)
+    count for every barcode.
+    '''
+    if sample_dict == {}:
+        fastq = [os.path.join(root, name) for root, directories, files in os.walk(basecalled_path)
+                 for name in files if is_fastq(name)]
+        if not fastq:
+            return [result("reads", FAIL, "no fastq files under %s" % basecalled_path)]
+        return [result("reads", OK, "%d fastq files, %d bytes" % (len(fastq), file_sizes(fastq)))]
+
+    barcodes = sorted(set(barcode for sample in sample_dict for barcode in sample_dict[sample]))
+    all_files = scan_fastq(basecalled_path)
+    barcode_files = find_barcode_files(basecalled_path, barcodes, all_files)
+    unassigned = unassigned_files(basecalled_path, all_files)
+    results = []
+    for sample in sample_dict:
+        for barcode in sample_dict[sample]:
+            files = barcode_files[barcode] + unassigned
+            size = file_sizes(files)
+            name = "%s %s" % (sample, barcode)
+            if not files:
+                results.append(result("reads", FAIL, "%s: no fastq files under %s" % (name, basecalled_path)))
+            elif size < min_bytes:
+                results.append(result("reads", FAIL, "%s: %d fastq files with only %d bytes" % (name, len(files),
+                                                                                              size)))
+            else:
+                results.append(result("reads", OK, "%s: %d fastq files, %d bytes" % (name, len(files), size)))
+    return results
+
+def run_checks(args):
+    '''
+    All the checks, with the tool version calls and the basecalled directory scan running side by side.
+    '''
+    cache = Cache(args.cache_dir, namespace="tools") if args.use_cache else None
+    results, pipeline = check_protocol(args.protocol, args.pipeline)
+    run_results, basecalled_path, sample_dict = check_run(args)
+    tools = pipeline_tools(pipeline["path"]) if pipeline is not None else ["snakemake"]
+
+    with ThreadPoolExecutor(max_workers=len(tools) + 1) as executor:
+        tool_futures = [executor.submit(check_tool, tool, cache) for tool in tools]
+        barcode_future = None
+        if basecalled_path is not None:
+            barcode_future = executor.submit(check_barcodes, basecalled_path, sample_dict, args.min_bytes)
+        results.extend(future.result() for future in tool_futures)
+        results.extend(run_results)
+        if barcode_future is not None:
+            results.extend(barcode_future.result())
+    return results
+
+def format_results(results):
+    lines = ["%-5s %-17s %s" % (item["status"], item["check"], item["detail"]) for item in results]
+    failures = sum(1 for item in results if item["status"] == FAIL)
+    warnings = sum(1 for item in results if item["status"] == WARNING)
+    lines.append("%d checks: %d failed, %d warnings" % (len(results), failures, warnings))
+    return "\n".join(lines)
+
+def get_arguments(argv=None):
+    '''
+    Parse the command line arguments for postbox check.
+    '''
+    parser = argparse.ArgumentParser(prog='postbox check',
+                                     description='Checks the protocol, tools and basecalled reads a run needs \
+                                                  without starting snakemake')
+
+    main_group = parser.add_argument_group('Main options')
+    add_protocol_arguments(main_group)
+
+    run_group = parser.add_argument_group('Run configuration options')
+    run_group.add_argument('-d', '--run_directory', dest='run_directory', default='./',
+                           help='Path to the directory for this run if it is not in current working directory')
+    add_run_configuration_arguments(run_group)
+    run_group.add_argument('--samples', dest='samples', default=None, type=comma_list,
+                           help='Comma separated list of samples to check. Defaults to all samples')
+    run_group.add_argument('--barcodes', dest='barcodes', default=None, type=comma_list,
+                           help='Comma separated list of barcodes. Only samples using one of these are checked')
+    add_cache_arguments(run_group)
+
+    check_group = parser.add_argument_group('Check options')
+    check_group.add_argument('--min_bytes', dest='min_bytes', default=1, type=int,
+                             help='Fail barcodes with fewer bytes of fastq than this')
+    check_group.add_argument('--json', dest='json', action="store_true",
+                             help='Print the results as JSON instead of a table')
+
+    args = parser.parse_args(argv)
+    args.protocol = args.protocol.rstrip("/")
+    with contextlib.redirect_stdout(io.StringIO()):
+        args.run_directory, args.run_configuration, args.csv, log_file = resolve_run_paths(
+            args.run_directory, args.run_configuration, args.csv)
+    return args
+
+def main(argv=None):
+    args = get_arguments(argv)
+    start = time.perf_counter()
+    results = run_checks(args)
+    if args.json:
+        print(json.dumps({"seconds": round(time.perf_counter() - start, 3), "results": results}, indent=2))
+    else:
+        print(format_results(results))
+    if any(item["status"] == FAIL for item in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+'''
+Compressed intermediate files. With postbox --compress the pipelines write their large intermediates (binned reads
+and reports, the reads of each reference, minimap2's mappings) compressed, through multithreaded compressors run
+as separate processes:
+
+    gzip: block gzip from bgzip, else pigz, else gzip, else Python's gzip module
+    zstd: zstd, else the zstandard module
+
+minimap2, racon and medaka read gzip but not zstd, so files they read stay gzip in zstd mode. open_file reads and
+writes either transparently, by file extension. Each compressed file written records its size before and after
+and the CPU time of its compressor, which summarise_stats adds up per stage.
+
+    minimap2 ... | python -m postbox.compression compress --output mapped.paf.gz --stage minimap2 --stats s.jsonl
+    python -m postbox.compression report s.jsonl
+'''
+import argparse
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from postbox.postbox import Error
+
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+STATS_FILE = "compression.jsonl"
+BLOCK_SIZE = 1024 * 1024
+
+stats_lock = threading.Lock()
+
+
+def compression_of(path):
+    for compression, extension in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+def extension(compression):
+    return COMPRESSIONS[compression] if compression else ""
+
+def tool_extension(compression):
+    '''
+    The extension of compressed files that external tools read, which is gzip whatever the compression.
+    '''
+    return extension("gzip") if compression else ""
+
+def compress_command(compression, threads=1):
+    '''
+    The command compressing stdin to stdout, or None if only Python can do it here.
+    '''
+    if compression == "zstd":
+        if shutil.which("zstd"):
+            return ["zstd", "-q", "-c", "-T%d" % threads]
+        return None
+    if shutil.which("bgzip"):
+        return ["bgzip", "-c", "-@", str(threads)]
+    if shutil.which("pigz"):
+        return ["pigz", "-c", "-p", str(threads)]
+    if shutil.which("gzip"):
+        return ["gzip", "-c"]
+    return None
+
+def decompress_command(compression):
+    if compression == "zstd":
+        return ["zstd", "-q", "-d", "-c"] if shutil.which("zstd") else None
+    for tool in ["pigz", "gzip"]:
+        if shutil.which(tool):
+            return [tool, "-d", "-c"]
+    return None
+
+def python_compressor(compression, handle):
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=handle, mode="wb", compresslevel=6)
+    try:
+        import zstandard
+    except ImportError:
+        raise Error("Writing zstd files needs the zstd command or the zstandard package")
+    return zstandard.ZstdCompressor(threads=-1).stream_writer(handle)
+
+class CompressedWriter(io.RawIOBase):
+    '''
+    A binary file that compresses what is written to it into path. Data can also be copied straight to fileno()
+    after a flush, adding its size to bytes_in. Closing waits for the compressor and records the file in the stats file, if any.
+    '''
+    def __init__(self, path, compression=None, threads=1, stage=None, stats=None):
+        super().__init__()
+        self.path = path
+        self.compression = compression or compression_of(path)
+        self.stage = stage
+        self.stats = stats
+        self.bytes_in = 0
+        self.start = time.process_time()
+        self.output = open(path, "wb")
+        command = compress_command(self.compression, threads)
+        if command is None:
+            self.process = None
+            self.compressor = python_compressor(self.compression, self.output)
+        else:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self.output)
+            self.compressor = self.process.stdin
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        if self.process is None:
+            raise io.UnsupportedOperation("compressing in Python, there is no file descriptor to write to")
+        return self.process.stdin.fileno()
+
+    def write(self, data):
+        self.compressor.write(data)
+        self.bytes_in += len(data)
+        return len(data)
+
+    def flush(self):
+        if not self.closed:
+            self.compressor.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.compressor.close()
+        if self.process is None:
+            cpu_seconds = time.process_time() - self.start
+        else:
+            pid, status, usage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            cpu_seconds = usage.ru_utime + usage.ru_stime
+        self.output.close()
+        if self.process is not None and self.process.returncode != 0:
+            raise Error("Compressing %s failed with return code %d" % (self.path, self.process.returncode))
+        if self.stats is not None:
+            record_stats(self.stats, self.stage, self.path, self.bytes_in, os.path.getsize(self.path), cpu_seconds)
+
+class DecompressedReader(io.RawIOBase):
+    '''
+    A binary file reading the decompressed content of path from a decompressor process.
+    '''
+    def __init__(self, path, compression=None):
+        super().__init__()
+        compression = compression or compression_of(path)
+        command = decompress_command(compression)
+        if command is None:
+            raise Error("Reading %s needs the zstd command" % path)
+        self.input = open(path, "rb")
+        self.process = subprocess.Popen(command, stdin=self.input, stdout=subprocess.PIPE)
+        self.path = path
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.process.stdout.readinto(buffer)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.process.stdout.close()
+        return_code = self.process.wait()
+        self.input.close()
+        # a reader closed early gets the decompressor killed by SIGPIPE, which is not an error
+        if return_code not in (0, -13):
+            raise Error("Decompressing %s failed with return code %d" % (self.path, return_code))
+
+def open_file(path, mode="r", threads=1, stage=None, stats=None, buffering=BLOCK_SIZE, newline=None):
+    '''
+    Open path like open, compressing or decompressing by its extension. threads, stage and stats only apply to
+    compressed files written.
+    '''
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, mode, buffering=buffering, newline=None if "b" in mode else newline)
+    if "r" in mode:
+        if compression == "gzip" and decompress_command("gzip") is None:
+            raw = gzip.open(path, "rb")
+        else:
+            raw = DecompressedReader(path, compression)
+        handle = io.BufferedReader(raw, buffer_size=buffering)
+    else:
+        handle = io.BufferedWriter(CompressedWriter(path, compression, threads, stage, stats),
+                                   buffer_size=buffering)
+    if "b" in mode:
+        return handle
+    return io.TextIOWrapper(handle, newline=newline)
+
+def record_stats(stats, stage, path, bytes_in, bytes_out, cpu_seconds):
+    entry = {"time": round(time.time(), 3), "stage": stage or "unknown", "path": path, "bytes_in": bytes_in,
+             "bytes_out": bytes_out, "cpu_seconds": round(cpu_seconds, 3)}
+    with stats_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(stats)), exist_ok=True)
+        fd = os.open(stats, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry, sort_keys=True) + "\n").encode())
+        finally:
+            os.close(fd)
+
+def summarise_stats(stats, since=None):
+    '''
+    {stage: {"files", "bytes_in", "bytes_out", "cpu_seconds"}} from a stats file, counting files written after
+    since (a time.time()) if given.
+    '''
+    summary = {}
+    try:
+        with open(stats) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and entry["time"] < since:
+                    continue
+                stage = summary.setdefault(entry["stage"], {"files": 0, "bytes_in": 0, "bytes_out": 0,
+                                                            "cpu_seconds": 0.0})
+                stage["files"] += 1
+                for key in ["bytes_in", "bytes_out", "cpu_seconds"]:
+                    stage[key] += entry[key]
+    except FileNotFoundError:
+        pass
+    return summary
+
+def format_summary(summary):
+    lines = ["%-20s %6s %12s %12s %7s %9s" % ("stage", "files", "written MB", "saved MB", "saved", "CPU s")]
+    total = {"files": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+    for stage in sorted(summary) + ["total"]:
+        values = total if stage == "total" else summary[stage]
+        saved = values["bytes_in"] - values["bytes_out"]
+        lines.append("%-20s %6d %12.1f %12.1f %6.1f%% %9.2f" % (
+            stage, values["files"], values["bytes_out"] / 1e6, saved / 1e6,
+            100.0 * saved / values["bytes_in"] if values["bytes_in"] else 0.0, values["cpu_seconds"]))
+        if stage != "total":
+            for key in total:
+                total[key] += values[key]
+    return "\n".join(lines)
+
+def compress_stream(input_fd, path, compression=None, threads=1, stage=None, stats=None):
+    '''
+    Compress everything read from input_fd into path. Returns the bytes read.
+    '''
+    writer = CompressedWriter(path, compression, threads, stage, stats)
+    try:
+        while True:
+            block = os.read(input_fd, BLOCK_SIZE)
+            if not block:
+                break
+            writer.write(block)
+    finally:
+        writer.close()
+    return writer.bytes_in
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m postbox.compression',
+                                     description='Compress pipeline outputs and report the space saved')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compress = subparsers.add_parser('compress', help='Compress stdin into a file')
+    compress.add_argument('-o', '--output', dest='output', required=True,
+                          help='File to write, compressed as its extension says (.gz or .zst)')
+    compress.add_argument('-t', '--threads', dest='threads', default=1, type=int)
+    compress.add_argument('--stage', dest='stage', default=None, help='Stage to count the file under')
+    compress.add_argument('--stats', dest='stats', default=None, help='Stats file to record the file in')
+    report = subparsers.add_parser('report', help='Summarise a stats file per stage')
+    report.add_argument('stats')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = get_arguments(argv)
+    if args.command == "report":
+        print(format_summary(summarise_stats(args.stats)))
+        return
+    if compression_of(args.output) is None:
+        sys.exit("Error: %s does not end in one of %s" % (args.output, ", ".join(COMPRESSIONS.values())))
+    compress_stream(sys.stdin.fileno(), args.output, threads=args.threads, stage=args.stage, stats=args.stats)
+
+if __name__ == '__main__':
+    main()
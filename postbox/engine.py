@@ -0,0 +1,42 @@
+import argparse
+import sys
+
+from postbox.postbox import Error, SnakemakeError
+
+
+def load_snakemake():
+    '''
+    Import snakemake lazily so that the subprocess engine never pays for it.
+    '''
+    try:
+        import snakemake
+    except ImportError:
+        sys.exit('Error: --engine api needs snakemake to be importable from the python environment running postbox.')
+    if not hasattr(snakemake, "snakemake"):
+        sys.exit('Error: the installed snakemake (%s) does not provide the snakemake.snakemake() API. Use '
+                 '--engine subprocess with this version.' % getattr(snakemake, "__version__", "unknown"))
+    return snakemake
+
+def config_list_to_dict(config_list):
+    '''
+    Parse key=value pairs exactly as the snakemake command line parses --config.
+    '''
+    snakemake = load_snakemake()
+    return snakemake.parse_config(argparse.Namespace(config=config_list))
+
+def run_api(pipeline_dict, config_list, threads, dry_run=False, workdir=None, force=False, mem_mb=None):
+    snakemake = load_snakemake()
+    config = config_list_to_dict(config_list)
+
+    configfiles = None
+    if pipeline_dict["config_file"] is not None:
+        configfiles = [pipeline_dict["config_file"]]
+
+    print("snakemake API: %s %s" % (pipeline_dict["path"], " ".join(config_list)))
+    success = snakemake.snakemake(pipeline_dict["path"], cores=threads, configfiles=configfiles, config=config,
+                                  dryrun=dry_run, forceall=force, force_incomplete=True, lock=False,
+                                  workdir=workdir, resources={"mem_mb": mem_mb} if mem_mb is not None else {})
+    if not success:
+        print('Error running snakemake on:', pipeline_dict["path"], file=sys.stderr)
+        raise SnakemakeError('Error in snakemake run. Cannot continue')
+    return success
@@ -0,0 +1,502 @@
+'''
+Where postbox runs its snakemake invocations (the whole run, each sample of a run_per_sample pipeline, or each run
+of a batch), chosen with --executor:
+
+    local   as child processes of postbox, the default
+    pool    in a pool of worker processes, which can also run the api engine for several samples at once
+    queue   as jobs in a job queue that postbox worker processes on any number of nodes take work from
+
+The queue is an SQLite database on a filesystem every node sees, with the run directories, protocol and pipeline
+tools at the same paths on every node. Each job asks for the cores and memory snakemake will be told it has, and
+workers only take jobs that fit what they have free. postbox polls the queue until its jobs are done and then reads
+their logs, so the journal records their rules as it does for local runs.
+
+    postbox -p protocol -t 64 --executor queue --queue /shared/postbox/queue.db
+    postbox worker --queue /shared/postbox/queue.db --cores 16 --memory_mb 64000    # on every node
+    postbox worker --queue /shared/postbox/queue.db --status
+'''
+import argparse
+import multiprocessing
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from postbox.postbox import Error, SnakemakeError, syscall
+
+EXECUTORS = ["local", "pool", "queue"]
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCESS = "success"
+FAILED = "failed"
+CANCELLED = "cancelled"
+DONE = (SUCCESS, FAILED, CANCELLED)
+
+# lines of a failed job's log shown on the console
+TAIL_LINES = 20
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    command TEXT NOT NULL,
+    cwd TEXT NOT NULL,
+    cores INTEGER NOT NULL,
+    mem_mb INTEGER,
+    log_file TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    return_code INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    cores INTEGER NOT NULL,
+    mem_mb INTEGER,
+    heartbeat REAL NOT NULL
+);
+'''
+
+
+class Job:
+    '''
+    One snakemake invocation: its shell command, or for the api engine the arguments of engine.run_api, where to
+    run it, the cores and memory it asks for and the file its output goes to.
+    '''
+    def __init__(self, name, command, cwd=None, cores=1, mem_mb=None, log_file=None, api=None):
+        self.name = name
+        self.command = command
+        self.cwd = cwd
+        self.cores = cores
+        self.mem_mb = mem_mb
+        self.log_file = log_file
+        self.api = api
+
+def check_return_code(job, return_code):
+    if return_code != 0:
+        print('Error running this command:', job.command, file=sys.stderr)
+        print('Return code:', return_code, file=sys.stderr)
+        raise SnakemakeError('Error in system call. Cannot continue')
+
+def log_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def read_log(path, offset=0):
+    '''
+    The lines written to path after offset.
+    '''
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read().decode(errors="replace").splitlines(True)
+    except FileNotFoundError:
+        return []
+
+def collect_log(job, lines, return_code, prefix="", line_callback=None):
+    '''
+    Hand the output of a job that ran elsewhere to line_callback, show the end of it if the job failed and raise
+    as syscall would.
+    '''
+    if line_callback is not None:
+        for line in lines:
+            line_callback(line.rstrip("\n"))
+    if return_code != 0:
+        for line in lines[-TAIL_LINES:]:
+            print(prefix + line.rstrip("\n"), file=sys.stderr)
+    check_return_code(job, return_code)
+
+class LocalExecutor:
+    '''
+    Runs jobs as child processes of postbox, or in postbox itself for the api engine.
+    '''
+    name = "local"
+    runs_api = True
+    concurrent_api = False
+
+    def run(self, job, log_level="DEBUG", log_max_bytes=50 * 1024 * 1024, prefix="", report=False, monitor=None,
+            line_callback=None):
+        if job.api is not None:
+            from postbox.engine import run_api
+            run_api(**job.api)
+            return 0
+        return_code = syscall(job.command, allow_fail=True, log_file=job.log_file, log_level=log_level,
+                              log_max_bytes=log_max_bytes, prefix=prefix, report=report, cwd=job.cwd,
+                              line_callback=line_callback, monitor=monitor).returncode
+        check_return_code(job, return_code)
+        return return_code
+
+    def close(self):
+        pass
+
+def run_in_worker(job, log_level, log_max_bytes, prefix):
+    '''
+    Run a job in a pool worker, returning its return code and output lines.
+    '''
+    if job.api is not None:
+        from postbox.engine import run_api
+        try:
+            run_api(**job.api)
+        except SnakemakeError as e:
+            return 1, [str(e)]
+        return 0, []
+    lines = []
+    process = syscall(job.command, allow_fail=True, log_file=job.log_file, log_level=log_level,
+                      log_max_bytes=log_max_bytes, prefix=prefix, cwd=job.cwd, line_callback=lines.append)
+    return process.returncode, lines
+
+class PoolExecutor:
+    '''
+    Runs jobs in a pool of worker processes. Snakemake's output is pumped and logged by the workers instead of
+    threads of postbox, and api engine jobs run side by side, each in its own worker.
+    '''
+    name = "pool"
+    runs_api = True
+    concurrent_api = True
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, *args):
+        with self.lock:
+            if self.pool is None:
+                # forking a postbox that has threads running could copy a held lock into the worker
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+            return self.pool.submit(*args)
+
+    def run(self, job, log_level="DEBUG", log_max_bytes=50 * 1024 * 1024, prefix="", report=False, monitor=None,
+            line_callback=None):
+        return_code, lines = self.submit(run_in_worker, job, log_level, log_max_bytes, prefix).result()
+        collect_log(job, lines, return_code, prefix, line_callback)
+        return return_code
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+class JobQueue:
+    '''
+    The SQLite job queue of the queue executor. Every call opens its own connection, so one JobQueue can be
+    shared by threads, and claims take the database's write lock, so two workers never take the same job.
+    '''
+    def __init__(self, path, timeout=60.0):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return Connection(db)
+
+    def log_directory(self):
+        return os.path.splitext(self.path)[0] + ".logs"
+
+    def submit(self, job):
+        '''
+        Queue a job, returning its id. Jobs without a log file log to the queue's log directory.
+        '''
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            job_id = db.execute(
+                "INSERT INTO jobs (name, command, cwd, cores, mem_mb, log_file, status, submitted) "
+                "VALUES (?, ?, ?, ?, ?, '', ?, ?)",
+                (job.name, job.command, os.path.abspath(job.cwd or os.getcwd()), max(1, job.cores), job.mem_mb,
+                 QUEUED, time.time())).lastrowid
+            log_file = job.log_file or os.path.join(self.log_directory(), "%d.log" % job_id)
+            db.execute("UPDATE jobs SET log_file = ? WHERE id = ?", (os.path.abspath(log_file), job_id))
+            db.execute("COMMIT")
+        return job_id
+
+    def job(self, job_id):
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def jobs(self, statuses=None):
+        with self.connect() as db:
+            if statuses is None:
+                rows = db.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = db.execute("SELECT * FROM jobs WHERE status IN (%s) ORDER BY id" % ",".join("?" * len(statuses)),
+                                  tuple(statuses)).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim(self, worker, free_cores, free_mem_mb=None, idle=False):
+        '''
+        Mark the oldest queued job that fits in free_cores and free_mem_mb as running on worker and return it, or
+        None. An idle worker takes the oldest job whatever it asks for, so that jobs asking for more than any one
+        worker has still run.
+        '''
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? AND (? OR (cores <= ? AND (mem_mb IS NULL OR ? IS NULL OR "
+                "mem_mb <= ?))) ORDER BY id LIMIT 1",
+                (QUEUED, idle, free_cores, free_mem_mb, free_mem_mb)).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE jobs SET status = ?, worker = ?, started = ?, attempts = attempts + 1 WHERE id = ?",
+                       (RUNNING, worker, time.time(), row["id"]))
+            db.execute("COMMIT")
+        return dict(row)
+
+    def finish(self, job_id, return_code):
+        status = SUCCESS if return_code == 0 else FAILED
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = CASE WHEN cancel = 1 THEN ? ELSE ? END, return_code = ?, "
+                       "finished = ? WHERE id = ? AND status = ?",
+                       (CANCELLED, status, return_code, time.time(), job_id, RUNNING))
+
+    def cancel(self, job_id):
+        '''
+        Cancel a job: straight away if it is still queued, else by asking its worker to stop it.
+        '''
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                       (CANCELLED, time.time(), job_id, QUEUED))
+            db.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND status = ?", (job_id, RUNNING))
+
+    def cancelled(self, job_ids):
+        if not job_ids:
+            return []
+        with self.connect() as db:
+            rows = db.execute("SELECT id FROM jobs WHERE cancel = 1 AND id IN (%s)" % ",".join("?" * len(job_ids)),
+                              tuple(job_ids)).fetchall()
+        return [row["id"] for row in rows]
+
+    def heartbeat(self, worker, cores, mem_mb=None):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO workers (name, cores, mem_mb, heartbeat) VALUES (?, ?, ?, ?)",
+                       (worker, cores, mem_mb, time.time()))
+
+    def release(self, worker):
+        '''
+        Put the running jobs of a worker that is stopping back in the queue, or cancel those it was asked to.
+        '''
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("UPDATE jobs SET status = ?, worker = NULL, started = NULL WHERE worker = ? AND status = ? "
+                       "AND cancel = 0", (QUEUED, worker, RUNNING))
+            db.execute("UPDATE jobs SET status = ?, finished = ? WHERE worker = ? AND status = ? AND cancel = 1",
+                       (CANCELLED, time.time(), worker, RUNNING))
+            db.execute("DELETE FROM workers WHERE name = ?", (worker,))
+            db.execute("COMMIT")
+
+    def requeue_lost(self, stale_after):
+        '''
+        Put the running jobs of workers not heard from for stale_after seconds back in the queue, as their node
+        has most likely gone. Returns how many were.
+        '''
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            lost = db.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, started = NULL WHERE status = ? AND cancel = 0 AND "
+                "worker NOT IN (SELECT name FROM workers WHERE heartbeat >= ?)",
+                (QUEUED, RUNNING, time.time() - stale_after)).rowcount
+            db.execute("UPDATE jobs SET status = ?, finished = ? WHERE status = ? AND cancel = 1 AND "
+                       "worker NOT IN (SELECT name FROM workers WHERE heartbeat >= ?)",
+                       (CANCELLED, time.time(), RUNNING, time.time() - stale_after))
+            db.execute("COMMIT")
+        return lost
+
+class Connection:
+    '''
+    An sqlite3 connection closed at the end of a with block, which sqlite3's own only commits.
+    '''
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+        self.db.close()
+
+class QueueExecutor:
+    '''
+    Submits jobs to a JobQueue and polls it until they are done. Jobs still queued or running when postbox is
+    interrupted are cancelled.
+    '''
+    name = "queue"
+    runs_api = False
+    concurrent_api = False
+
+    def __init__(self, path, poll_interval=5.0):
+        self.queue = JobQueue(path)
+        self.poll_interval = poll_interval
+
+    def run(self, job, log_level="DEBUG", log_max_bytes=50 * 1024 * 1024, prefix="", report=False, monitor=None,
+            line_callback=None):
+        print(prefix + job.command)
+        offset = log_size(job.log_file) if job.log_file else 0
+        job_id = self.queue.submit(job)
+        print("%sQueued as job %d (%d cores%s)" % (prefix, job_id, max(1, job.cores),
+                                                   ", %d MB" % job.mem_mb if job.mem_mb is not None else ""))
+        state = None
+        try:
+            while True:
+                state = self.queue.job(job_id)
+                if state["status"] in DONE:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            if state is None or state["status"] not in DONE:
+                self.queue.cancel(job_id)
+        print("%sJob %d %s on %s" % (prefix, job_id, state["status"], state["worker"]))
+        return_code = state["return_code"] if state["return_code"] is not None else 1
+        collect_log(job, read_log(state["log_file"], offset), return_code, prefix, line_callback)
+        return return_code
+
+    def close(self):
+        pass
+
+def make_executor(args):
+    '''
+    The executor chosen on the command line. Dry runs are always local.
+    '''
+    name = getattr(args, "executor", "local")
+    if name == "local" or getattr(args, "dry_run", False):
+        return LocalExecutor()
+    if name == "pool":
+        return PoolExecutor(args.workers or args.threads)
+    if args.queue is None:
+        sys.exit('Error: --executor queue needs --queue, the job queue the workers read')
+    return QueueExecutor(args.queue, args.queue_poll_interval)
+
+def worker_name():
+    return "%s:%d" % (os.uname().nodename, os.getpid())
+
+def start_job(row):
+    os.makedirs(os.path.dirname(row["log_file"]), exist_ok=True)
+    log = open(row["log_file"], "ab")
+    # its own process group, so that cancelling it also stops the processes snakemake started
+    process = subprocess.Popen(row["command"], shell=True, cwd=row["cwd"], stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    return process, log
+
+def stop_job(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+def run_worker(queue, cores, mem_mb=None, poll_interval=5.0, stale_after=120.0, exit_when_idle=False, name=None,
+               stop=None):
+    '''
+    Take jobs from queue while they fit in cores and mem_mb, run them and record how they ended, until
+    interrupted, until the threading.Event stop is set or, with exit_when_idle, until nothing is queued or
+    running. Returns the ids of the jobs run.
+    '''
+    name = name or worker_name()
+    running = {}
+    done = []
+    try:
+        while True:
+            for job_id in list(running):
+                process, log, row = running[job_id]
+                return_code = process.poll()
+                if return_code is not None:
+                    log.close()
+                    queue.finish(job_id, return_code)
+                    print("Job %d (%s) finished with return code %d" % (job_id, row["name"], return_code))
+                    done.append(job_id)
+                    del running[job_id]
+            for job_id in queue.cancelled(list(running)):
+                stop_job(running[job_id][0])
+
+            queue.heartbeat(name, cores, mem_mb)
+            lost = queue.requeue_lost(stale_after)
+            if lost:
+                print("Requeued %d jobs of workers that stopped responding" % lost)
+
+            while True:
+                free_cores = cores - sum(row["cores"] for process, log, row in running.values())
+                free_mem_mb = None if mem_mb is None else \
+                    mem_mb - sum(row["mem_mb"] or 0 for process, log, row in running.values())
+                row = queue.claim(name, free_cores, free_mem_mb, idle=not running)
+                if row is None:
+                    break
+                process, log = start_job(row)
+                running[row["id"]] = (process, log, row)
+                print("Job %d (%s) started with %d cores in %s" % (row["id"], row["name"], row["cores"], row["cwd"]))
+
+            if exit_when_idle and not running and not queue.jobs([QUEUED]):
+                return done
+            if stop is not None:
+                if stop.wait(poll_interval):
+                    return done
+            else:
+                time.sleep(poll_interval)
+    finally:
+        # jobs left behind go back to the queue for another worker
+        for job_id, (process, log, row) in running.items():
+            stop_job(process)
+            process.wait()
+            log.close()
+        queue.release(name)
+
+def format_jobs(jobs):
+    lines = ["%6s %-10s %-24s %5s %8s %-24s %s" % ("id", "status", "name", "cores", "mem_mb", "worker", "log")]
+    for job in jobs:
+        lines.append("%6d %-10s %-24s %5d %8s %-24s %s" % (
+            job["id"], job["status"], job["name"][:24], job["cores"],
+            job["mem_mb"] if job["mem_mb"] is not None else "-", job["worker"] or "-", job["log_file"]))
+    return "\n".join(lines)
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='postbox worker',
+                                     description='Runs jobs that postbox --executor queue submits to a job queue')
+    parser.add_argument('--queue', dest='queue', required=True,
+                        help='Path to the job queue, on a filesystem shared with the nodes submitting to it')
+    parser.add_argument('--cores', dest='cores', default=os.cpu_count() or 1, type=int,
+                        help='Cores shared by the jobs this worker runs at once. Defaults to all of them')
+    parser.add_argument('--memory_mb', dest='memory_mb', default=None, type=int,
+                        help='Memory in MB shared by the jobs this worker runs at once. Defaults to no limit')
+    parser.add_argument('--poll_interval', dest='poll_interval', default=5.0, type=float,
+                        help='Seconds between looks at the queue')
+    parser.add_argument('--stale_after', dest='stale_after', default=120.0, type=float,
+                        help='Seconds after which the running jobs of a worker that stopped responding are queued '
+                        'again')
+    parser.add_argument('--exit_when_idle', dest='exit_when_idle', action="store_true",
+                        help='Stop once the queue is empty instead of waiting for more jobs')
+    parser.add_argument('--status', dest='status', action="store_true",
+                        help='List the jobs in the queue and exit')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = get_arguments(argv)
+    queue = JobQueue(args.queue)
+    if args.status:
+        print(format_jobs(queue.jobs()))
+        return
+    print("Worker %s taking jobs from %s with %d cores" % (worker_name(), queue.path, args.cores))
+    try:
+        run_worker(queue, args.cores, args.memory_mb, args.poll_interval, args.stale_after, args.exit_when_idle)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
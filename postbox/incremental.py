@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import threading
+
+from postbox.barcodes import find_barcode_files, unassigned_files, scan_fastq
+
+STATE_DIRECTORY = ".postbox"
+
+fingerprint_lock = threading.Lock()
+
+
+def state_path(run_directory, file_name):
+    return os.path.join(run_directory, STATE_DIRECTORY, file_name)
+
+def fingerprints_path(run_directory):
+    return state_path(run_directory, "fingerprints.json")
+
+def fingerprint_files(paths, base_path, files):
+    '''
+    A digest of the names, sizes and modification times (from files, as scan_fastq returns them) of a set of
+    files. Reads are only ever appended to a run as new files, so this changes whenever a barcode gets more reads
+    without having to read the files.
+    '''
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        size, mtime_ns = files[path]
+        digest.update(("%s\t%d\t%d\n" % (os.path.relpath(path, base_path), size, mtime_ns)).encode())
+    return digest.hexdigest()
+
+def sample_fingerprints(basecalled_path, sample_dict, files=None):
+    '''
+    Fingerprints of the reads of each sample, from files if the basecalled directory has already been scanned. Files
+    with no barcode in their path (as in a flat directory that binlorry demultiplexes) count for every sample.
+    '''
+    if files is None:
+        files = scan_fastq(basecalled_path)
+    barcodes = [barcode for sample in sample_dict for barcode in sample_dict[sample]]
+    barcode_files = find_barcode_files(basecalled_path, barcodes, files)
+    unassigned = unassigned_files(basecalled_path, files)
+
+    fingerprints = {}
+    for sample in sample_dict:
+        paths = [path for barcode in sample_dict[sample] for path in barcode_files[barcode]] + unassigned
+        fingerprints[sample] = fingerprint_files(paths, basecalled_path, files)
+    return fingerprints
+
+def load_fingerprints(run_directory):
+    path = fingerprints_path(run_directory)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as json_file:
+        return json.load(json_file)
+
+def save_fingerprints(run_directory, fingerprints):
+    '''
+    Record the fingerprints of samples that completed successfully, keeping those of other samples.
+    '''
+    path = fingerprints_path(run_directory)
+    with fingerprint_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        saved = load_fingerprints(run_directory)
+        saved.update(fingerprints)
+        with open(path + ".tmp", "w") as json_file:
+            json.dump(saved, json_file, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+def changed_samples(fingerprints, previous):
+    return [sample for sample in fingerprints if previous.get(sample) != fingerprints[sample]]
@@ -0,0 +1,162 @@
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+from postbox.incremental import state_path
+from postbox.telemetry import SnakemakeLogParser
+
+JOURNAL_FILE = "journal.jsonl"
+LOCK_FILE = "run.lock"
+
+
+class RunLock:
+    '''
+    An exclusive lock on a run directory, held for as long as postbox works on it. Snakemake's own lock would stop
+    the per-sample snakemake processes of one run from sharing the directory, so they run with --nolock and this
+    keeps other postbox processes out instead. The lock is released by the kernel if postbox dies.
+    '''
+    def __init__(self, run_directory, timeout=0.0):
+        self.run_directory = run_directory
+        self.path = state_path(run_directory, LOCK_FILE)
+        self.timeout = timeout
+        self.fd = None
+
+    def holder(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or "unknown"
+        except OSError:
+            return "unknown"
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        os.ftruncate(fd, 0)
+        os.write(fd, ("pid %d on %s\n" % (os.getpid(), os.uname().nodename)).encode())
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            sys.exit('Error: %s is in use by another postbox (%s, see %s). Wait for it to finish, or give '
+                     '--lock_timeout to wait for it automatically.' % (self.run_directory, self.holder(), self.path))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class Journal:
+    '''
+    An append-only record of what postbox did in a run directory, one JSON object per line: runs starting and
+    ending, samples succeeding or failing, and the snakemake rules finished on the way. Every line is synced to
+    disk before postbox moves on, so an interrupted run (OOM kill, preempted node) can be resumed from it.
+    '''
+    def __init__(self, run_directory):
+        self.path = state_path(run_directory, JOURNAL_FILE)
+        self.lock = threading.Lock()
+
+    def record(self, event, **details):
+        entry = dict(details, time=round(time.time(), 3), event=event)
+        line = (json.dumps(entry, sort_keys=True) + "\n").encode()
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def entries(self):
+        entries = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # a line cut short when postbox was killed mid write
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def unfinished_run(self):
+        '''
+        The entries of the last run (from its run_start, through any resumes) unless it ended successfully, else
+        None. Runs that were killed never record their end at all.
+        '''
+        entries = self.entries()
+        starts = [index for index, entry in enumerate(entries) if entry["event"] == "run_start"]
+        if not starts:
+            return None
+        run = entries[starts[-1]:]
+        ends = [entry for entry in run if entry["event"] == "run_end"]
+        if ends and ends[-1].get("status") == "success":
+            return None
+        return run
+
+    def completed_samples(self):
+        '''
+        Samples that the last run finished before it was interrupted or failed, or None if there is no run to
+        resume.
+        '''
+        run = self.unfinished_run()
+        if run is None:
+            return None
+        return set(entry["sample"] for entry in run if entry["event"] == "sample_success")
+
+    def stage_recorder(self, sample=None):
+        '''
+        A line callback for snakemake's output that journals every rule as it finishes.
+        '''
+        rules = {}
+
+        def started(block, now):
+            rules[block["jobid"]] = (block["rule"], block.get("wildcards", ""))
+
+        def finished(jobid, status, now):
+            rule, wildcards = rules.pop(jobid, (None, ""))
+            if rule is not None:
+                self.record("stage", sample=sample, rule=rule, wildcards=wildcards, status=status)
+
+        parser = SnakemakeLogParser(on_start=started, on_finish=finished)
+        return parser.feed
+
+def retry(function, attempts=1, backoff=30.0, on_failure=None, label="", sleep=time.sleep, retry_on=Exception):
+    '''
+    Call function(attempt) until it returns, at most attempts times, waiting backoff seconds after the first
+    failure and twice as long after each further one. Only exceptions of the retry_on type(s) are retried.
+    on_failure(attempt, exception) is called on every failure; the last one is raised.
+    '''
+    attempts = max(1, attempts)
+    for attempt in range(1, attempts + 1):
+        try:
+            return function(attempt)
+        except Exception as e:
+            if on_failure is not None:
+                on_failure(attempt, e)
+            if attempt == attempts or not isinstance(e, retry_on):
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print("%sAttempt %d of %d failed: %s. Retrying in %.0fs" % (label, attempt, attempts, e, delay))
+            sleep(delay)
@@ -0,0 +1,148 @@
+import gzip
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from postbox.barcodes import scan_fastq, barcode_of_path, normalise_barcode
+from postbox.incremental import state_path
+
+MANIFEST_FILE = "manifest.tsv"
+COLUMNS = ["path", "size", "mtime_ns", "barcode", "reads"]
+
+manifest_lock = threading.Lock()
+
+
+def manifest_path(run_directory):
+    return state_path(run_directory, MANIFEST_FILE)
+
+def count_reads(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    lines = 0
+    with opener(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            lines += block.count(b"\n")
+    return lines // 4
+
+def load_manifest(path):
+    '''
+    The basecalled path a manifest was built for and its entries, {relative path: {"size", "mtime_ns", "barcode",
+    "reads"}}, with reads None for files not counted. (None, {}) if there is no manifest yet.
+    '''
+    entries = {}
+    try:
+        with open(path) as f:
+            basecalled_path = f.readline().rstrip("\n").split("\t", 1)[1]
+            f.readline()
+            for line in f:
+                relative_path, size, mtime_ns, barcode, reads = line.rstrip("\n").split("\t")
+                entries[relative_path] = {"size": int(size), "mtime_ns": int(mtime_ns), "barcode": barcode or None,
+                                          "reads": int(reads) if reads else None}
+    except FileNotFoundError:
+        return None, {}
+    return basecalled_path, entries
+
+def save_manifest(path, basecalled_path, entries):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write("#basecalled_path\t%s\n" % basecalled_path)
+        f.write("\t".join(COLUMNS) + "\n")
+        for relative_path in sorted(entries):
+            entry = entries[relative_path]
+            reads = "" if entry["reads"] is None else entry["reads"]
+            f.write("%s\t%d\t%d\t%s\t%s\n" % (relative_path, entry["size"], entry["mtime_ns"],
+                                               entry["barcode"] or "", reads))
+    os.replace(path + ".tmp", path)
+
+def selected_barcodes(barcodes):
+    return None if barcodes is None else set(normalise_barcode(barcode) for barcode in barcodes)
+
+def is_selected(barcode, wanted):
+    # files with no barcode in their path are demultiplexed by binlorry, so any selection may need them
+    return wanted is None or barcode is None or barcode in wanted
+
+def update_manifest(basecalled_path, entries=None, threads=8, barcodes=None):
+    '''
+    Scan basecalled_path and return its manifest entries and the number of entries that were new or changed. Reads
+    are only counted in new or changed files of the given barcodes (of all if None) or with no barcode in their path,
+    as the rest are not read by the run; files with the size and modification time of an entry in entries keep its count.
+    '''
+    entries = entries or {}
+    wanted = selected_barcodes(barcodes)
+    files = scan_fastq(basecalled_path, threads)
+
+    manifest = {}
+    changed = 0
+    to_count = []
+    for path, (size, mtime_ns) in files.items():
+        relative_path = os.path.relpath(path, basecalled_path)
+        barcode = barcode_of_path(relative_path)
+        count = is_selected(barcode, wanted)
+        previous = entries.get(relative_path)
+        if previous is not None and previous["size"] == size and previous["mtime_ns"] == mtime_ns and \
+                (previous["reads"] is not None or not count):
+            manifest[relative_path] = previous
+            continue
+        manifest[relative_path] = {"size": size, "mtime_ns": mtime_ns, "barcode": barcode, "reads": None}
+        changed += 1
+        if count:
+            to_count.append(relative_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        paths = [os.path.join(basecalled_path, relative_path) for relative_path in to_count]
+        for relative_path, reads in zip(to_count, executor.map(count_reads, paths)):
+            manifest[relative_path]["reads"] = reads
+    return manifest, changed
+
+def update_run_manifest(run_directory, basecalled_path, threads=8, barcodes=None):
+    '''
+    Bring the manifest kept in the run's state directory up to date with basecalled_path, counting the reads of the
+    given barcodes, save it and return its path and entries.
+    '''
+    path = manifest_path(run_directory)
+    start = time.perf_counter()
+    with manifest_lock:
+        previous_path, entries = load_manifest(path)
+        if previous_path != basecalled_path:
+            entries = {}
+        manifest, changed = update_manifest(basecalled_path, entries, threads, barcodes)
+        if changed or len(manifest) != len(entries):
+            save_manifest(path, basecalled_path, manifest)
+    wanted = selected_barcodes(barcodes)
+    reads = sum(entry["reads"] or 0 for entry in manifest.values() if is_selected(entry["barcode"], wanted))
+    print("Input manifest: %d fastq files, %d new or changed, %d reads for the selected barcodes (%.2fs)" % (
+        len(manifest), changed, reads, time.perf_counter() - start))
+    return path, manifest
+
+def manifest_files(basecalled_path, entries):
+    '''
+    {path: (size, mtime_ns)} as scan_fastq returns it, from manifest entries.
+    '''
+    return {os.path.join(basecalled_path, relative_path): (entry["size"], entry["mtime_ns"])
+            for relative_path, entry in entries.items()}
+
+def barcode_entries(entries, barcodes):
+    '''
+    The manifest entries of the given barcodes, and those with no barcode in their path: in a flat basecalled
+    directory that is every file, and binlorry picks the barcodes' reads out of them from the annotations.
+    '''
+    wanted = selected_barcodes(barcodes)
+    return {relative_path: entry for relative_path, entry in entries.items() if is_selected(entry["barcode"], wanted)}
+
+def link_barcode_files(path, barcodes, directory):
+    '''
+    Fill directory with symbolic links to the files of the given barcodes (see barcode_entries) in the manifest at path,
+    under the same
+    relative paths as in the basecalled directory so that file names and barcode directories are kept. Returns the
+    number of files linked.
+    '''
+    basecalled_path, entries = load_manifest(path)
+    if basecalled_path is None:
+        raise FileNotFoundError("No input manifest at %s" % path)
+    selected = barcode_entries(entries, barcodes)
+    os.makedirs(directory, exist_ok=True)
+    for relative_path in selected:
+        link = os.path.join(directory, relative_path)
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(os.path.join(os.path.abspath(basecalled_path), relative_path), link)
+    return len(selected)
@@ -0,0 +1,244 @@
+'''
+Merge binlorry's per barcode fastq and csv files into per sample files, as the rename_to_samples rule of the
+example pipeline does:
+
+    python -m postbox.merge --input_prefix binned/temp/binned --output_prefix binned/binned \
+        --sample North:BC01 --sample South:BC02,BC03
+
+writes binned/binned_North.fastq and .csv from binned/temp/binned_BC01.fastq and .csv, and so on. A sample with a
+single barcode gets hard links to its files (copies where the filesystem cannot link); the files of pooled samples
+are concatenated inside the kernel, without passing the data through postbox. With --compression the per sample
+files are written compressed instead (see postbox.compression).
+'''
+import argparse
+import csv
+import errno
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from postbox.compression import COMPRESSIONS, CompressedWriter, compression_of, extension, open_file
+
+# errors from copy_file_range and sendfile that mean "not between these files", rather than a failed copy
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def copy_fd(in_fd, out_fd, offset, size):
+    '''
+    Append size bytes of in_fd from offset to out_fd, with copy_file_range where the kernel and filesystem support
+    it (a server side copy on NFS 4.2, shared extents on btrfs and xfs), else sendfile, else read and write.
+    '''
+    end = offset + size
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(in_fd, out_fd, end - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+    if offset < end and hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                copied = os.sendfile(out_fd, in_fd, offset, min(end - offset, BLOCK_SIZE))
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+    while offset < end:
+        block = os.pread(in_fd, min(end - offset, BLOCK_SIZE), offset)
+        if not block:
+            break
+        os.write(out_fd, block)
+        offset += len(block)
+
+def open_output(path):
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+class Output:
+    '''
+    A file being merged into, compressed if its name ends in .gz or .zst.
+    '''
+    def __init__(self, path, threads=1, stats=None):
+        self.writer = None
+        if compression_of(path):
+            self.writer = CompressedWriter(path, threads=threads, stage="merge", stats=stats)
+            try:
+                self.fd = self.writer.fileno()
+            except io.UnsupportedOperation:
+                self.fd = None
+        else:
+            self.fd = open_output(path)
+
+    def write(self, data):
+        if self.writer is not None:
+            self.writer.write(data)
+        else:
+            os.write(self.fd, data)
+
+    def append(self, in_fd, offset, size):
+        if self.fd is None:
+            for start in range(offset, offset + size, BLOCK_SIZE):
+                self.writer.write(os.pread(in_fd, min(BLOCK_SIZE, offset + size - start), start))
+            return
+        if self.writer is not None:
+            self.writer.flush()
+            self.writer.bytes_in += size
+        copy_fd(in_fd, self.fd, offset, size)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def concatenate(paths, output, threads=1, stats=None):
+    with Output(output, threads, stats) as out:
+        for path in paths:
+            in_fd = os.open(path, os.O_RDONLY)
+            try:
+                out.append(in_fd, 0, os.fstat(in_fd).st_size)
+            finally:
+                os.close(in_fd)
+
+def link_or_copy(source, output):
+    '''
+    Make output a hard link to source, or a copy where that is not possible. Returns "link" or "copy".
+    '''
+    if os.path.lexists(output):
+        os.remove(output)
+    try:
+        os.link(source, output)
+        return "link"
+    except OSError:
+        concatenate([source], output)
+        return "copy"
+
+def read_header(path):
+    with open(path, "rb") as f:
+        return f.readline()
+
+def merge_csvs(paths, output, threads=1, stats=None):
+    '''
+    Join csv files with one header. When every file has the same header their bodies are copied as they are;
+    otherwise rows are matched up by column name, with empty values for columns a file does not have.
+    '''
+    headers = [read_header(path) for path in paths]
+    present = [(path, header) for path, header in zip(paths, headers) if header]
+    if len(set(header.rstrip(b"\r\n") for path, header in present)) > 1:
+        merge_csv_columns([path for path, header in present], output, threads, stats)
+        return
+
+    with Output(output, threads, stats) as out:
+        if present:
+            header = present[0][1]
+            out.write(header if header.endswith(b"\n") else header + b"\n")
+        for path, header in present:
+            in_fd = os.open(path, os.O_RDONLY)
+            try:
+                size = os.fstat(in_fd).st_size - len(header)
+                out.append(in_fd, len(header), size)
+                if size and os.pread(in_fd, 1, len(header) + size - 1) != b"\n":
+                    out.write(b"\n")
+            finally:
+                os.close(in_fd)
+
+def merge_csv_columns(paths, output, threads=1, stats=None):
+    columns = []
+    for path in paths:
+        with open(path, newline="") as f:
+            for column in next(csv.reader(f), []):
+                if column not in columns:
+                    columns.append(column)
+    with open_file(output, "w", threads=threads, stage="merge", stats=stats, newline="") as fw:
+        writer = csv.DictWriter(fw, columns, restval="", lineterminator="\n")
+        writer.writeheader()
+        for path in paths:
+            with open(path, newline="") as f:
+                writer.writerows(csv.DictReader(f))
+
+def barcode_files(input_prefix, barcode):
+    return "%s_%s.fastq" % (input_prefix, barcode), "%s_%s.csv" % (input_prefix, barcode)
+
+def merge_sample(input_prefix, output_prefix, sample, barcodes, compression=None, threads=1, stats=None):
+    '''
+    Write output_prefix_sample.fastq and .csv from the files of the sample's barcodes, compressed as compression
+    says with threads threads each. Returns how: "link", "copy", "merge" or "compress".
+    '''
+    reads_output = "%s_%s.fastq%s" % (output_prefix, sample, extension(compression))
+    csv_output = "%s_%s.csv%s" % (output_prefix, sample, extension(compression))
+    inputs = [barcode_files(input_prefix, barcode) for barcode in barcodes]
+    if len(inputs) == 1 and not compression:
+        reads, csv_file = inputs[0]
+        how = link_or_copy(reads, reads_output)
+        link_or_copy(csv_file, csv_output)
+        return how
+
+    # the fastq copy mostly waits on the kernel or the compressor, so the csv merge runs alongside it
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        reads = executor.submit(concatenate, [reads for reads, csv_file in inputs], reads_output, threads, stats)
+        merge_csvs([csv_file for reads, csv_file in inputs], csv_output, threads, stats)
+        reads.result()
+    return "compress" if compression else "merge"
+
+def merge_samples(input_prefix, output_prefix, sample_dict, threads=4, compression=None, compression_threads=1,
+                  stats=None):
+    '''
+    Merge every sample of sample_dict, several at once. Returns {sample: how}.
+    '''
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = {sample: executor.submit(merge_sample, input_prefix, output_prefix, sample, sample_dict[sample],
+                                           compression, compression_threads, stats)
+                   for sample in sample_dict}
+        return {sample: futures[sample].result() for sample in futures}
+
+def sample_argument(value):
+    sample, separator, barcodes = value.rpartition(":")
+    if not sample or not barcodes:
+        raise argparse.ArgumentTypeError("expected SAMPLE:BARCODE[,BARCODE...], got %s" % value)
+    return sample, [barcode.strip() for barcode in barcodes.split(",") if barcode.strip()]
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m postbox.merge',
+                                     description='Merge per barcode fastq and csv files into per sample files')
+    parser.add_argument('--input_prefix', dest='input_prefix', required=True,
+                        help='Prefix of the per barcode files, PREFIX_BARCODE.fastq and PREFIX_BARCODE.csv')
+    parser.add_argument('--output_prefix', dest='output_prefix', required=True,
+                        help='Prefix of the per sample files written, PREFIX_SAMPLE.fastq and PREFIX_SAMPLE.csv')
+    parser.add_argument('--sample', dest='samples', action='append', type=sample_argument, required=True,
+                        help='A sample and its barcodes as SAMPLE:BARCODE[,BARCODE...]. Can be given more than once')
+    parser.add_argument('-t', '--threads', dest='threads', default=4, type=int,
+                        help='Number of samples merged at once')
+    parser.add_argument('--compression', dest='compression', default=None, choices=sorted(COMPRESSIONS),
+                        help='Compress the per sample files, adding .gz or .zst to their names')
+    parser.add_argument('--compression_threads', dest='compression_threads', default=1, type=int,
+                        help='Threads of each compressor')
+    parser.add_argument('--compression_stats', dest='compression_stats', default=None,
+                        help='File to record the space saved by compression in (see postbox.compression)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = get_arguments(argv)
+    sample_dict = dict(args.samples)
+    try:
+        merged = merge_samples(args.input_prefix, args.output_prefix, sample_dict, args.threads, args.compression,
+                               args.compression_threads, args.compression_stats)
+    except FileNotFoundError as e:
+        sys.exit("Error: %s" % e)
+    for sample in merged:
+        print("Merged %s from %s (%s)" % (sample, ", ".join(sample_dict[sample]), merged[sample]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+Iterative consensus polishing in one process: each round maps the reads to the current draft with minimap2,
+polishes it with racon, aligns the result to the reference with mafft and cleans it as clean.py does. Tool output
+is read from pipes where the next tool allows it, otherwise from a scratch directory on tmpfs that is reused every
+round and removed at the end; only the final draft and a manifest are written to the output directory.
+
+    python -m postbox.polish --reads Sabin1.fastq --reference Sabin1.fasta --name Sabin1 --rounds 4 \
+        --threads 4 --output polished.fasta --manifest manifest.json
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from postbox.alignment import Alignment, clean_consensus
+from postbox.postbox import Error
+from postbox.telemetry import write_atomic
+
+TMPFS = "/dev/shm"
+
+
+def scratch_directory(work_dir=None):
+    '''
+    Where to keep intermediate files: work_dir if given, else /dev/shm when it is writable, else the default
+    temporary directory.
+    '''
+    if work_dir is not None:
+        return work_dir
+    if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK):
+        return TMPFS
+    return tempfile.gettempdir()
+
+def run_tool(command, stdout=subprocess.PIPE):
+    '''
+    Run a tool and return its stdout as bytes (or None when written to a file).
+    '''
+    result = subprocess.run(command, stdout=stdout, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Error("%s failed with return code %d: %s" % (command[0], result.returncode,
+                                                            result.stderr.decode(errors="replace")[-2000:]))
+    return result.stdout
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def polish(reads, reference, name, rounds=4, threads=1, work_dir=None, tools=None, index=None):
+    '''
+    Run the polishing rounds and return the final cleaned fasta record (as text) and the manifest details of each
+    round. tools maps minimap2, racon and mafft to the executables to use. index is a minimap2 index of reference
+    for the first round, such as the reference store keeps (see postbox.references).
+    '''
+    tools = dict({"minimap2": "minimap2", "racon": "racon", "mafft": "mafft"}, **(tools or {}))
+    threads = str(threads)
+    with open(reference, "rb") as f:
+        reference_fasta = f.read()
+    if not reference_fasta.endswith(b"\n"):
+        reference_fasta += b"\n"
+
+    steps = []
+    with tempfile.TemporaryDirectory(prefix="postbox_polish_", dir=scratch_directory(work_dir)) as scratch:
+        # read once from the (possibly shared) filesystem, then from memory backed scratch every round
+        local_reads = os.path.join(scratch, "reads" + (".fastq.gz" if reads.endswith(".gz") else ".fastq"))
+        shutil.copyfile(reads, local_reads)
+        draft = os.path.join(scratch, "draft.fasta")
+        shutil.copyfile(reference, draft)
+        paf = os.path.join(scratch, "mapped.paf")
+        to_align = os.path.join(scratch, "to_align.fasta")
+
+        cleaned = None
+        for round_number in range(1, rounds + 1):
+            start = time.perf_counter()
+            target = index if index is not None and round_number == 1 else draft
+            with open(paf, "wb") as paf_file:
+                run_tool([tools["minimap2"], "-t", threads, "-x", "map-ont", target, local_reads], stdout=paf_file)
+            polished = run_tool([tools["racon"], "--no-trimming", "-t", threads, local_reads, paf, draft])
+            if not polished.strip():
+                raise Error("racon produced no consensus in round %d" % round_number)
+            write_file(to_align, reference_fasta + polished)
+            aligned = run_tool([tools["mafft"], "--thread", threads, to_align])
+
+            cleaned = clean_consensus(Alignment.from_text(aligned.decode(), "round %d" % round_number), name,
+                                      round_number)
+            write_file(draft, cleaned.encode())
+            steps.append({
+                "round": round_number,
+                "seconds": round(time.perf_counter() - start, 3),
+                "length": len(cleaned.split("\n", 1)[1].strip())
+            })
+    return cleaned, steps
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m postbox.polish',
+                                     description='Polish a draft consensus with repeated minimap2, racon, mafft and \
+                                                  clean rounds in one process')
+    parser.add_argument('--reads', dest='reads', required=True, help='Reads to polish with (fastq)')
+    parser.add_argument('--reference', dest='reference', required=True,
+                        help='Reference (fasta) used as the first draft and to align every round against')
+    parser.add_argument('--index', dest='index', default=None,
+                        help='minimap2 index of the reference, used instead of it for the first round')
+    parser.add_argument('--name', dest='name', required=True, help='Name of the consensus sequence')
+    parser.add_argument('--rounds', dest='rounds', default=4, type=int, help='Number of polishing rounds')
+    parser.add_argument('-t', '--threads', dest='threads', default=1, type=int)
+    parser.add_argument('--output', dest='output', required=True, help='Where to write the final draft (fasta)')
+    parser.add_argument('--manifest', dest='manifest', default=None, help='Where to write a JSON manifest')
+    parser.add_argument('--work_dir', dest='work_dir', default=None,
+                        help='Directory for intermediate files. Defaults to /dev/shm when available')
+    args = parser.parse_args(argv)
+    if args.rounds < 1:
+        parser.error("--rounds must be at least 1")
+    return args
+
+def main(argv=None):
+    args = get_arguments(argv)
+    start = time.time()
+    try:
+        cleaned, steps = polish(args.reads, args.reference, args.name, args.rounds, args.threads, args.work_dir,
+                                index=args.index)
+    except Error as e:
+        sys.exit("Error: %s" % e)
+
+    write_atomic(args.output, cleaned)
+    if args.manifest is not None:
+        manifest = {
+            "name": args.name,
+            "reads": args.reads,
+            "reference": args.reference,
+            "index": args.index,
+            "output": args.output,
+            "rounds": args.rounds,
+            "threads": args.threads,
+            "scratch": scratch_directory(args.work_dir),
+            "started": start,
+            "seconds": round(time.time() - start, 3),
+            "steps": steps
+        }
+        write_atomic(args.manifest, json.dumps(manifest, indent=2) + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -2,89 +2,244 @@
 
 import subprocess
 import argparse
+import contextlib
 import sys
 import os.path
 import json
-import pandas as pd
+import shlex
+import csv
+import time
+
+from postbox.pump import OutputPump, LEVELS
+from postbox.scheduler import run_fair_share
+from postbox.cache import cached_resolve_run
+from postbox.telemetry import RunTelemetry
+from postbox.incremental import sample_fingerprints, load_fingerprints, save_fingerprints, changed_samples, \
+    state_path
+from postbox.resources import available_memory_mb, rule_resources, resources_config_list
+from postbox.manifest import update_run_manifest, manifest_files
+from postbox.journal import RunLock, Journal, retry
 
 
 class Error (Exception): pass
 
-def get_arguments():
+class SnakemakeError (Error):
+    '''
+    Snakemake exited with an error. Unlike postbox's own errors (a bad config, a missing input) this may have been
+    a passing failure, so it is the one that is retried.
+    '''
+
+def comma_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def add_protocol_arguments(group):
+    group.add_argument('-p', '--protocol', dest='protocol', required=True,
+                       help='Path to RAMPART protocol directory')
+    group.add_argument('-q', '--pipeline', dest='pipeline', default=None,
+                       help='Name of pipeline to run. If there is only one pipeline \
+                       in the protocol directory, this parameter is optional')
+
+def add_run_configuration_arguments(group):
+    group.add_argument('-r', '--run_configuration', dest='run_configuration', default='run_configuration.json',
+                      help='Path to the run_configuration.json file relative to the run directory')
+    group.add_argument('-c', '--csv', dest='csv', default='barcodes.csv',
+                      help='Path to the CSV file containing a samples and barcodes column if this information is \
+                      not provided in the run_configuration.json file. Path should be relative to the run \
+                      directory. Updates the run_configuration information if both are provided')
+    group.add_argument('-i', '--basecalled_path', dest='basecalled_path', default=None,
+                       help='Path to the basecalled directory if this information is \
+                          not provided in the run_configuration.json file. Path should be relative to the run \
+                          directory. Updates the run_configuration information if both are provided')
+    group.add_argument('--fast5_path', dest='fast5_path', default=None,
+                       help='Path to the directory containing raw fast5 files. If this information is \
+                          not provided in the run_configuration.json file. Necessary if guppy demultiplexing is used\
+                          after a sequencing run with live basecalling enabled.')
+
+def add_sample_arguments(group):
+    group.add_argument('--samples', dest='samples', default=None, type=comma_list,
+                       help='Comma separated list of samples to process. Defaults to all samples')
+    group.add_argument('--barcodes', dest='barcodes', default=None, type=comma_list,
+                       help='Comma separated list of barcodes. Only samples using one of these are processed')
+    group.add_argument('--incremental', dest='incremental', action="store_true",
+                       help='Only process samples whose basecalled files changed since their last successful run')
+    group.add_argument('--single_run', dest='single_run', action="store_true",
+                       help='Run all samples in one snakemake even if the pipeline is marked run_per_sample')
+    group.add_argument('--max_samples', dest='max_samples', default=None, type=int,
+                       help='For run_per_sample pipelines, the maximum number of samples processed at once. \
+                       Defaults to one per thread; threads are shared evenly between running samples')
+
+def add_cache_arguments(group):
+    group.add_argument('--no_cache', dest='use_cache', action="store_false",
+                       help='Always re-read the protocol, run configuration and barcodes csv instead of reusing the \
+                       cached resolution from an earlier run with unchanged files, and let the pipeline read the \
+                       reference panel itself instead of from the cached reference store')
+    group.add_argument('--cache_dir', dest='cache_dir', default=None,
+                       help='Directory for cached run resolutions and reference stores. Defaults to \
+                       $POSTBOX_CACHE_DIR or ~/.cache/postbox')
+
+def add_resource_arguments(group):
+    group.add_argument('--memory_mb', dest='memory_mb', default=None, type=int,
+                       help='Memory in MB the pipeline may use, shared out between jobs through snakemake --resources \
+                       mem_mb. Defaults to the memory available when postbox starts')
+
+def add_manifest_arguments(group):
+    group.add_argument('--no_manifest', dest='use_manifest', action="store_false",
+                       help='Do not keep a manifest of the basecalled files, and let the pipeline scan the whole \
+                       basecalled directory itself')
+    group.add_argument('--scan_threads', dest='scan_threads', default=8, type=int,
+                       help='Threads used to scan the basecalled directory and count reads in new files')
+
+def add_compression_arguments(group):
+    group.add_argument('--compress', dest='compress', choices=['gzip', 'zstd'], default=None,
+                       help='Write the pipeline\'s large intermediate files (binned reads and reports, per reference \
+                       reads, mappings) compressed. Files the external tools read are always gzip')
+    group.add_argument('--compress_threads', dest='compress_threads', default=2, type=int,
+                       help='Threads of each compressor started with --compress')
+
+def add_journal_arguments(group, resume=True):
+    if resume:
+        group.add_argument('--resume', dest='resume', action="store_true",
+                           help='Carry on with the last run if it was interrupted, skipping the samples it had \
+                           finished according to the journal in the run directory')
+    group.add_argument('--attempts', dest='attempts', default=2, type=int,
+                       help='Times to try each snakemake run that exits with an error before giving up on it. Errors \
+                       found by postbox itself are not retried')
+    group.add_argument('--retry_backoff', dest='retry_backoff', default=30.0, type=float,
+                       help='Seconds to wait before the first retry, doubling for every further one')
+    group.add_argument('--lock_timeout', dest='lock_timeout', default=0.0, type=float,
+                       help='Seconds to wait for another postbox working on the same run directory to finish')
+
+def add_executor_arguments(group):
+    group.add_argument('--executor', dest='executor', choices=['local', 'pool', 'queue'], default='local',
+                       help='Run snakemake as child processes of postbox (default), in a pool of worker processes, \
+                       or as jobs in the queue given with --queue for postbox worker processes on other nodes to run')
+    group.add_argument('--workers', dest='workers', default=None, type=int,
+                       help='Worker processes of --executor pool. Defaults to one per thread')
+    group.add_argument('--queue', dest='queue', default=None,
+                       help='Job queue of --executor queue, on a filesystem shared with the worker nodes')
+    group.add_argument('--queue_poll_interval', dest='queue_poll_interval', default=5.0, type=float,
+                       help='Seconds between looks at the job queue for jobs that finished')
+
+def add_logging_arguments(parser, default_log_file=None, default_log_level='DEBUG'):
+    log_group = parser.add_argument_group('Logging options')
+    log_group.add_argument('--log_file', dest='log_file', default=default_log_file,
+                           help='Also write the snakemake output to this rotating log file. Path should be relative \
+                           to the run directory')
+    log_group.add_argument('--log_level', dest='log_level', choices=LEVELS, default=default_log_level,
+                           help='Only show snakemake output at or above this level on the console. The log file \
+                           always receives everything')
+    log_group.add_argument('--log_max_bytes', dest='log_max_bytes', default=50 * 1024 * 1024, type=int,
+                           help='Size at which the log file is rotated')
+
+def add_metrics_arguments(parser):
+    metrics_group = parser.add_argument_group('Metrics options')
+    metrics_group.add_argument('--metrics', dest='metrics', action="store_true",
+                               help='Record wall time, CPU time and peak RSS of every snakemake job in \
+                               postbox_metrics.json in the run directory (subprocess engine only)')
+    metrics_group.add_argument('--prometheus', dest='prometheus', action="store_true",
+                               help='With --metrics, also write per-rule totals to postbox_metrics.prom for the \
+                               node_exporter textfile collector')
+
+def resolve_run_paths(run_directory, run_configuration, csv, log_file=None):
     '''
-    Parse the command line arguments.
+    Make the run configuration, barcodes csv and log file paths absolute, relative to the run directory.
+    '''
+    # strip trailing / from paths
+    run_directory = run_directory.rstrip("/")
+
+    # dummy handle if the run_configuration or barcodes csv are given as absolute paths
+    if not run_directory.startswith("/"):
+        run_directory = os.path.abspath(run_directory)
+        print("Using run directory %s" %run_directory)
+
+    if not run_configuration.startswith("/"):
+        run_configuration = "%s/%s" % (run_directory, run_configuration)
+        print("Using run configuration %s" % run_configuration)
+
+    if not csv.startswith("/"):
+        csv = "%s/%s" % (run_directory, csv)
+        print("Using csv %s" % csv)
+
+    if log_file is not None and not log_file.startswith("/"):
+        log_file = "%s/%s" % (run_directory, log_file)
+
+    return run_directory, run_configuration, csv, log_file
+
+def get_arguments(argv=None, on_error=None):
+    '''
+    Parse the command line arguments. on_error(message), if given, is called instead of exiting on bad ones.
     '''
     parser = argparse.ArgumentParser(description='Parses CSV output by RAMPART and runs analysis step on all barcoded \
                                                   samples')
+    if on_error is not None:
+        parser.error = on_error
 
     main_group = parser.add_argument_group('Main options')
-    main_group.add_argument('-p', '--protocol', dest='protocol', required=True,
-                            help='Path to RAMPART protocol directory')
-    main_group.add_argument('-q', '--pipeline', dest='pipeline', default=None,
-                            help='Name of pipeline to run. If there is only one pipeline \
-                            in the protocol directory, this parameter is optional')
+    add_protocol_arguments(main_group)
 
     run_group = parser.add_argument_group('Run configuration options')
     run_group.add_argument('-d', '--run_directory', dest='run_directory', default='./',
                            help='Path to the directory for this run if it is not in current working directory')
-    run_group.add_argument('-r', '--run_configuration', dest='run_configuration', default='run_configuration.json',
-                          help='Path to the run_configuration.json file relative to the run directory')
-    run_group.add_argument('-c', '--csv', dest='csv', default='barcodes.csv',
-                          help='Path to the CSV file containing a samples and barcodes column if this information is \
-                          not provided in the run_configuration.json file. Path should be relative to the run \
-                          directory. Updates the run_configuration information if both are provided')
-    run_group.add_argument('-i', '--basecalled_path', dest='basecalled_path', default=None,
-                           help='Path to the basecalled directory if this information is \
-                              not provided in the run_configuration.json file. Path should be relative to the run \
-                              directory. Updates the run_configuration information if both are provided')
-    run_group.add_argument('--fast5_path', dest='fast5_path', default=None,
-                           help='Path to the directory containing raw fast5 files. If this information is \
-                              not provided in the run_configuration.json file. Necessary if guppy demultiplexing is used\
-                              after a sequencing run with live basecalling enabled.')
+    add_run_configuration_arguments(run_group)
     run_group.add_argument('-t', '--threads', dest='threads', default=1, type=int,
                           help='Number of cores to run snakemake with')
     run_group.add_argument('-n', '--dry_run', dest='dry_run', action="store_true",
                            help='Make this a snakemake dry run')
+    add_sample_arguments(run_group)
+    run_group.add_argument('--engine', dest='engine', choices=['subprocess', 'api'], default='subprocess',
+                           help='Run snakemake as a separate process (default) or in-process through its Python API, \
+                           which avoids paying interpreter and import startup on every invocation')
+    add_resource_arguments(run_group)
+    add_manifest_arguments(run_group)
+    add_compression_arguments(run_group)
+    add_journal_arguments(run_group)
+    add_cache_arguments(run_group)
+    add_executor_arguments(run_group)
+
+    add_logging_arguments(parser)
+    add_metrics_arguments(parser)
 
     run_group.add_argument('remainder', nargs=argparse.REMAINDER,
                           help='String of key=value pairs to override snakemake config parameters with')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    # strip trailing / from paths
     args.protocol = args.protocol.rstrip("/")
-    args.run_directory = args.run_directory.rstrip("/")
-
-    # dummy handle if the run_configuration or barcodes csv are given as absolute paths
-    if not args.run_directory.startswith("/"):
-        args.run_directory = os.path.abspath(args.run_directory)
-        print("Using run directory %s" %args.run_directory)
-
-    if not args.run_configuration.startswith("/"):
-        args.run_configuration = "%s/%s" % (args.run_directory, args.run_configuration)
-        print("Using run configuration %s" % args.run_configuration)
-
-    if not args.csv.startswith("/"):
-        args.csv = "%s/%s" % (args.run_directory, args.csv)
-        print("Using csv %s" % args.csv)
+    args.run_directory, args.run_configuration, args.csv, args.log_file = resolve_run_paths(
+        args.run_directory, args.run_configuration, args.csv, args.log_file)
+    if args.engine == "api" and args.executor == "queue":
+        parser.error("--engine api runs snakemake inside postbox, which the queue workers cannot do")
 
     return args
 
 
-def syscall(command, allow_fail=False):
-    print(command)
-
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                               universal_newlines=True)
-
-    # Poll process.stdout to show stdout live
-    while True:
-        output = process.stdout.readline().rstrip()
-        if process.poll() is not None:
-            break
-        if output:
-            print(output)
-    return_code = process.poll()
+def syscall(command, allow_fail=False, log_file=None, log_level="DEBUG", log_max_bytes=50 * 1024 * 1024, prefix="",
+            report=False, cwd=None, monitor=None, line_callback=None):
+    print(prefix + command)
+
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0,
+                               cwd=cwd)
+
+    # Stream process.stdout live until the child closes it, so the tail of the output is never lost
+    line_callbacks, tick_callbacks = [], []
+    if line_callback is not None:
+        line_callbacks.append(line_callback)
+    if monitor is not None:
+        monitor.start(process.pid)
+        line_callbacks.append(monitor.feed_line)
+        tick_callbacks.append(monitor.sample)
+    output_pump = OutputPump(log_file=log_file, log_level=log_level, max_bytes=log_max_bytes, prefix=prefix,
+                             line_callbacks=line_callbacks, tick_callbacks=tick_callbacks, tick_interval=0.5)
+    try:
+        output_pump.pump(process.stdout)
+    finally:
+        process.stdout.close()
+        return_code = process.wait()
+        if monitor is not None:
+            monitor.finish(return_code)
+        if report:
+            output_pump.report()
+        output_pump.close()
 
     if (not allow_fail) and return_code != 0:
         print('Error running this command:', command, file=sys.stderr)
@@ -92,6 +247,16 @@ def syscall(command, allow_fail=False):
         raise Error('Error in system call. Cannot continue')
     return process
 
+def pipeline_name_error(pipelines, pipeline_name, pipeline_json):
+    '''
+    Why pipeline_name (or None for the only one) does not pick a pipeline of pipelines.json, or None if it does.
+    '''
+    if pipeline_name is None and len(pipelines) != 1:
+        return "-q/--pipeline is needed to choose one of: %s" % ", ".join(sorted(pipelines))
+    if pipeline_name is not None and pipeline_name not in pipelines:
+        return "no pipeline %s in %s, choose one of: %s" % (pipeline_name, pipeline_json, ", ".join(sorted(pipelines)))
+    return None
+
 def find_pipeline(protocol_path, pipeline_name, pipeline_dict):
     if not os.path.exists(protocol_path):
         sys.exit(
@@ -106,11 +271,12 @@ def find_pipeline(protocol_path, pipeline_name, pipeline_dict):
 
     with open(pipeline_json) as json_file:
         pipelines = json.load(json_file)
-        assert pipeline_name is not None or len(pipelines) == 1
+        error = pipeline_name_error(pipelines, pipeline_name, pipeline_json)
+        if error is not None:
+            raise Error(error)
         if pipeline_name is None:
             pipeline_name = list(pipelines.keys())[0]
 
-        assert pipeline_name in pipelines
         pipeline_dict.update(pipelines[pipeline_name])
 
         if "path" in pipelines[pipeline_name]:
@@ -145,21 +311,28 @@ def load_run_configuration(run_configuration_path):
     return config, sample_dict
 
 def csv_to_sample_dict(csv_file):
-    csv = pd.read_csv(csv_file)
     sample_dict = {}
 
-    sample_column_names = [s for s in ['samples', 'sample', 'Samples', 'Sample', 'SAMPLES', 'SAMPLE'] if s in csv.columns.values]
-    barcode_column_names = [s for s in ['barcodes', 'barcode', 'Barcodes', 'Barcode', 'BARCODES', 'BARCODE'] if s in csv.columns.values]
-    if len(sample_column_names) < 1:
-        sys.exit("Error: barcodes CSV file does not have a column header for sample/samples")
-    if len(barcode_column_names) < 1:
-        sys.exit("Error: barcodes CSV file does not have a column header for barcode/barcodes")
-
-    for i,row in csv.iterrows():
-        sample, barcode = row[sample_column_names[0]], row[barcode_column_names[0]]
-        if sample not in sample_dict:
-            sample_dict[sample] = []
-        sample_dict[sample].append(barcode)
+    with open(csv_file, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+
+        sample_column_names = [s for s in ['samples', 'sample', 'Samples', 'Sample', 'SAMPLES', 'SAMPLE'] if s in header]
+        barcode_column_names = [s for s in ['barcodes', 'barcode', 'Barcodes', 'Barcode', 'BARCODES', 'BARCODE'] if s in header]
+        if len(sample_column_names) < 1:
+            sys.exit("Error: barcodes CSV file does not have a column header for sample/samples")
+        if len(barcode_column_names) < 1:
+            sys.exit("Error: barcodes CSV file does not have a column header for barcode/barcodes")
+        sample_index = header.index(sample_column_names[0])
+        barcode_index = header.index(barcode_column_names[0])
+
+        for row in reader:
+            if not row:
+                continue
+            sample, barcode = row[sample_index], row[barcode_index]
+            if sample not in sample_dict:
+                sample_dict[sample] = []
+            sample_dict[sample].append(barcode)
     #print(sample_dict)
     return sample_dict
 
@@ -218,14 +391,33 @@ def update_config_with_fast5_path(run_directory, config, fast5_path):
 
     return config
 
+def filter_sample_dict(sample_dict, samples=None, barcodes=None):
+    '''
+    Keep only the named samples, and/or the samples using any of the named barcodes (with all of their barcodes).
+    '''
+    if samples is not None:
+        missing = [sample for sample in samples if sample not in sample_dict]
+        if missing:
+            sys.exit('Error: samples %s not found in the sample to barcode map' % ", ".join(missing))
+        sample_dict = {sample: sample_dict[sample] for sample in sample_dict if sample in samples}
+
+    if barcodes is not None:
+        known = set(barcode for sample in sample_dict for barcode in sample_dict[sample])
+        missing = [barcode for barcode in barcodes if barcode not in known]
+        if missing:
+            sys.exit('Error: barcodes %s not found in the sample to barcode map' % ", ".join(missing))
+        sample_dict = {sample: sample_dict[sample] for sample in sample_dict
+                       if any(barcode in barcodes for barcode in sample_dict[sample])}
+
+    return sample_dict
+
 def sample_dict_to_dict_string(sample_dict):
     sample_strings = ["%s: [%s]" %(sample, ",".join(sample_dict[sample])) for sample in sample_dict]
     dict_string = "'{%s}'" %", ".join(sample_strings)
     #print(dict_string)
     return dict_string
 
-def generate_command(protocol, pipeline, run_directory, run_configuration, basecalled_path, fast5_path, csv, threads, remainder,
-                     dry_run=False):
+def resolve_run(protocol, pipeline, run_directory, run_configuration, basecalled_path, fast5_path, csv):
     pipeline_dict = {
         "path": None,
         "config": None,
@@ -240,11 +432,19 @@ def generate_command(protocol, pipeline, run_directory, run_configuration, basec
     config = update_config_with_fast5_path(run_directory, config, fast5_path)
     sample_dict = update_sample_dict_with_csv(csv, sample_dict)
 
+    return pipeline_dict, config, sample_dict
 
+def build_command(pipeline_dict, config, sample_dict, threads, remainder, dry_run=False, force=False,
+                  resources=None):
+    # postbox holds its own lock on the run directory (see journal.RunLock) while snakemake runs
     command_list = ['snakemake', '--snakefile', pipeline_dict["path"], "--cores", str(threads),
                     "--rerun-incomplete", "--nolock"]
+    if resources is not None and resources["mem_mb"] is not None:
+        command_list.extend(["--resources", "mem_mb=%d" % resources["mem_mb"]])
     if dry_run:
         command_list.append("--dry-run")
+    if force:
+        command_list.append("--forceall")
 
     if pipeline_dict["config_file"] is not None:
         command_list.extend(["--configfile", pipeline_dict["config_file"]])
@@ -254,18 +454,384 @@ def generate_command(protocol, pipeline, run_directory, run_configuration, basec
     command_list.extend(["basecalled_path=\"%s\"" % config["basecalledPath"]])
     if config["fast5Path"] is not None:
         command_list.extend(["fast5_path=\"%s\"" % config["fast5Path"]])
+    if config.get("inputManifest") is not None:
+        command_list.extend(["input_manifest=\"%s\"" % config["inputManifest"]])
+    command_list.extend(["%s=\"%s\"" % (key, value) for key, value in compression_config_list(config)])
+    if config.get("referenceStore") is not None:
+        command_list.extend(["reference_store=\"%s\"" % config["referenceStore"]])
+    if resources is not None:
+        command_list.extend(resources_config_list(resources))
     if pipeline_dict["config"] is not None:
         command_list.append(pipeline_dict["config"])
     command_list.extend(remainder)
     command = ' '.join(command_list)
     return command
 
+def build_config_list(pipeline_dict, config, sample_dict, remainder, resources=None):
+    '''
+    The --config key=value pairs of build_command as they look once the shell has removed the quoting, for
+    handing to snakemake directly.
+    '''
+    config_list = []
+    if sample_dict != {}:
+        config_list.append("samples=%s" % sample_dict_to_dict_string(sample_dict).strip("'"))
+    config_list.append("basecalled_path=%s" % config["basecalledPath"])
+    if config["fast5Path"] is not None:
+        config_list.append("fast5_path=%s" % config["fast5Path"])
+    if config.get("inputManifest") is not None:
+        config_list.append("input_manifest=%s" % config["inputManifest"])
+    config_list.extend("%s=%s" % (key, value) for key, value in compression_config_list(config))
+    if config.get("referenceStore") is not None:
+        config_list.append("reference_store=%s" % config["referenceStore"])
+    if resources is not None:
+        config_list.extend(resources_config_list(resources))
+    if pipeline_dict["config"] is not None:
+        config_list.extend(shlex.split(pipeline_dict["config"]))
+    config_list.extend(remainder)
+    return config_list
+
+def compression_config_list(config):
+    '''
+    The (key, value) config pairs telling the pipeline how to compress its intermediate files, if at all.
+    '''
+    if not config.get("compression"):
+        return []
+    pairs = [("compression", config["compression"]), ("compression_threads", config.get("compressionThreads", 1))]
+    if config.get("compressionStats") is not None:
+        pairs.append(("compression_stats", config["compressionStats"]))
+    return pairs
+
+def generate_command(protocol, pipeline, run_directory, run_configuration, basecalled_path, fast5_path, csv, threads, remainder,
+                     dry_run=False, compression=None):
+    pipeline_dict, config, sample_dict = resolve_run(protocol, pipeline, run_directory, run_configuration,
+                                                     basecalled_path, fast5_path, csv)
+    if compression is not None:
+        config["compression"] = compression
+    return build_command(pipeline_dict, config, sample_dict, threads, remainder, dry_run)
+
+def split_remainder_output_path(remainder, default="binned"):
+    '''
+    Pull any output_path=... override out of the remainder, returning it and the remaining key=value pairs.
+    '''
+    output_path = default
+    others = []
+    for item in remainder:
+        if item.startswith("output_path="):
+            output_path = item.split("=", 1)[1].rstrip("/")
+        else:
+            others.append(item)
+    return output_path, others
+
+def sample_log_file(log_file, sample):
+    if log_file is None:
+        return None
+    root, ext = os.path.splitext(log_file)
+    return "%s.%s%s" % (root, sample, ext)
+
+def use_per_sample(pipeline_dict, sample_dict, single_run=False):
+    return bool(pipeline_dict.get("run_per_sample")) and len(sample_dict) > 1 and not single_run
+
+def run_resources(args, threads, lanes, share=1.0):
+    '''
+    Thread and memory budgets for a snakemake run with threads cores, lanes samples run side by side and the given
+    share of the memory postbox may use.
+    '''
+    memory_mb = getattr(args, "memory_mb", None) or available_memory_mb()
+    return rule_resources(threads, lanes, memory_mb * share if memory_mb else None)
+
+def output_prefix(args, sample=None):
+    '''
+    The prefix of snakemake's output lines: the sample, and the run when several share the console as in batch.
+    '''
+    names = [name for name in [getattr(args, "run_name", None), sample] if name]
+    return "[%s] " % "/".join(names) if names else ""
+
+def run_pipeline(args, pipeline_dict, config, sample_dict, threads, remainder, sample=None, log_file=None,
+                 report=True, memory_share=1.0, attempt=1):
+    # samples picked by an incremental run have new reads, which snakemake cannot see as the binning rule has no
+    # inputs, so everything downstream is forced to rerun. Retries and resumed runs pick up where the last try
+    # stopped instead.
+    force = getattr(args, "incremental", False) and sample_dict != {} and attempt == 1 and \
+        not getattr(args, "resume", False)
+    resources = run_resources(args, threads, max(1, len(sample_dict)), memory_share)
+    prefix = output_prefix(args, sample)
+    from postbox.executors import Job
+    executor = job_executor(args)
+    command = build_command(pipeline_dict, config, sample_dict, threads, remainder, args.dry_run, force, resources)
+    # snakemake runs in the current directory unless told otherwise, as postbox serve does
+    job = Job(prefix.strip("[] ") or os.path.basename(getattr(args, "run_directory", "run")), command,
+              cwd=getattr(args, "cwd", None), cores=threads, mem_mb=resources["mem_mb"], log_file=log_file)
+    if args.engine == "api":
+        job.api = {"pipeline_dict": pipeline_dict, "threads": threads, "dry_run": args.dry_run, "force": force,
+                   "config_list": build_config_list(pipeline_dict, config, sample_dict, remainder, resources),
+                   "mem_mb": resources["mem_mb"], "workdir": job.cwd}
+        executor.run(job)
+    else:
+        telemetry = getattr(args, "telemetry", None)
+        monitor = telemetry.monitor(sample or "") if telemetry is not None else None
+        journal = getattr(args, "journal", None)
+        line_callback = journal.stage_recorder(sample) if journal is not None else None
+        executor.run(job, log_level=args.log_level, log_max_bytes=args.log_max_bytes, prefix=prefix, report=report,
+                     monitor=monitor, line_callback=line_callback)
+
+def job_executor(args):
+    '''
+    The executor main made for this run, or a local one for callers that did not make any.
+    '''
+    from postbox.executors import LocalExecutor
+    return getattr(args, "job_executor", None) or LocalExecutor()
+
+def run_with_retry(args, function, samples, prefix=""):
+    '''
+    Call function(attempt) as often as --attempts allows, journaling the outcome for each of samples.
+    '''
+    journal = getattr(args, "journal", None)
+
+    def failed(attempt, exception):
+        if journal is not None:
+            for sample in samples:
+                journal.record("sample_failure", sample=sample, attempt=attempt, error=str(exception))
+
+    result = retry(function, getattr(args, "attempts", 1), getattr(args, "retry_backoff", 0.0), failed, prefix,
+                   retry_on=SnakemakeError)
+    if journal is not None:
+        for sample in samples:
+            journal.record("sample_success", sample=sample)
+    return result
+
+def run_sample(args, pipeline_dict, config, sample_dict, sample, cores):
+    '''
+    Run the pipeline on a single sample, writing to its own directory under the output path.
+    '''
+    output_path, remainder = split_remainder_output_path(args.remainder)
+    sample_remainder = remainder + ["output_path=%s/%s" % (output_path, sample)]
+    prefix = output_prefix(args, sample)
+
+    def attempt(number):
+        # samples running side by side get memory in proportion to their cores
+        run_pipeline(args, pipeline_dict, config, {sample: sample_dict[sample]}, cores, sample_remainder,
+                     sample=sample, log_file=sample_log_file(args.log_file, sample), report=False,
+                     memory_share=min(1.0, cores / max(1, args.threads)), attempt=number)
+
+    run_with_retry(args, attempt, [sample], prefix)
+
+def run_per_sample(args, pipeline_dict, config, sample_dict, on_sample_success=None):
+    '''
+    Run the pipeline once per sample, each with its own output path, sharing the --threads budget. Snakemake is not
+    safe to run concurrently in one process, so the api engine runs samples one after another unless they run in
+    a pool of worker processes.
+    '''
+    def make_job(sample):
+        def job(cores):
+            run_sample(args, pipeline_dict, config, sample_dict, sample, cores)
+            if on_sample_success is not None:
+                on_sample_success(sample)
+        return job
+
+    jobs = [(sample, make_job(sample)) for sample in sample_dict]
+    max_concurrent = args.max_samples
+    if args.engine == "api" and not job_executor(args).concurrent_api:
+        max_concurrent = 1
+    results = run_fair_share(jobs, args.threads, max_concurrent)
+
+    failed = []
+    for sample, result, exception in results:
+        if exception is not None:
+            print("Sample %s failed: %s" % (sample, exception), file=sys.stderr)
+            failed.append(sample)
+    if failed:
+        raise Error('%d of %d samples failed: %s' % (len(failed), len(sample_dict), ", ".join(failed)))
+
+def prepare_manifest(args, run_directory, config, sample_dict):
+    '''
+    Bring the run's manifest of basecalled files up to date and point the pipeline at it, so that it only reads
+    the files of the selected barcodes. Returns the files as scan_fastq does, or None without a manifest.
+    '''
+    if not getattr(args, "use_manifest", False) or sample_dict == {}:
+        return None
+    barcodes = [barcode for sample in sample_dict for barcode in sample_dict[sample]]
+    path, entries = update_run_manifest(run_directory, config["basecalledPath"], args.scan_threads, barcodes)
+    config["inputManifest"] = path
+    return manifest_files(config["basecalledPath"], entries)
+
+def prepare_compression(args, run_directory, config):
+    '''
+    Tell the pipeline to compress its intermediate files if --compress is given, recording the space saved in the
+    run's state directory.
+    '''
+    if not getattr(args, "compress", None):
+        return
+    from postbox.compression import STATS_FILE
+    config["compression"] = args.compress
+    config["compressionThreads"] = args.compress_threads
+    config["compressionStats"] = os.path.abspath(state_path(run_directory, STATS_FILE))
+
+def prepare_references(args, pipeline_dict, config):
+    '''
+    Point the pipeline at the reference store of the panel it requires, building the store if this panel has not
+    been seen before. Turned off with --no_cache.
+    '''
+    if not getattr(args, "use_cache", True):
+        return
+    from postbox.references import reference_store, required_panel
+    panel = required_panel(args.protocol, pipeline_dict)
+    if panel is None:
+        return
+    config["referenceStore"] = reference_store(panel, args.cache_dir, getattr(args, "threads", 1))
+
+def report_compression(config, since=None):
+    '''
+    Print the space compression saved and its CPU time per stage, for files written after since.
+    '''
+    if not config.get("compressionStats"):
+        return
+    from postbox.compression import summarise_stats, format_summary
+    summary = summarise_stats(config["compressionStats"], since)
+    if summary:
+        print("Compressed intermediate files (%s):\n%s" % (config["compression"], format_summary(summary)))
+
+@contextlib.contextmanager
+def run_lock(run_directory, dry_run=False, timeout=0.0, work_directory=None):
+    '''
+    The locks on a run directory and on the directory snakemake works in, if that is another one, or nothing for
+    dry runs, which leave both alone. Runs started from one directory all write their outputs there.
+    '''
+    if dry_run:
+        yield
+        return
+    directories = set([os.path.realpath(run_directory)])
+    if work_directory is not None:
+        directories.add(os.path.realpath(work_directory))
+    with contextlib.ExitStack() as stack:
+        # always taken in the same order, so that two postboxes each waiting for the other's cannot happen
+        for directory in sorted(directories):
+            stack.enter_context(RunLock(directory, timeout))
+        yield
+
+def write_metrics(telemetry, run_directory, prometheus=False):
+    telemetry.write_json("%s/postbox_metrics.json" % run_directory)
+    print("Wrote job metrics to %s/postbox_metrics.json" % run_directory)
+    if prometheus:
+        telemetry.write_prometheus("%s/postbox_metrics.prom" % run_directory)
+
+def run_locked(args, pipeline_dict, config, sample_dict):
+    '''
+    Everything main does once it holds the run directory: resume, incremental selection, running and journaling.
+    '''
+    journal = Journal(args.run_directory)
+    # dry runs show what a run would do without recording anything
+    args.journal = None if args.dry_run else journal
+    if args.resume:
+        completed = journal.completed_samples()
+        if completed is None:
+            print("%sNo interrupted run to resume, starting a new one" % output_prefix(args))
+            args.resume = False
+        else:
+            print("%sResuming the last run: %d of %d samples already finished" % (
+                output_prefix(args), len([sample for sample in sample_dict if sample in completed]), len(sample_dict)))
+            sample_dict = {sample: sample_dict[sample] for sample in sample_dict if sample not in completed}
+            if sample_dict == {}:
+                if args.journal is not None:
+                    args.journal.record("run_end", status="success")
+                return
+
+    files = prepare_manifest(args, args.run_directory, config, sample_dict)
+    prepare_compression(args, args.run_directory, config)
+    prepare_references(args, pipeline_dict, config)
+    start = time.time()
+
+    fingerprints = {}
+    if args.incremental and sample_dict != {}:
+        fingerprints = sample_fingerprints(config["basecalledPath"], sample_dict, files)
+        changed = changed_samples(fingerprints, load_fingerprints(args.run_directory))
+        print("%sIncremental run: %d of %d samples have changed inputs" % (output_prefix(args), len(changed),
+                                                                          len(sample_dict)))
+        if not changed:
+            return
+        sample_dict = {sample: sample_dict[sample] for sample in changed}
+
+    def record_success(*samples):
+        if args.incremental and not args.dry_run:
+            save_fingerprints(args.run_directory, {sample: fingerprints[sample] for sample in samples})
+
+    if args.journal is not None:
+        args.journal.record("run_resume" if args.resume else "run_start", samples=sorted(sample_dict),
+                            pipeline=pipeline_dict["path"])
+    status = "failed"
+    try:
+        if args.per_sample:
+            run_per_sample(args, pipeline_dict, config, sample_dict, on_sample_success=record_success)
+        else:
+            def attempt(number):
+                run_pipeline(args, pipeline_dict, config, sample_dict, args.threads, args.remainder,
+                             log_file=args.log_file, attempt=number)
+
+            run_with_retry(args, attempt, list(sample_dict), output_prefix(args))
+            record_success(*sample_dict)
+        status = "success"
+    finally:
+        # a run that is killed never gets here, which is what --resume looks for
+        if args.journal is not None:
+            args.journal.record("run_end", status=status)
+        if not args.dry_run:
+            report_compression(config, start)
+        if args.telemetry is not None:
+            write_metrics(args.telemetry, args.run_directory, args.prometheus)
+
+def run_resolved(args, pipeline_dict, config, sample_dict, executor=None):
+    '''
+    Run a resolved run as main does, with executor if given (which is left open) or else the one --executor
+    names. Dry runs are always local.
+    '''
+    # the output layout is decided by the whole run, so that processing one of its samples (--samples,
+    # --incremental, --resume) writes where a run of all of them would
+    args.per_sample = use_per_sample(pipeline_dict, sample_dict, args.single_run)
+    sample_dict = filter_sample_dict(sample_dict, args.samples, args.barcodes)
+
+    args.telemetry = None
+    if args.metrics and args.engine == "subprocess":
+        if args.executor == "local":
+            args.telemetry = RunTelemetry()
+        else:
+            print("Warning: --metrics only follows snakemake run by the local executor", file=sys.stderr)
+
+    from postbox.executors import make_executor
+    own_executor = executor is None or args.dry_run
+    args.job_executor = make_executor(args) if own_executor else executor
+    try:
+        work_directory = getattr(args, "cwd", None) or os.getcwd()
+        with run_lock(args.run_directory, args.dry_run, args.lock_timeout, work_directory):
+            run_locked(args, pipeline_dict, config, sample_dict)
+    finally:
+        if own_executor:
+            args.job_executor.close()
+
+SUBCOMMANDS = {
+    "batch": "postbox.batch",
+    "watch": "postbox.watch",
+    "check": "postbox.check",
+    "worker": "postbox.executors",
+    "serve": "postbox.serve",
+}
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        import importlib
+        subcommand = importlib.import_module(SUBCOMMANDS[sys.argv[1]])
+        return subcommand.main(sys.argv[2:])
+
     args = get_arguments()
 
-    command = generate_command(args.protocol, args.pipeline, args.run_directory, args.run_configuration,
-                               args.basecalled_path, args.fast5_path, args.csv, args.threads, args.remainder, args.dry_run)
-    syscall(command)
+    try:
+        pipeline_dict, config, sample_dict = cached_resolve_run(args.protocol, args.pipeline, args.run_directory,
+                                                                args.run_configuration, args.basecalled_path,
+                                                                args.fast5_path, args.csv, cache_dir=args.cache_dir,
+                                                                use_cache=args.use_cache)
+    except Error as e:
+        sys.exit("Error: %s" % e)
+    run_resolved(args, pipeline_dict, config, sample_dict)
 
 if __name__ == '__main__':
-    main()
+    # through the module postbox's other modules import, so that there is only one Error class to catch
+    from postbox.postbox import main as package_main
+    package_main()
@@ -0,0 +1,151 @@
+import os
+import selectors
+import sys
+import time
+
+LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+# the logging module's numeric levels, so that it only needs importing when a log file is written
+LEVEL_NUMBERS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+
+def classify_line(line):
+    '''
+    Assign a log level to a line of snakemake (or tool) output. Indented lines are the details snakemake prints
+    under each job (input, output, jobid, wildcards...).
+    '''
+    if "Error" in line or "Exception" in line or line.startswith("Traceback"):
+        return "ERROR"
+    if "Warning" in line or "WARNING" in line:
+        return "WARNING"
+    if line.startswith((" ", "\t")):
+        return "DEBUG"
+    return "INFO"
+
+def open_rotating_log(log_file, max_bytes=50 * 1024 * 1024, backup_count=3):
+    import logging
+    import logging.handlers
+
+    logger = logging.getLogger("postbox.pump.%s" % os.path.abspath(log_file))
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+class OutputPump:
+    '''
+    Streams the output of a child process to the console and optionally to a rotating log file.
+
+    The pipe is read in fixed size chunks with a selector, so memory is bounded by chunk_size plus at most
+    max_line_length of an unterminated line, and reading continues until EOF so nothing is dropped when the child
+    exits. Only lines at or above log_level reach the console; the log file receives every line.
+    '''
+    def __init__(self, console=None, log_file=None, log_level="DEBUG", prefix="", max_bytes=50 * 1024 * 1024,
+                 backup_count=3, chunk_size=64 * 1024, max_line_length=64 * 1024, line_callbacks=None,
+                 tick_callbacks=None, tick_interval=1.0):
+        if log_level not in LEVELS:
+            raise ValueError("log_level must be one of %s" % ", ".join(LEVELS))
+        self.console = console
+        self.log_level = LEVELS.index(log_level)
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.max_line_length = max_line_length
+        self.line_callbacks = line_callbacks or []
+        self.tick_callbacks = tick_callbacks or []
+        self.tick_interval = tick_interval
+        self.logger = None
+        if log_file is not None:
+            self.logger = open_rotating_log(log_file, max_bytes, backup_count)
+
+        self.bytes = 0
+        self.lines = 0
+        self.start = None
+        self.end = None
+
+    def handle_lines(self, lines):
+        console_lines = []
+        for line in lines:
+            line = line.rstrip("\r")
+            self.lines += 1
+            level = classify_line(line)
+            for callback in self.line_callbacks:
+                callback(line)
+            if self.logger is not None:
+                self.logger.log(LEVEL_NUMBERS[level], line)
+            if line and LEVELS.index(level) >= self.log_level:
+                console_lines.append(self.prefix + line)
+        if console_lines:
+            console = self.console if self.console is not None else sys.stdout
+            console.write("\n".join(console_lines) + "\n")
+            console.flush()
+
+    def pump(self, stream):
+        '''
+        Read stream until EOF.
+        '''
+        self.start = time.perf_counter()
+        fd = stream.fileno()
+        os.set_blocking(fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(fd, selectors.EVENT_READ)
+
+        pending = b""
+        last_tick = self.start
+        try:
+            while True:
+                events = selector.select(timeout=self.tick_interval)
+                now = time.perf_counter()
+                if now - last_tick >= self.tick_interval:
+                    for callback in self.tick_callbacks:
+                        callback()
+                    last_tick = now
+                if not events:
+                    continue
+                try:
+                    chunk = os.read(fd, self.chunk_size)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    break
+                self.bytes += len(chunk)
+                pending += chunk
+                *complete, pending = pending.split(b"\n")
+                if len(pending) > self.max_line_length:
+                    complete.append(pending)
+                    pending = b""
+                if complete:
+                    self.handle_lines([line.decode("utf-8", errors="replace") for line in complete])
+            if pending:
+                self.handle_lines([pending.decode("utf-8", errors="replace")])
+        finally:
+            selector.close()
+            self.end = time.perf_counter()
+
+    def stats(self):
+        elapsed = (self.end or time.perf_counter()) - (self.start or time.perf_counter())
+        return {
+            "bytes": self.bytes,
+            "lines": self.lines,
+            "seconds": elapsed,
+            "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "lines_per_second": self.lines / elapsed if elapsed > 0 else 0.0
+        }
+
+    def report(self, file=None):
+        stats = self.stats()
+        message = "Output pump: %d lines, %d bytes in %.2fs (%.0f lines/s, %.0f bytes/s)" % (
+            stats["lines"], stats["bytes"], stats["seconds"], stats["lines_per_second"], stats["bytes_per_second"])
+        if self.logger is not None:
+            self.logger.info(message)
+        print(message, file=file if file is not None else sys.stderr)
+        return stats
+
+    def close(self):
+        if self.logger is not None:
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+                handler.close()
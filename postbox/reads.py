@@ -0,0 +1,167 @@
+import hashlib
+import os
+from array import array
+
+INDEX_EXTENSION = ".idx"
+
+
+def read_name(header):
+    '''
+    The read name of a fastq header line, i.e. what Biopython calls the record id.
+    '''
+    return header[1:].split(None, 1)[0].decode() if len(header) > 1 else ""
+
+def fastq_records(handle):
+    '''
+    Yield (name, offset, record) for each record of a binary fastq handle, where record is the raw four lines as
+    bytes. Records are not parsed beyond their name, so they can be copied out unchanged.
+    '''
+    try:
+        offset = handle.tell()
+    except OSError:
+        # a pipe from a decompressor, read from its start
+        offset = 0
+    while True:
+        header = handle.readline()
+        if not header:
+            return
+        if header.strip() == b"":
+            offset += len(header)
+            continue
+        if not header.startswith(b"@"):
+            raise ValueError("Expected a fastq record at byte %d, got %r" % (offset, header[:50]))
+        record = header + handle.readline() + handle.readline() + handle.readline()
+        yield read_name(header), offset, record
+        offset += len(record)
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+class ReadBins:
+    '''
+    A compact map of read name to bin for runs with millions of reads. Names are kept as 8 byte hashes in an array
+    per bin rather than as strings (about a tenth of the memory), so two names would have to share a 64 bit hash to
+    be confused. Bins are looked up with get, like a dict, once all names are added.
+    '''
+    def __init__(self):
+        self.hashes = {}
+        self.lookup = None
+
+    def add(self, name, bin_name):
+        if bin_name not in self.hashes:
+            self.hashes[bin_name] = array("Q")
+        self.hashes[bin_name].append(name_hash(name))
+        self.lookup = None
+
+    def select(self, bin_names):
+        '''
+        Forget the reads of all bins but bin_names.
+        '''
+        self.hashes = {bin_name: self.hashes[bin_name] for bin_name in bin_names if bin_name in self.hashes}
+        self.lookup = None
+
+    def counts(self):
+        return {bin_name: len(hashes) for bin_name, hashes in self.hashes.items()}
+
+    def build_lookup(self):
+        import numpy
+        bin_names = list(self.hashes)
+        hashes = numpy.zeros(0, dtype=numpy.uint64)
+        bins = numpy.zeros(0, dtype=numpy.uint32)
+        if bin_names:
+            hashes = numpy.concatenate([numpy.frombuffer(self.hashes[bin_name], dtype=numpy.uint64)
+                                        for bin_name in bin_names])
+            bins = numpy.concatenate([numpy.full(len(self.hashes[bin_name]), index, dtype=numpy.uint32)
+                                      for index, bin_name in enumerate(bin_names)])
+        order = numpy.argsort(hashes, kind="stable")
+        self.lookup = (hashes[order], bins[order], bin_names)
+
+    def get(self, name, default=None):
+        if self.lookup is None:
+            self.build_lookup()
+        hashes, bins, bin_names = self.lookup
+        key = name_hash(name)
+        position = int(hashes.searchsorted(key))
+        if position < len(hashes) and int(hashes[position]) == key:
+            return bin_names[bins[position]]
+        return default
+
+def check_indexable(reads_path):
+    from postbox.compression import compression_of
+    if compression_of(reads_path) is not None:
+        # the offsets of a decompressed stream cannot be seeked to in the compressed file
+        raise ValueError("Cannot index %s: reads can only be fetched by offset from an uncompressed fastq" % reads_path)
+
+def split_reads(reads_path, read_bins, output_paths, buffer_size=1024 * 1024, index_path=None, threads=1,
+                stats=None):
+    '''
+    Write every read of reads_path whose name is in read_bins to the fastq of its bin, in one pass over the file.
+    read_bins maps read names to bins (a dict or ReadBins) and output_paths bins to files. Returns the number of
+    reads written per bin. If index_path is given, the byte offset of every record is saved there as well (see load_read_index).
+    Compressed files are read and written by their extension (see postbox.compression), but compressed reads cannot
+    be indexed.
+    '''
+    from postbox.compression import open_file
+    if index_path is not None:
+        check_indexable(reads_path)
+    writers = {}
+    counts = dict.fromkeys(output_paths, 0)
+    index = None
+    try:
+        for bin_name, path in output_paths.items():
+            writers[bin_name] = open_file(path, "wb", threads=threads, stage="split_reads", stats=stats,
+                                          buffering=buffer_size)
+        if index_path is not None:
+            index = open(index_path + ".tmp", "w", buffering=buffer_size)
+        with open_file(reads_path, "rb", buffering=buffer_size) as f:
+            for name, offset, record in fastq_records(f):
+                if index is not None:
+                    index.write("%s\t%d\t%d\n" % (name, offset, len(record)))
+                bin_name = read_bins.get(name)
+                if bin_name in writers:
+                    writers[bin_name].write(record)
+                    counts[bin_name] += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if index is not None:
+            index.close()
+    if index is not None:
+        os.replace(index_path + ".tmp", index_path)
+    return counts
+
+def write_read_index(reads_path, index_path=None):
+    '''
+    Save the byte offset and length of every record of a fastq, by default next to it as <reads>.idx.
+    '''
+    index_path = index_path or reads_path + INDEX_EXTENSION
+    split_reads(reads_path, {}, {}, index_path=index_path)
+    return index_path
+
+def load_read_index(index_path):
+    '''
+    Read an index written by split_reads or write_read_index into a dict of name to (offset, length).
+    '''
+    index = {}
+    with open(index_path) as f:
+        for line in f:
+            name, offset, length = line.rstrip("\n").split("\t")
+            index[name] = (int(offset), int(length))
+    return index
+
+def fetch_reads(reads_path, index, names, output):
+    '''
+    Copy the records of the named reads from reads_path, an uncompressed fastq, to the binary handle output by
+    seeking straight to them. Names missing from the index are returned.
+    '''
+    check_indexable(reads_path)
+    missing = []
+    with open(reads_path, "rb") as f:
+        for name in names:
+            if name not in index:
+                missing.append(name)
+                continue
+            offset, length = index[name]
+            f.seek(offset)
+            output.write(f.read(length))
+    return missing
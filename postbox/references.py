@@ -0,0 +1,245 @@
+'''
+A cache of the reference panels pipelines require (references.fasta in pipelines.json's requires), built once per
+panel content rather than parsed again by every sample of every run. A store lives in the postbox cache directory
+under references/<sha256 of the panel>/:
+
+    references.fasta      the panel with every sequence on one line
+    references.fasta.fai  its samtools faidx index, for reading any one sequence without parsing the rest
+    references.json       ids, display names and descriptions in panel order, and the minimap2 version used
+    references.mmi        minimap2 index of the whole panel
+    targets/<id>.mmi      minimap2 index of each sequence named by its display name, as parse_ref_and_depth.py
+                          names the reference of each analysis stem, so the first mapping round can use it
+
+The minimap2 indexes are only there if minimap2 was on the PATH when the store was built, and are rebuilt when
+its version changes.
+'''
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+from urllib.parse import quote
+
+from postbox.cache import default_cache_dir
+
+STORE_VERSION = 1
+STORE_NAMESPACE = "references"
+FASTA_FILE = "references.fasta"
+METADATA_FILE = "references.json"
+PANEL_INDEX = "references.mmi"
+MINIMAP2_PRESET = "map-ont"
+
+# stores this process has already found, by panel path, modification time and size and by the minimap2 on the PATH,
+# so that a long running postbox (postbox serve) does not hash the panel again for every run
+known_stores = {}
+# runs of one postbox (batch, serve) building a store at once take turns, as their temporary files share a pid
+store_lock = threading.Lock()
+
+
+def fasta_digest(path):
+    digest = hashlib.sha256(b"postbox reference store %d\n" % STORE_VERSION)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_panel(path):
+    '''
+    (id, description, sequence) of every record of a fasta, with the description being the rest of the header.
+    '''
+    records = []
+    with open(path) as f:
+        title, parts = None, []
+        for line in f:
+            if line.startswith(">"):
+                if title is not None:
+                    records.append((title, parts))
+                title, parts = line[1:].strip(), []
+            elif title is not None:
+                parts.append(line.strip().replace(" ", ""))
+        if title is not None:
+            records.append((title, parts))
+    panel = []
+    for title, parts in records:
+        fields = title.split(None, 1)
+        panel.append((fields[0] if fields else "", fields[1] if len(fields) > 1 else "", "".join(parts)))
+    return panel
+
+def display_name(record_id, description):
+    for field in description.split():
+        if field.startswith("display_name="):
+            return field.split("=", 1)[1]
+    return record_id
+
+def target_path(directory, record_id):
+    # ids are used as file names, which they may not all be fit for as they are
+    return os.path.join(directory, "targets", quote(record_id, safe=""))
+
+def minimap2_version():
+    if shutil.which("minimap2") is None:
+        return None
+    try:
+        process = subprocess.run(["minimap2", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 universal_newlines=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return process.stdout.strip() if process.returncode == 0 and process.stdout.strip() else None
+
+def build_index(fasta, index, threads=1):
+    '''
+    Write a minimap2 index of fasta to index. Returns whether minimap2 made one.
+    '''
+    tmp_path = "%s.%d.tmp" % (index, os.getpid())
+    process = subprocess.run(["minimap2", "-x", MINIMAP2_PRESET, "-t", str(threads), "-d", tmp_path, fasta],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if process.returncode != 0 or not os.path.exists(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, index)
+    return True
+
+def write_store(directory, panel, source):
+    '''
+    Write the fasta, its .fai and the metadata of a store to directory.
+    '''
+    os.makedirs(os.path.join(directory, "targets"))
+    offset = 0
+    with open(os.path.join(directory, FASTA_FILE), "w") as fasta, \
+            open(os.path.join(directory, FASTA_FILE + ".fai"), "w") as fai:
+        for record_id, description, sequence in panel:
+            header = ">%s\n" % " ".join(field for field in [record_id, description] if field)
+            fasta.write(header + sequence + "\n")
+            offset += len(header.encode())
+            fai.write("%s\t%d\t%d\t%d\t%d\n" % (record_id, len(sequence), offset, len(sequence), len(sequence) + 1))
+            offset += len(sequence) + 1
+    metadata = {"source": os.path.abspath(source), "ids": [record_id for record_id, description, sequence in panel],
+                "descriptions": {record_id: description for record_id, description, sequence in panel},
+                "display_names": {record_id: display_name(record_id, description)
+                                  for record_id, description, sequence in panel},
+                "minimap2": None}
+    with open(os.path.join(directory, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=1)
+
+def index_store(directory, threads=1):
+    '''
+    Build the minimap2 indexes of a store unless they were built with the minimap2 now on the PATH.
+    '''
+    store = ReferenceStore(directory)
+    version = minimap2_version()
+    if version is None or store.metadata["minimap2"] == version:
+        return
+    build_index(os.path.join(directory, FASTA_FILE), os.path.join(directory, PANEL_INDEX), threads)
+    for record_id in store.ids():
+        target = target_path(directory, record_id)
+        # runs indexing the same store at once each write their own sequence file
+        tmp_fasta = "%s.%d.fasta.tmp" % (target, os.getpid())
+        with open(tmp_fasta, "w") as f:
+            f.write(">%s\n%s\n" % (store.display_name(record_id), store.sequence(record_id)))
+        build_index(tmp_fasta, target + ".mmi", threads)
+        os.remove(tmp_fasta)
+    store.metadata["minimap2"] = version
+    tmp_path = "%s.%d.tmp" % (store.metadata_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(store.metadata, f, indent=1)
+    os.replace(tmp_path, store.metadata_path)
+
+def reference_store(fasta, cache_dir=None, threads=1):
+    '''
+    The directory of the store of the panel in fasta, building it the first time the panel is seen. Stores are
+    written to a temporary directory and renamed into place, so runs building the same one at once both end up
+    with a complete store.
+    '''
+    stat = os.stat(fasta)
+    minimap2 = shutil.which("minimap2")
+    known = (os.path.abspath(fasta), stat.st_mtime_ns, stat.st_size, cache_dir, minimap2,
+             os.stat(minimap2).st_mtime_ns if minimap2 else None)
+    if known in known_stores and os.path.exists(os.path.join(known_stores[known], METADATA_FILE)):
+        return known_stores[known]
+    directory = os.path.join(cache_dir or default_cache_dir(), STORE_NAMESPACE, fasta_digest(fasta))
+    with store_lock:
+        if not os.path.exists(os.path.join(directory, METADATA_FILE)):
+            tmp_directory = "%s.%d.tmp" % (directory, os.getpid())
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            write_store(tmp_directory, parse_panel(fasta), fasta)
+            try:
+                os.rename(tmp_directory, directory)
+            except OSError:
+                # another postbox got there first
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+        index_store(directory, threads)
+        known_stores[known] = directory
+    return directory
+
+class ReferenceStore:
+    '''
+    Read access to a store written by reference_store: the panel's ids and display names, and any sequence by id
+    through the .fai index.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.metadata_path = os.path.join(directory, METADATA_FILE)
+        with open(self.metadata_path) as f:
+            self.metadata = json.load(f)
+        self.fasta = os.path.join(directory, FASTA_FILE)
+        self.offsets = {}
+        with open(self.fasta + ".fai") as f:
+            for line in f:
+                name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")
+                self.offsets[name] = (int(offset), int(length))
+
+    def ids(self):
+        return list(self.metadata["ids"])
+
+    def display_name(self, record_id):
+        return self.metadata["display_names"][record_id]
+
+    def display_names(self):
+        '''
+        The distinct display names of the panel, in the order they first appear.
+        '''
+        names = []
+        for record_id in self.metadata["ids"]:
+            if self.display_name(record_id) not in names:
+                names.append(self.display_name(record_id))
+        return names
+
+    def sequence(self, record_id):
+        offset, length = self.offsets[record_id]
+        with open(self.fasta, "rb") as f:
+            f.seek(offset)
+            return f.read(length).decode()
+
+    def panel_index(self):
+        path = os.path.join(self.directory, PANEL_INDEX)
+        return path if os.path.exists(path) else None
+
+    def target_index(self, record_id):
+        '''
+        The minimap2 index of one sequence, named by its display name, or None if the store has none.
+        '''
+        path = target_path(self.directory, record_id) + ".mmi"
+        return path if os.path.exists(path) else None
+
+    def link_target_index(self, record_id, path):
+        '''
+        Link path to the index of one sequence, if there is one. Returns whether it did.
+        '''
+        index = self.target_index(record_id)
+        if index is None:
+            return False
+        if os.path.lexists(path):
+            os.remove(path)
+        os.symlink(index, path)
+        return True
+
+def required_panel(protocol, pipeline_dict):
+    '''
+    The path of the first fasta in the pipeline's requires entries, or None.
+    '''
+    for requirement in pipeline_dict.get("requires", []):
+        path = os.path.join(protocol, "rampart", requirement.get("file", ""))
+        if requirement.get("file", "").endswith((".fasta", ".fa", ".fna")) and os.path.isfile(path):
+            return path
+    return None
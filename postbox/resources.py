@@ -0,0 +1,56 @@
+import os
+
+# tool: (threads beyond which it stops getting faster on amplicon sized references, memory MB per job, per thread)
+TOOL_PROFILES = {
+    "minimap2": (8, 500, 100),
+    "racon": (8, 500, 200),
+    "mafft": (4, 200, 50),
+    "medaka": (4, 4000, 500)
+}
+# leave some memory for snakemake, postbox and the rest of the node
+MEMORY_FRACTION = 0.9
+
+
+def available_memory_mb():
+    '''
+    MemAvailable from /proc/meminfo, or the physical memory where that is not available, or None.
+    '''
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def rule_resources(threads, lanes=1, memory_mb=None):
+    '''
+    Per tool thread and memory budgets for a snakemake run with threads cores and lanes independent polishing
+    chains (samples times analysis stems) that can run side by side. Each chain runs its tools one after another,
+    so the cores are split evenly between chains, capped at what each tool can use. With memory_mb, the total is
+    also returned as the mem_mb to give snakemake's --resources, so that memory hungry jobs such as medaka are only
+    started while they fit.
+
+    Returns {"config": {"racon_threads": ..., "racon_mem_mb": ..., ...}, "mem_mb": total or None}.
+    '''
+    threads = max(1, threads)
+    per_lane = max(1, threads // max(1, lanes))
+    mem_mb = int(memory_mb * MEMORY_FRACTION) if memory_mb else None
+
+    config = {}
+    for tool, (max_threads, base_mb, thread_mb) in sorted(TOOL_PROFILES.items()):
+        tool_threads = min(max_threads, per_lane, threads)
+        tool_mb = base_mb + thread_mb * tool_threads
+        if mem_mb is not None:
+            # a job asking for more than the whole budget would never be scheduled
+            tool_mb = min(tool_mb, mem_mb)
+        config["%s_threads" % tool] = tool_threads
+        config["%s_mem_mb" % tool] = tool_mb
+    return {"config": config, "mem_mb": mem_mb}
+
+def resources_config_list(resources):
+    return ["%s=%s" % (key, value) for key, value in sorted(resources["config"].items())]
@@ -0,0 +1,91 @@
+import threading
+
+
+class CoreBudget:
+    '''
+    A pool of cores shared between concurrently running jobs.
+    '''
+    def __init__(self, cores):
+        self.cores = max(1, cores)
+        self.free = self.cores
+        self.condition = threading.Condition()
+
+    def acquire(self, cores):
+        cores = max(1, min(cores, self.cores))
+        with self.condition:
+            while self.free < cores:
+                self.condition.wait()
+            self.free -= cores
+        return cores
+
+    def acquire_up_to(self, cores):
+        '''
+        Take as many of the requested cores as are free, waiting only until at least one is.
+        '''
+        cores = max(1, min(cores, self.cores))
+        with self.condition:
+            while self.free < 1:
+                self.condition.wait()
+            cores = min(cores, self.free)
+            self.free -= cores
+        return cores
+
+    def release(self, cores):
+        with self.condition:
+            self.free += cores
+            self.condition.notify_all()
+
+def fair_share(cores, unfinished, max_concurrent):
+    '''
+    Cores for the next job to start: the budget split evenly between the jobs that can still run side by side.
+    '''
+    slots = max(1, min(unfinished, max_concurrent))
+    return max(1, cores // slots)
+
+def run_fair_share(jobs, cores, max_concurrent=None):
+    '''
+    Run jobs, a list of (name, function) pairs where function takes the number of cores it may use, concurrently
+    under a global core budget. Jobs start in order, each with a fair share of the budget computed from the jobs
+    not yet finished, so late jobs get more cores once the queue drains. An exception in one job does not stop the
+    others; it is returned in place of that job's result.
+
+    Returns a list of (name, result, exception) in the order the jobs were given.
+    '''
+    if max_concurrent is None:
+        max_concurrent = cores
+    max_concurrent = max(1, max_concurrent)
+
+    budget = CoreBudget(cores)
+    results = [None] * len(jobs)
+    state = {"unfinished": len(jobs), "running": 0}
+    condition = threading.Condition()
+
+    def run_job(index, name, function, job_cores):
+        result, exception = None, None
+        try:
+            result = function(job_cores)
+        except BaseException as e:
+            exception = e
+        finally:
+            budget.release(job_cores)
+            with condition:
+                results[index] = (name, result, exception)
+                state["unfinished"] -= 1
+                state["running"] -= 1
+                condition.notify_all()
+
+    threads = []
+    for index, (name, function) in enumerate(jobs):
+        with condition:
+            while state["running"] >= max_concurrent:
+                condition.wait()
+            share = fair_share(budget.cores, state["unfinished"], max_concurrent)
+            state["running"] += 1
+        job_cores = budget.acquire_up_to(share)
+        thread = threading.Thread(target=run_job, args=(index, name, function, job_cores), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,538 @@
+'''
+postbox serve: a long running postbox taking runs over HTTP, on a Unix socket or localhost, so that a LIMS starting
+many runs a day does not pay for interpreter startup, imports and protocol resolution every time. Pipelines and run
+resolutions stay in memory while their files are unchanged, and with --executor pool the worker processes (and
+their snakemake imports, with --engine api) are kept from one run to the next. Runs are queued and at most
+--max_concurrent run at once, each with an even share of --threads, inside its run directory. The socket (by
+default postbox.sock where the daemon starts) is only usable by the daemon's user; --port listens on localhost
+instead, where any local user can submit runs. Relative paths are taken from where the daemon starts.
+
+    postbox serve -p /path/to/protocol -q analysis -t 32 --max_concurrent 2 --socket /tmp/postbox.sock
+    curl --unix-socket /tmp/postbox.sock -d '{"run_directory": "/data/runs/run1"}' http://localhost/runs
+    curl --unix-socket /tmp/postbox.sock http://localhost/runs/1
+    curl --unix-socket /tmp/postbox.sock 'http://localhost/runs/1/log?sample=North&offset=0'
+
+    POST   /runs             queue a run: {"run_directory": ..., "pipeline": ..., "protocol": ..., "threads": ...,
+                             "overrides": ["key=value", ...], "arguments": [any other postbox options]}
+    GET    /runs             every run submitted since the daemon started
+    GET    /runs/<id>        one run
+    GET    /runs/<id>/log    its snakemake log (or a sample's with ?sample=) from ?offset= bytes on, with the size
+                             of the whole log in the X-Log-Size header
+    DELETE /runs/<id>        cancel a run that has not started
+    GET    /status           the daemon: runs queued and running, pipelines loaded
+'''
+import argparse
+import collections
+import copy
+import http.client
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from postbox.postbox import add_protocol_arguments, add_cache_arguments, add_executor_arguments, \
+    add_logging_arguments, find_pipeline, run_resolved, sample_log_file, Error, get_arguments as get_run_arguments
+from postbox.cache import cached_resolve_run
+from postbox.executors import make_executor
+
+HOST = "127.0.0.1"
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCESS = "success"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class SubmissionError(Exception): pass
+
+def stat_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return signature
+
+class Resolutions:
+    '''
+    Pipelines and run resolutions kept in memory, reused for as long as the files they were read from keep their
+    modification time and size. Misses go through cached_resolve_run and its cache on disk.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pipelines = {}
+        self.runs = {}
+
+    def lookup(self, table, key, signature):
+        with self.lock:
+            hit = table.get(key)
+        if hit is not None and hit[0] == signature:
+            # runs fill in their config as they go, so every one gets its own copy
+            return copy.deepcopy(hit[1])
+        return None
+
+    def store(self, table, key, signature, value):
+        with self.lock:
+            table[key] = (signature, copy.deepcopy(value))
+        return value
+
+    def pipeline(self, protocol, pipeline):
+        key = (os.path.abspath(protocol), pipeline)
+        signature = stat_signature([os.path.join(protocol, "rampart", "pipelines.json")])
+        pipeline_dict = self.lookup(self.pipelines, key, signature)
+        if pipeline_dict is None:
+            pipeline_dict = self.store(self.pipelines, key, signature, find_pipeline(
+                protocol, pipeline, {"path": None, "config": None, "config_file": None, "options": None}))
+        return pipeline_dict
+
+    def resolve(self, args):
+        key = (os.path.abspath(args.protocol), args.pipeline, args.run_directory, args.run_configuration,
+               args.basecalled_path, args.fast5_path, args.csv)
+        signature = stat_signature([os.path.join(args.protocol, "rampart", "pipelines.json"),
+                                    args.run_configuration, args.csv])
+        resolved = self.lookup(self.runs, key, signature)
+        if resolved is None:
+            resolved = self.store(self.runs, key, signature, cached_resolve_run(
+                args.protocol, args.pipeline, args.run_directory, args.run_configuration, args.basecalled_path,
+                args.fast5_path, args.csv, cache_dir=args.cache_dir, use_cache=args.use_cache))
+        return resolved
+
+    def loaded(self):
+        with self.lock:
+            return sorted("%s:%s" % (protocol, pipeline or "") for protocol, pipeline in self.pipelines)
+
+class Run:
+    def __init__(self, run_id, request, args):
+        self.id = run_id
+        self.request = request
+        self.args = args
+        self.status = QUEUED
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def logs(self):
+        '''
+        {name: path} of the log of the run and of each of its samples that has one so far.
+        '''
+        if self.args.log_file is None:
+            return {}
+        logs = {"run": self.args.log_file}
+        directory, name = os.path.split(self.args.log_file)
+        root, ext = os.path.splitext(name)
+        try:
+            for entry in sorted(os.listdir(directory)):
+                if entry.startswith(root + ".") and entry.endswith(ext) and entry != name:
+                    sample = entry[len(root) + 1:len(entry) - len(ext)]
+                    logs[sample] = sample_log_file(self.args.log_file, sample)
+        except OSError:
+            pass
+        return logs
+
+    def to_dict(self):
+        return {"id": self.id, "status": self.status, "run_directory": self.args.run_directory,
+                "protocol": self.args.protocol, "pipeline": self.args.pipeline, "threads": self.args.threads,
+                "error": self.error, "submitted": self.submitted, "started": self.started, "finished": self.finished,
+                "logs": self.logs()}
+
+def run_arguments(args, request, threads):
+    '''
+    The postbox command line a submitted run amounts to.
+    '''
+    argv = ["-p", request.get("protocol") or args.protocol, "-d", request["run_directory"], "-t", str(threads),
+            "--engine", args.engine, "--executor", args.executor, "--log_level", args.log_level,
+            "--log_max_bytes", str(args.log_max_bytes)]
+    if request.get("pipeline") or args.pipeline:
+        argv.extend(["-q", request.get("pipeline") or args.pipeline])
+    if args.log_file is not None:
+        argv.extend(["--log_file", args.log_file])
+    if args.cache_dir is not None:
+        argv.extend(["--cache_dir", args.cache_dir])
+    if not args.use_cache:
+        argv.append("--no_cache")
+    if args.workers is not None:
+        argv.extend(["--workers", str(args.workers)])
+    if args.queue is not None:
+        argv.extend(["--queue", args.queue, "--queue_poll_interval", str(args.queue_poll_interval)])
+    # the overrides go last, as the pipeline config takes the rest of the line
+    return argv + list(request.get("arguments", [])) + list(request.get("overrides", []))
+
+def absolute_paths(args):
+    '''
+    Make the paths of args that are not relative to the run directory absolute, as snakemake runs inside the run
+    directory rather than where the daemon was started.
+    '''
+    args.protocol = os.path.abspath(args.protocol)
+    for option in ["cache_dir", "queue"]:
+        if getattr(args, option, None) is not None:
+            setattr(args, option, os.path.abspath(getattr(args, option)))
+    return args
+
+def check_request(request):
+    if not isinstance(request, dict):
+        raise SubmissionError("expected a JSON object")
+    run_directory = request.get("run_directory")
+    if not isinstance(run_directory, str) or not os.path.isabs(run_directory):
+        raise SubmissionError("run_directory must be an absolute path")
+    if not os.path.isdir(run_directory):
+        raise SubmissionError("run directory %s does not exist" % run_directory)
+    for key in ["overrides", "arguments"]:
+        if not isinstance(request.get(key, []), list) or not all(isinstance(item, str) for item in request.get(key, [])):
+            raise SubmissionError("%s must be a list of strings" % key)
+    if request.get("threads") is not None and not (isinstance(request["threads"], int) and request["threads"] > 0):
+        raise SubmissionError("threads must be a positive integer")
+
+class Daemon:
+    '''
+    The runs of a postbox serve: a queue of submitted runs worked through by max_concurrent runner threads.
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.resolutions = Resolutions()
+        self.executor = make_executor(args)
+        self.runs = {}
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.next_id = 1
+        self.stopping = False
+        self.started = time.time()
+        self.runners = []
+
+    def share(self):
+        return max(1, self.args.threads // max(1, self.args.max_concurrent))
+
+    def submit(self, request):
+        check_request(request)
+        threads = min(request.get("threads") or self.share(), self.args.threads)
+
+        def invalid(message):
+            raise SubmissionError(message)
+
+        try:
+            args = get_run_arguments(run_arguments(self.args, request, threads), on_error=invalid)
+            absolute_paths(args)
+            # checks the pipeline exists, and loads it for the runs to come
+            self.resolutions.pipeline(args.protocol, args.pipeline)
+        except Error as e:
+            raise SubmissionError(str(e))
+        except SystemExit as e:
+            raise SubmissionError(str(e.code) if e.code not in (None, 0) else "invalid arguments")
+        args.cwd = args.run_directory
+        with self.condition:
+            run = Run(self.next_id, request, args)
+            self.next_id += 1
+            self.runs[run.id] = run
+            self.pending.append(run)
+            self.condition.notify()
+        print("Run %d queued: %s" % (run.id, args.run_directory))
+        return run
+
+    def run(self, run_id):
+        with self.condition:
+            return self.runs[run_id]
+
+    def list_runs(self):
+        with self.condition:
+            return list(self.runs.values())
+
+    def cancel(self, run_id):
+        '''
+        Cancel a queued run. Returns whether it was.
+        '''
+        with self.condition:
+            run = self.runs[run_id]
+            if run.status != QUEUED:
+                return False
+            self.pending.remove(run)
+            run.status = CANCELLED
+            run.finished = time.time()
+        return True
+
+    def execute(self, run):
+        try:
+            pipeline_dict, config, sample_dict = self.resolutions.resolve(run.args)
+            executor = self.executor if run.args.executor == self.args.executor else None
+            run_resolved(run.args, pipeline_dict, config, sample_dict, executor)
+            run.status = SUCCESS
+        except (Exception, SystemExit) as e:
+            run.status = FAILED
+            run.error = str(e.code if isinstance(e, SystemExit) else e) or e.__class__.__name__
+        run.finished = time.time()
+        print("Run %d %s: %s" % (run.id, run.status, run.args.run_directory))
+
+    def runner(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                run = self.pending.popleft()
+                run.status = RUNNING
+                run.started = time.time()
+            self.execute(run)
+
+    def start(self):
+        for number in range(max(1, self.args.max_concurrent)):
+            thread = threading.Thread(target=self.runner, daemon=True)
+            thread.start()
+            self.runners.append(thread)
+
+    def stop(self):
+        '''
+        Stop starting runs, wait for the running ones and let go of the executor.
+        '''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.runners:
+            thread.join()
+        self.executor.close()
+
+    def status(self):
+        with self.condition:
+            counts = collections.Counter(run.status for run in self.runs.values())
+        return {"pid": os.getpid(), "uptime": round(time.time() - self.started, 3), "threads": self.args.threads,
+                "max_concurrent": self.args.max_concurrent, "runs": dict(counts),
+                "pipelines": self.resolutions.loaded()}
+
+def read_from(path, offset):
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(min(offset, size))
+            return f.read(), size
+    except FileNotFoundError:
+        return b"", 0
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "postbox"
+
+    def address_string(self):
+        # connections over a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, value):
+        self.send_body(status, (json.dumps(value, indent=1) + "\n").encode(), "application/json")
+
+    def route(self):
+        '''
+        The parts of the path, the query and the run the path names if any, or None after an error response.
+        '''
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        run = None
+        if len(parts) > 1 and parts[0] == "runs":
+            try:
+                run = self.server.daemon.run(int(parts[1]))
+            except (ValueError, KeyError):
+                self.send_json(404, {"error": "no run %s" % parts[1]})
+                return None
+        return parts, parse_qs(url.query), run
+
+    def do_GET(self):
+        routed = self.route()
+        if routed is None:
+            return
+        parts, query, run = routed
+        daemon = self.server.daemon
+        if parts == ["status"]:
+            self.send_json(200, daemon.status())
+        elif parts == ["runs"]:
+            self.send_json(200, [run.to_dict() for run in daemon.list_runs()])
+        elif run is not None and len(parts) == 2:
+            self.send_json(200, run.to_dict())
+        elif run is not None and parts[2:] == ["log"]:
+            name = query.get("sample", ["run"])[0]
+            logs = run.logs()
+            if name not in logs:
+                self.send_json(404, {"error": "no log for %s" % name})
+                return
+            try:
+                offset = int(query.get("offset", ["0"])[0])
+            except ValueError:
+                self.send_json(400, {"error": "offset must be a number"})
+                return
+            body, size = read_from(logs[name], offset)
+            self.send_body(200, body, "text/plain; charset=utf-8", {"X-Log-Size": str(size)})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != "/runs":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"null")
+            run = self.server.daemon.submit(request)
+        except ValueError as e:
+            self.send_json(400, {"error": "invalid JSON: %s" % e})
+            return
+        except SubmissionError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(202, run.to_dict())
+
+    def do_DELETE(self):
+        routed = self.route()
+        if routed is None:
+            return
+        parts, query, run = routed
+        if run is None or len(parts) != 2:
+            self.send_json(404, {"error": "not found"})
+        elif self.server.daemon.cancel(run.id):
+            self.send_json(200, run.to_dict())
+        else:
+            self.send_json(409, {"error": "run %d is %s, only queued runs can be cancelled" % (run.id, run.status)})
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(daemon, socket_path=None, port=8642, verbose=False):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                sys.exit("Error: another postbox serve is listening on %s" % socket_path)
+            except OSError:
+                # left behind by a daemon that was killed
+                os.remove(socket_path)
+            finally:
+                probe.close()
+        server = UnixHTTPServer(socket_path, Handler)
+        os.chmod(socket_path, 0o600)
+    else:
+        server = ThreadingHTTPServer((HOST, port), Handler)
+        server.daemon_threads = True
+    server.daemon = daemon
+    server.verbose = verbose
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60.0):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def call(address, method, path, body=None, timeout=60.0):
+    '''
+    Make a request to a postbox serve at address, a socket path or a port on localhost. Returns the status, the
+    body (parsed if JSON) and the headers.
+    '''
+    if isinstance(address, int):
+        connection = http.client.HTTPConnection(HOST, address, timeout=timeout)
+    else:
+        connection = UnixHTTPConnection(address, timeout)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={"Content-Type": "application/json"} if data else {})
+        response = connection.getresponse()
+        content = response.read()
+        if response.getheader("Content-Type", "").startswith("application/json"):
+            content = json.loads(content)
+        return response.status, content, dict(response.getheaders())
+    finally:
+        connection.close()
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='postbox serve',
+                                     description='Runs postbox as a daemon taking runs over HTTP on localhost or a \
+                                                  Unix socket')
+    main_group = parser.add_argument_group('Main options', 'Defaults for the runs submitted, which can name others')
+    add_protocol_arguments(main_group)
+
+    run_group = parser.add_argument_group('Run options')
+    run_group.add_argument('-t', '--threads', dest='threads', default=1, type=int,
+                           help='Total number of cores shared by the runs running at once')
+    run_group.add_argument('--max_concurrent', dest='max_concurrent', default=1, type=int,
+                           help='Maximum number of runs running at once; further runs wait in the queue')
+    run_group.add_argument('--engine', dest='engine', choices=['subprocess', 'api'], default='subprocess',
+                           help='Run snakemake as a separate process (default) or through its Python API, which \
+                           with more than one run at once needs --executor pool')
+    add_executor_arguments(run_group)
+    add_cache_arguments(run_group)
+
+    server_group = parser.add_argument_group('Server options')
+    server_group.add_argument('--socket', dest='socket', default='postbox.sock',
+                              help='Unix socket to listen on, which only the user running postbox serve can use')
+    server_group.add_argument('--port', dest='port', default=None, type=int,
+                              help='Listen on this port on localhost instead of a Unix socket. There is no \
+                              authentication: any local user can then submit runs, which run as this user')
+    server_group.add_argument('--verbose', dest='verbose', action="store_true",
+                              help='Log every request')
+
+    add_logging_arguments(parser, default_log_file='postbox.log', default_log_level='WARNING')
+
+    args = parser.parse_args(argv)
+    args.protocol = args.protocol.rstrip("/")
+    absolute_paths(args)
+    args.socket = os.path.abspath(args.socket) if args.port is None else None
+    if args.engine == "api" and args.executor == "queue":
+        parser.error("--engine api runs snakemake inside postbox, which the queue workers cannot do")
+    if args.engine == "api" and args.executor == "local" and args.max_concurrent > 1:
+        parser.error("snakemake's API cannot run several runs in one process, use --executor pool")
+    return args
+
+def stop_on_signal(number, frame):
+    raise KeyboardInterrupt()
+
+def main(argv=None):
+    args = get_arguments(argv)
+    daemon = Daemon(args)
+    if args.pipeline is not None:
+        try:
+            daemon.resolutions.pipeline(args.protocol, args.pipeline)
+        except Error as e:
+            sys.exit("Error: %s" % e)
+    if args.engine == "api" and args.executor == "local":
+        from postbox.engine import load_snakemake
+        load_snakemake()
+    if args.port is not None:
+        print("Warning: listening on port %d of localhost without authentication, any local user can submit runs" %
+              args.port, file=sys.stderr)
+    server = make_server(daemon, args.socket, args.port, args.verbose)
+    daemon.start()
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    print("postbox serve listening on %s, running %d runs at once with %d threads" % (
+        args.socket or "http://%s:%d" % (HOST, args.port), args.max_concurrent, args.threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping: waiting for the runs in progress to finish")
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        daemon.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import json
+import os
+import re
+import threading
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+rule_pattern = re.compile(r'^(?:local)?(?:rule|checkpoint) (\S+):$')
+error_pattern = re.compile(r'^Error in rule (\S+):$')
+finished_pattern = re.compile(r'^Finished job (\d+)\.$')
+detail_pattern = re.compile(r'^\s+(\w+): (.*)$')
+
+
+class SnakemakeLogParser:
+    '''
+    Follows snakemake's log to find out which jobs run when. Jobs are announced as a "rule name:" line followed by
+    indented details (jobid, output, wildcards...), finish with "Finished job N." and fail with an "Error in rule
+    name:" block.
+    '''
+    def __init__(self, on_start=None, on_finish=None):
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.block = None
+
+    def close_block(self, now):
+        block, self.block = self.block, None
+        if block is None or "jobid" not in block:
+            return
+        if block["kind"] == "error":
+            if self.on_finish is not None:
+                self.on_finish(block["jobid"], "failed", now)
+        elif self.on_start is not None:
+            self.on_start(block, now)
+
+    def feed(self, line, now=None):
+        now = time.time() if now is None else now
+        detail = detail_pattern.match(line)
+        if self.block is not None and detail:
+            key, value = detail.groups()
+            if key == "jobid":
+                self.block["jobid"] = value.strip()
+            elif key == "output":
+                self.block["output"] = [path.strip() for path in value.split(",") if path.strip()]
+            elif key == "wildcards":
+                self.block["wildcards"] = value.strip()
+            return
+        self.close_block(now)
+
+        match = rule_pattern.match(line)
+        if match:
+            self.block = {"kind": "rule", "rule": match.group(1), "output": [], "wildcards": ""}
+            return
+        match = error_pattern.match(line)
+        if match:
+            self.block = {"kind": "error", "rule": match.group(1)}
+            return
+        match = finished_pattern.match(line)
+        if match and self.on_finish is not None:
+            self.on_finish(match.group(1), "finished", now)
+
+def output_pattern(paths):
+    '''
+    A regex finding any of paths in a command line as a whole path (or the directory of one), so that Sabin1 is not
+    found in Sabin10.
+    '''
+    if not paths:
+        return None
+    alternatives = "|".join(re.escape(path) for path in sorted(paths, key=len, reverse=True))
+    return re.compile(r'(?:^|(?<=[\s=<>\'"/:]))(?:%s)(?=$|[\s<>\'";|&)/.])' % alternatives)
+
+def read_process(pid):
+    '''
+    Parent pid, cpu seconds of the process itself and of the children it has waited for, current and peak resident
+    set size (kB) and command line of a process from /proc, or None if it has gone.
+    '''
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            stat = f.read()
+        with open("/proc/%d/status" % pid) as f:
+            status = f.read()
+        with open("/proc/%d/cmdline" % pid, "rb") as f:
+            cmdline = f.read().replace(b"\0", b" ").decode("utf-8", errors="replace")
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    # the command name in brackets may contain spaces, so split after it
+    fields = stat[stat.rindex(")") + 2:].split()
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    children_cpu = (int(fields[13]) + int(fields[14])) / CLOCK_TICKS
+    memory = {}
+    for line in status.splitlines():
+        if line.startswith(("VmRSS:", "VmHWM:")):
+            key, value = line.split(":", 1)
+            memory[key] = int(value.split()[0])
+    return ppid, cpu, children_cpu, memory.get("VmRSS", 0), memory.get("VmHWM", 0), cmdline
+
+def process_tree(root_pid):
+    '''
+    All live descendants of root_pid as {pid: (ppid, cpu, children_cpu, rss, hwm, cmdline)}.
+    '''
+    processes = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            info = read_process(int(name))
+            if info is not None:
+                processes[int(name)] = info
+
+    descendants = {}
+    parents = {root_pid}
+    while parents:
+        children = [pid for pid in processes if processes[pid][0] in parents and pid not in descendants]
+        for pid in children:
+            descendants[pid] = processes[pid]
+        parents = set(children)
+    return descendants
+
+class JobMonitor:
+    '''
+    Telemetry for one snakemake process: job timings from its log, cpu and memory from sampling its process tree.
+    Processes are attributed to a running job when one of the job's output paths appears in their command line
+    (or that of an ancestor), which holds for shell commands writing to their {output}.
+
+    The figures are approximate. A process that a job's own processes wait for is counted in full through their
+    children's cpu time, but the processes snakemake starts directly lose whatever they use after the last sample,
+    and jobs shorter than the sampling interval may get no cpu or memory at all.
+    '''
+    def __init__(self, telemetry, label=""):
+        self.telemetry = telemetry
+        self.label = label
+        self.root_pid = None
+        self.jobs = {}
+        self.pid_jobs = {}
+        self.absorbed = set()
+        self.parser = SnakemakeLogParser(on_start=self.job_started, on_finish=self.job_finished)
+
+    def start(self, pid):
+        self.root_pid = pid
+
+    def job_started(self, block, now):
+        job = {
+            "label": self.label,
+            "jobid": block["jobid"],
+            "rule": block["rule"],
+            "wildcards": block["wildcards"],
+            "output": block["output"],
+            "pattern": output_pattern(block["output"]),
+            "start": now,
+            "end": None,
+            "status": "running",
+            "cpu_seconds": {},
+            "parents": {},
+            "peak_rss_kb": 0
+        }
+        self.jobs[job["jobid"]] = job
+
+    def job_finished(self, jobid, status, now):
+        job = self.jobs.get(jobid)
+        if job is not None and job["end"] is None:
+            job["end"] = now
+            job["status"] = status
+
+    def feed_line(self, line):
+        self.parser.feed(line)
+
+    def job_for(self, pid, tree):
+        if pid in self.pid_jobs:
+            return self.pid_jobs[pid]
+        ppid, cpu, children_cpu, rss, hwm, cmdline = tree[pid]
+        job = None
+        if ppid in tree:
+            job = self.job_for(ppid, tree)
+        if job is None:
+            for candidate in self.jobs.values():
+                if candidate["end"] is None and candidate["pattern"] is not None and \
+                        candidate["pattern"].search(cmdline):
+                    job = candidate
+                    break
+        if job is not None:
+            self.pid_jobs[pid] = job
+        return job
+
+    def sample(self):
+        if self.root_pid is None:
+            return
+        tree = process_tree(self.root_pid)
+        # a process of a job that has gone while its parent in the same job lives on was waited for, so its cpu
+        # time is now part of the parent's children cpu time and must not be counted twice
+        for pid, job in self.pid_jobs.items():
+            if pid not in tree and job["parents"].get(pid) in tree and pid not in self.absorbed:
+                self.absorbed.add(pid)
+                job["cpu_seconds"].pop(pid, None)
+        rss_sums = {}
+        for pid in tree:
+            job = self.job_for(pid, tree)
+            if job is None:
+                continue
+            ppid, cpu, children_cpu, rss, hwm, cmdline = tree[pid]
+            if self.pid_jobs.get(ppid) is job:
+                job["parents"][pid] = ppid
+            job["cpu_seconds"][pid] = max(cpu + children_cpu, job["cpu_seconds"].get(pid, 0.0))
+            job["peak_rss_kb"] = max(job["peak_rss_kb"], hwm)
+            rss_sums[job["jobid"]] = rss_sums.get(job["jobid"], 0) + rss
+        for jobid, rss in rss_sums.items():
+            self.jobs[jobid]["peak_rss_kb"] = max(self.jobs[jobid]["peak_rss_kb"], rss)
+
+    def finish(self, return_code):
+        self.parser.close_block(time.time())
+        now = time.time()
+        for job in self.jobs.values():
+            if job["end"] is None:
+                job["end"] = now
+                job["status"] = "finished" if return_code == 0 else "incomplete"
+        self.telemetry.add_jobs(self.jobs.values())
+
+class RunTelemetry:
+    '''
+    Collects per-job wall time, cpu time and peak RSS across all snakemake processes of a postbox run and writes
+    them out as postbox_metrics.json and, optionally, a Prometheus textfile.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def monitor(self, label=""):
+        return JobMonitor(self, label)
+
+    def add_jobs(self, jobs):
+        with self.lock:
+            for job in jobs:
+                self.jobs.append({
+                    "label": job["label"],
+                    "jobid": job["jobid"],
+                    "rule": job["rule"],
+                    "wildcards": job["wildcards"],
+                    "status": job["status"],
+                    "start": job["start"],
+                    "end": job["end"],
+                    "wall_seconds": round(job["end"] - job["start"], 3),
+                    "cpu_seconds": round(sum(job["cpu_seconds"].values()), 3),
+                    "peak_rss_mb": round(job["peak_rss_kb"] / 1024, 1)
+                })
+
+    def rule_summary(self):
+        rules = {}
+        for job in self.jobs:
+            summary = rules.setdefault(job["rule"], {"jobs": 0, "failed": 0, "wall_seconds": 0.0,
+                                                     "cpu_seconds": 0.0, "peak_rss_mb": 0.0})
+            summary["jobs"] += 1
+            summary["failed"] += job["status"] == "failed"
+            summary["wall_seconds"] = round(summary["wall_seconds"] + job["wall_seconds"], 3)
+            summary["cpu_seconds"] = round(summary["cpu_seconds"] + job["cpu_seconds"], 3)
+            summary["peak_rss_mb"] = max(summary["peak_rss_mb"], job["peak_rss_mb"])
+        return rules
+
+    def write_json(self, path):
+        end = time.time()
+        with self.lock:
+            metrics = {
+                "start": self.start,
+                "end": end,
+                "wall_seconds": round(end - self.start, 3),
+                "rules": self.rule_summary(),
+                "jobs": sorted(self.jobs, key=lambda job: job["start"])
+            }
+        write_atomic(path, json.dumps(metrics, indent=2) + "\n")
+
+    def write_prometheus(self, path):
+        with self.lock:
+            rules = self.rule_summary()
+        metrics = [
+            ("postbox_rule_jobs_total", "counter", "Snakemake jobs run per rule", "jobs", 1),
+            ("postbox_rule_failed_jobs_total", "counter", "Snakemake jobs failed per rule", "failed", 1),
+            ("postbox_rule_wall_seconds_total", "counter", "Wall clock seconds spent in jobs of the rule",
+             "wall_seconds", 1),
+            ("postbox_rule_cpu_seconds_total", "counter", "CPU seconds used by jobs of the rule", "cpu_seconds", 1),
+            ("postbox_rule_peak_rss_bytes", "gauge", "Largest peak resident set size of a job of the rule",
+             "peak_rss_mb", 1024 * 1024)
+        ]
+        lines = []
+        for name, kind, description, key, scale in metrics:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for rule in sorted(rules):
+                lines.append('%s{rule="%s"} %s' % (name, rule, repr(round(rules[rule][key] * scale, 3))))
+        write_atomic(path, "\n".join(lines) + "\n")
+
+def write_atomic(path, text):
+    # textfile collectors may read at any moment, so never let them see a half written file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,265 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+from postbox.postbox import add_protocol_arguments, add_run_configuration_arguments, add_cache_arguments, \
+    add_resource_arguments, add_manifest_arguments, add_compression_arguments, add_journal_arguments, \
+    add_executor_arguments, add_logging_arguments, resolve_run_paths, filter_sample_dict, comma_list, run_sample, \
+    prepare_manifest, prepare_compression, prepare_references, run_lock, Error
+from postbox.journal import Journal
+from postbox.executors import make_executor
+from postbox.cache import cached_resolve_run
+from postbox.barcodes import scan_fastq, is_fastq, barcode_of_path, normalise_barcode
+from postbox.incremental import sample_fingerprints, load_fingerprints, save_fingerprints, changed_samples
+
+
+def get_arguments(argv=None):
+    '''
+    Parse the command line arguments for postbox watch.
+    '''
+    parser = argparse.ArgumentParser(prog='postbox watch',
+                                     description='Watches the basecalled directory of a live run and reprocesses \
+                                                  each sample as new reads arrive for its barcodes')
+
+    main_group = parser.add_argument_group('Main options')
+    add_protocol_arguments(main_group)
+
+    run_group = parser.add_argument_group('Run configuration options')
+    run_group.add_argument('-d', '--run_directory', dest='run_directory', default='./',
+                           help='Path to the directory for this run if it is not in current working directory')
+    add_run_configuration_arguments(run_group)
+    run_group.add_argument('--samples', dest='samples', default=None, type=comma_list,
+                           help='Comma separated list of samples to watch. Defaults to all samples')
+    run_group.add_argument('--barcodes', dest='barcodes', default=None, type=comma_list,
+                           help='Comma separated list of barcodes. Only samples using one of these are watched')
+    run_group.add_argument('-t', '--threads', dest='threads', default=1, type=int,
+                           help='Total number of cores shared by concurrent sample runs')
+    run_group.add_argument('--overrides', dest='remainder', nargs='*', default=[],
+                           help='key=value pairs to override snakemake config parameters with')
+    add_resource_arguments(run_group)
+    add_manifest_arguments(run_group)
+    add_compression_arguments(run_group)
+    add_journal_arguments(run_group, resume=False)
+    add_cache_arguments(run_group)
+    add_executor_arguments(run_group)
+
+    watch_group = parser.add_argument_group('Watch options')
+    watch_group.add_argument('--settle', dest='settle', default=30.0, type=float,
+                             help='Seconds without new files for a barcode before its sample is processed')
+    watch_group.add_argument('--min_interval', dest='min_interval', default=300.0, type=float,
+                             help='Minimum seconds between the starts of two runs of the same sample')
+    watch_group.add_argument('--max_concurrent', dest='max_concurrent', default=1, type=int,
+                             help='Maximum number of samples processed at once')
+    watch_group.add_argument('--poll_interval', dest='poll_interval', default=10.0, type=float,
+                             help='Seconds between directory scans when inotify is not available')
+    watch_group.add_argument('--polling', dest='polling', action="store_true",
+                             help='Scan the directory instead of using inotify, e.g. on network filesystems')
+
+    add_logging_arguments(parser, default_log_file='postbox.log', default_log_level='WARNING')
+
+    args = parser.parse_args(argv)
+    args.protocol = args.protocol.rstrip("/")
+    args.run_directory, args.run_configuration, args.csv, args.log_file = resolve_run_paths(
+        args.run_directory, args.run_configuration, args.csv, args.log_file)
+
+    # watch runs always rerun their sample from scratch, through a separate snakemake per sample
+    args.engine = "subprocess"
+    args.incremental = True
+    args.dry_run = False
+    return args
+
+class PollingWatcher:
+    '''
+    Finds new or modified fastq files by comparing directory scans, at most one every poll_interval seconds however
+    often it is waited on, as a scan of a network filesystem is expensive.
+    '''
+    def __init__(self, basecalled_path, poll_interval=10.0):
+        self.basecalled_path = basecalled_path
+        self.poll_interval = poll_interval
+        self.snapshot = scan_fastq(basecalled_path)
+        self.last_scan = time.monotonic()
+
+    def wait(self, timeout):
+        until_scan = self.last_scan + self.poll_interval - time.monotonic()
+        if until_scan > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, until_scan))
+        snapshot = scan_fastq(self.basecalled_path)
+        self.last_scan = time.monotonic()
+        changed = [path for path in snapshot if self.snapshot.get(path) != snapshot[path]]
+        self.snapshot = snapshot
+        return changed
+
+class InotifyWatcher:
+    '''
+    Reports fastq files as they are closed after writing or moved into the basecalled directory, using the
+    optional inotify_simple package.
+    '''
+    def __init__(self, basecalled_path):
+        import inotify_simple
+        self.flags = inotify_simple.flags
+        self.mask = self.flags.CLOSE_WRITE | self.flags.MOVED_TO | self.flags.CREATE
+        self.inotify = inotify_simple.INotify()
+        self.directories = {}
+        for root, directories, files in os.walk(basecalled_path):
+            self.add_directory(root)
+
+    def add_directory(self, path):
+        self.directories[self.inotify.add_watch(path, self.mask)] = path
+
+    def wait(self, timeout):
+        changed = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            directory = self.directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & self.flags.ISDIR:
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO):
+                    self.add_directory(path)
+                    changed.extend(scan_fastq(path))
+            elif is_fastq(event.name) and event.mask & (self.flags.CLOSE_WRITE | self.flags.MOVED_TO):
+                changed.append(path)
+        return changed
+
+def make_watcher(basecalled_path, polling=False, poll_interval=10.0):
+    if not polling:
+        try:
+            return InotifyWatcher(basecalled_path)
+        except (ImportError, OSError) as e:
+            print("inotify not available (%s), polling %s every %.0fs" % (e, basecalled_path, poll_interval))
+    return PollingWatcher(basecalled_path, poll_interval)
+
+class WatchScheduler:
+    '''
+    Decides when each sample should be processed: once none of its barcodes has had a new file for settle
+    seconds, at most every min_interval seconds, and with no more than max_concurrent samples running.
+    '''
+    def __init__(self, sample_dict, settle=30.0, min_interval=300.0, max_concurrent=1):
+        self.settle = settle
+        self.min_interval = min_interval
+        self.max_concurrent = max_concurrent
+        self.sample_order = {sample: index for index, sample in enumerate(sample_dict)}
+        self.barcode_samples = {}
+        for sample in sample_dict:
+            for barcode in sample_dict[sample]:
+                self.barcode_samples.setdefault(normalise_barcode(barcode), []).append(sample)
+        self.last_change = {}
+        self.last_start = {}
+        self.running = set()
+
+    def note_samples(self, samples, now):
+        for sample in samples:
+            self.last_change[sample] = now
+
+    def note_changes(self, relative_paths, now):
+        samples = set()
+        for relative_path in relative_paths:
+            barcode = barcode_of_path(relative_path)
+            if barcode is None:
+                # binlorry sorts a flat directory by the read annotations, so its reads may be any sample's
+                samples.update(self.sample_order)
+            else:
+                samples.update(self.barcode_samples.get(barcode, []))
+        self.note_samples(samples, now)
+        return samples
+
+    def ready(self, now):
+        ready = []
+        for sample in sorted(self.last_change, key=lambda sample: (self.last_change[sample],
+                                                                   self.sample_order[sample])):
+            if len(self.running) + len(ready) >= self.max_concurrent:
+                break
+            if sample in self.running:
+                continue
+            if now - self.last_change[sample] < self.settle:
+                continue
+            if sample in self.last_start and now - self.last_start[sample] < self.min_interval:
+                continue
+            ready.append(sample)
+        for sample in ready:
+            del self.last_change[sample]
+            self.last_start[sample] = now
+            self.running.add(sample)
+        return ready
+
+    def finished(self, sample):
+        self.running.discard(sample)
+
+    def idle(self):
+        return not self.running and not self.last_change
+
+def main(argv=None):
+    args = get_arguments(argv)
+
+    try:
+        pipeline_dict, config, sample_dict = cached_resolve_run(args.protocol, args.pipeline, args.run_directory,
+                                                                args.run_configuration, args.basecalled_path,
+                                                                args.fast5_path, args.csv, cache_dir=args.cache_dir,
+                                                                use_cache=args.use_cache)
+    except Error as e:
+        sys.exit("Error: %s" % e)
+    sample_dict = filter_sample_dict(sample_dict, args.samples, args.barcodes)
+    if sample_dict == {}:
+        sys.exit("Error: postbox watch needs a sample to barcode map to know which samples new reads belong to")
+
+    # hold the run directory for as long as the watch lasts, so that no other postbox starts on it meanwhile
+    args.job_executor = make_executor(args)
+    try:
+        with run_lock(args.run_directory, timeout=args.lock_timeout, work_directory=os.getcwd()):
+            args.journal = Journal(args.run_directory)
+            watch(args, pipeline_dict, config, sample_dict)
+    finally:
+        args.job_executor.close()
+
+def watch(args, pipeline_dict, config, sample_dict):
+    basecalled_path = config["basecalledPath"].rstrip("/")
+
+    scheduler = WatchScheduler(sample_dict, args.settle, args.min_interval, args.max_concurrent)
+    lock = threading.Lock()
+    cores = max(1, args.threads // max(1, args.max_concurrent))
+
+    def process(sample):
+        try:
+            files = prepare_manifest(args, args.run_directory, config, sample_dict)
+            fingerprints = sample_fingerprints(basecalled_path, {sample: sample_dict[sample]}, files)
+            run_sample(args, pipeline_dict, config, sample_dict, sample, cores)
+            save_fingerprints(args.run_directory, fingerprints)
+            print("[%s] Processed" % sample)
+        except Exception as e:
+            print("[%s] Failed: %s" % (sample, e), file=sys.stderr)
+        finally:
+            with lock:
+                scheduler.finished(sample)
+
+    prepare_compression(args, args.run_directory, config)
+    prepare_references(args, pipeline_dict, config)
+    # samples with reads not yet processed by an earlier run or watch start out pending
+    files = prepare_manifest(args, args.run_directory, config, sample_dict)
+    fingerprints = sample_fingerprints(basecalled_path, sample_dict, files)
+    scheduler.note_samples(changed_samples(fingerprints, load_fingerprints(args.run_directory)), time.monotonic())
+
+    watcher = make_watcher(basecalled_path, args.polling, args.poll_interval)
+    print("Watching %s for %d samples. Press Ctrl-C to stop." % (basecalled_path, len(sample_dict)))
+    threads = []
+    try:
+        while True:
+            changed = watcher.wait(timeout=1.0)
+            now = time.monotonic()
+            with lock:
+                samples = scheduler.note_changes([os.path.relpath(path, basecalled_path) for path in changed], now)
+                ready = scheduler.ready(now)
+            if samples:
+                print("New reads for %s" % ", ".join(sorted(samples)))
+            threads = [thread for thread in threads if thread.is_alive()]
+            for sample in ready:
+                thread = threading.Thread(target=process, args=(sample,), daemon=True)
+                thread.start()
+                threads.append(thread)
+    except KeyboardInterrupt:
+        print("Stopping watch, waiting for running samples to finish")
+    for thread in threads:
+        thread.join()
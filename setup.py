@@ -11,8 +11,10 @@ setup(
     tests_require=["nose >= 1.3"],
     install_requires=[
         "numpy>=1.16.1",
-        "pandas>=0.24.2",
     ],
+    extras_require={
+        "watch": ["inotify_simple"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from postbox.alignment import *
+
+
+class TestAlignment(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "aln.fasta")
+        with open(self.path, "w") as f:
+            f.write(">ref display_name=Sabin1\nACGT-ACGTAC\nGT--\n>cns:racon1 round=1\n--GTCA-GTNCATT-\n")
+        self.alignment = Alignment.from_fasta(self.path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_from_fasta(self):
+        self.assertEqual(self.alignment.ids, ["ref", "cns:racon1"])
+        self.assertEqual(len(self.alignment), 15)
+        self.assertEqual(self.alignment.row(0), "ACGT-ACGTACGT--")
+
+    def test_unequal_lengths(self):
+        with open(self.path, "w") as f:
+            f.write(">ref\nACGT\n>cns\nACG\n")
+        with self.assertRaises(ValueError):
+            Alignment.from_fasta(self.path)
+
+    def test_trim_trailing_gaps(self):
+        self.assertEqual(self.alignment.trailing_gaps(), (2, 2))
+        trimmed = self.alignment.trim_trailing_gaps()
+        self.assertEqual(trimmed.row(0), "GT-ACGTACGT")
+        self.assertEqual(trimmed.row(1), "GTCA-GTNCAT")
+
+    def test_remove_gaps(self):
+        trimmed = self.alignment.trim_trailing_gaps()
+        self.assertEqual(list(trimmed.gap_positions()), [2, 4])
+        # the gap in the consensus becomes N, the base inserted against the reference is dropped
+        self.assertEqual(trimmed.remove_gaps(), "GTANGTNCAT")
+
+    def test_snp_positions(self):
+        trimmed = self.alignment.trim_trailing_gaps()
+        # the N against an A is not a snp
+        self.assertEqual(list(trimmed.snp_positions()), [9])
+
+    def test_clean_consensus(self):
+        with open(self.path) as f:
+            alignment = Alignment.from_text(f.read())
+        self.assertEqual(clean_consensus(alignment, "Sabin1", 1),
+                         ">Sabin1 accession=cns round_name=1 length=10\nGTANGTNCAT\n")
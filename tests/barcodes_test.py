@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from postbox.barcodes import *
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+class TestBarcodes(unittest.TestCase):
+    def test_normalise_barcode(self):
+        self.assertEqual(normalise_barcode("BC01"), "barcode01")
+        self.assertEqual(normalise_barcode("NB3"), "barcode03")
+        self.assertEqual(normalise_barcode("barcode12"), "barcode12")
+        self.assertEqual(normalise_barcode("7"), "barcode07")
+        self.assertEqual(normalise_barcode("unclassified"), "unclassified")
+
+    def test_barcode_of_path(self):
+        self.assertEqual(barcode_of_path("barcode01/FAK_pass_0.fastq"), "barcode01")
+        self.assertEqual(barcode_of_path("pass/barcode02/0/reads.fastq"), "barcode02")
+        self.assertEqual(barcode_of_path("FAK_pass_barcode03_0.fastq"), "barcode03")
+        self.assertEqual(barcode_of_path("unclassified/reads.fastq"), "unclassified")
+        self.assertIsNone(barcode_of_path("0/reads.fastq"))
+
+    def test_find_barcode_files(self):
+        with tempfile.TemporaryDirectory() as basecalled_path:
+            for name in ["barcode01/a.fastq", "barcode01/b.fastq.gz", "barcode01/summary.txt", "barcode02/a.fastq",
+                         "unclassified/a.fastq"]:
+                touch(os.path.join(basecalled_path, name))
+            barcode_files = find_barcode_files(basecalled_path, ["BC01", "NB02", "BC03"])
+            expected = {
+                "BC01": ["%s/barcode01/a.fastq" % basecalled_path, "%s/barcode01/b.fastq.gz" % basecalled_path],
+                "NB02": ["%s/barcode02/a.fastq" % basecalled_path],
+                "BC03": []
+            }
+            self.assertEqual(barcode_files, expected)
+
+    def test_unassigned_files(self):
+        files = {"/run/fastq_pass/%s" % name: (0, 0) for name in ["barcode01/a.fastq", "b.fastq", "0/a.fastq"]}
+        self.assertEqual(unassigned_files("/run/fastq_pass", files),
+                         ["/run/fastq_pass/0/a.fastq", "/run/fastq_pass/b.fastq"])
+
+    def test_scan_fastq(self):
+        with tempfile.TemporaryDirectory() as basecalled_path:
+            for name in ["barcode01/a.fastq", "barcode01/0/b.fq", "barcode02/notes.txt"]:
+                touch(os.path.join(basecalled_path, name))
+            files = scan_fastq(basecalled_path, threads=2)
+            self.assertEqual(sorted(files), ["%s/barcode01/0/b.fq" % basecalled_path,
+                                             "%s/barcode01/a.fastq" % basecalled_path])
+            self.assertEqual(files["%s/barcode01/a.fastq" % basecalled_path][0], 0)
+            self.assertEqual(scan_fastq(os.path.join(basecalled_path, "missing")), {})
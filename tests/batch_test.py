@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from postbox.batch import *
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(this_dir, 'tests', 'data')
+
+
+class TestBatch(unittest.TestCase):
+    def test_expand_run_directories(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["run2", "run1", "other"]:
+                os.mkdir(os.path.join(tmp_dir, name))
+            open(os.path.join(tmp_dir, "run3"), "w").close()
+            patterns = ["%s/run*" % tmp_dir, "%s/other/" % tmp_dir, "%s/run1" % tmp_dir]
+            expected = ["%s/run1" % tmp_dir, "%s/run2" % tmp_dir, "%s/other" % tmp_dir]
+            self.assertEqual(expand_run_directories(patterns), expected)
+
+    def test_prepare_run(self):
+        with tempfile.TemporaryDirectory() as run_directory:
+            os.mkdir(os.path.join(run_directory, "fastq_pass"))
+            args = get_arguments(["-p", "%s/example_protocol" % data_dir, "-q", "analysis",
+                                  "-c", "%s/example_run_directory/barcodes.csv" % data_dir,
+                                  "-i", "fastq_pass", run_directory])
+            run = prepare_run(args, args.run_directories[0])
+        self.assertEqual(run["config"]["basecalledPath"], "%s/fastq_pass" % run_directory)
+        self.assertEqual(run["log_file"], "%s/postbox.log" % run_directory)
+        self.assertEqual(sorted(run["sample_dict"]), ["Control", "East", "North", "South", "West"])
+
+    def test_main_reports_failed_runs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(SystemExit) as out:
+                main(["-p", "%s/example_protocol" % data_dir, "-q", "analysis", "-i", "fastq_pass", tmp_dir])
+        self.assertIn("1 of 1 runs failed", str(out.exception))
+
+    def test_threads_must_be_positive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(SystemExit):
+                get_arguments(["-p", "%s/example_protocol" % data_dir, "-t", "0", tmp_dir])
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_per_sample_pipeline(self):
+        with tempfile.TemporaryDirectory() as run_directory:
+            os.mkdir(os.path.join(run_directory, "fastq_pass"))
+            main(["-p", "%s/example_protocol" % data_dir, "-q", "analysis", "-t", "2", "--dry_run", "--no_cache",
+                  "-c", "%s/example_run_directory/barcodes.csv" % data_dir, "-i", "fastq_pass", run_directory])
+            with open(os.path.join(run_directory, "postbox.South.log")) as f:
+                log = f.read()
+        self.assertIn("binned/South/binned_South.fastq", log)
+        self.assertNotIn("binned/North/", log)
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_selected_samples(self):
+        # runs of a batch take the options of the single run CLI
+        with tempfile.TemporaryDirectory() as run_directory:
+            os.mkdir(os.path.join(run_directory, "fastq_pass"))
+            main(["-p", "%s/example_protocol" % data_dir, "-q", "analysis", "-t", "2", "--dry_run", "--no_cache",
+                  "--samples", "North,South", "-c", "%s/example_run_directory/barcodes.csv" % data_dir,
+                  "-i", "fastq_pass", run_directory])
+            logs = sorted(name for name in os.listdir(run_directory) if name.endswith(".log"))
+        self.assertEqual(logs, ["postbox.North.log", "postbox.South.log"])
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from postbox.cache import *
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(this_dir, 'tests', 'data')
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.run_directory = os.path.join(self.tmp_dir.name, "run")
+        os.makedirs(os.path.join(self.run_directory, "fastq_pass"))
+        shutil.copy("%s/example_run_directory/barcodes.csv" % data_dir, self.run_directory)
+        self.protocol = "%s/example_protocol" % data_dir
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def resolve(self):
+        return cached_resolve_run(self.protocol, "analysis", self.run_directory,
+                                  "%s/run_configuration.json" % self.run_directory, "fastq_pass", None,
+                                  "%s/barcodes.csv" % self.run_directory, cache_dir=self.cache_dir)
+
+    def test_cached_resolve_run_reuses_entry(self):
+        first = self.resolve()
+        # a cache hit skips validation, so it does not notice the basecalled path has gone
+        os.rmdir(os.path.join(self.run_directory, "fastq_pass"))
+        second = self.resolve()
+        self.assertEqual(first, second)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, "resolved"))), 1)
+
+    def test_cached_resolve_run_notices_changed_csv(self):
+        pipeline_dict, config, sample_dict = self.resolve()
+        with open("%s/barcodes.csv" % self.run_directory, "a") as f:
+            f.write("East2,BC06\n")
+        pipeline_dict, config, sample_dict = self.resolve()
+        self.assertEqual(sample_dict["East2"], ["BC06"])
+
+    def test_relative_protocol_resolved_per_directory(self):
+        cwd = os.getcwd()
+        try:
+            for directory in [data_dir, self.run_directory]:
+                os.chdir(directory)
+                self.protocol = os.path.relpath("%s/example_protocol" % data_dir)
+                pipeline_dict, config, sample_dict = self.resolve()
+                self.assertTrue(os.path.exists(pipeline_dict["path"]), pipeline_dict["path"])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, "resolved"))), 2)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = Cache(self.cache_dir, max_entries=2)
+        for key in ["a", "b"]:
+            cache.put(key, key)
+            time.sleep(0.01)
+        self.assertEqual(cache.get("a"), "a")
+        time.sleep(0.01)
+        cache.put("c", "c")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("c"), "c")
+
+    def test_file_fingerprint_missing_file(self):
+        self.assertIsNone(file_fingerprint(os.path.join(self.tmp_dir.name, "idontexist.csv")))
@@ -0,0 +1,100 @@
+import os
+import stat
+import tempfile
+import unittest
+
+from postbox.check import *
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(this_dir, 'tests', 'data')
+protocol = os.path.join(data_dir, 'example_protocol')
+
+
+class TestCheck(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.run_directory = self.tmp_dir.name
+        with open(os.path.join(self.run_directory, "barcodes.csv"), "w") as f:
+            f.write("sample,barcode\nNorth,BC01\nSouth,BC02\nSouth,BC03\n")
+        for barcode, reads in [("barcode01", "@r1\nACGT\n+\n!!!!\n"), ("barcode02", "")]:
+            os.makedirs(os.path.join(self.run_directory, "fastq_pass", barcode))
+            with open(os.path.join(self.run_directory, "fastq_pass", barcode, "a.fastq"), "w") as f:
+                f.write(reads)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def arguments(self, *extra):
+        return get_arguments(["-p", protocol, "-q", "analysis", "-d", self.run_directory, "-i", "fastq_pass",
+                              "--cache_dir", os.path.join(self.tmp_dir.name, "cache")] + list(extra))
+
+    def test_check_protocol(self):
+        results, pipeline = check_protocol(protocol, "analysis")
+        self.assertEqual(pipeline["path"],
+                         os.path.join(protocol, "rampart", "pipelines/analyse_samples", "Snakefile"))
+        self.assertEqual([item["status"] for item in results], [OK] * 4)
+        self.assertEqual(results[-1]["check"], "requires")
+
+    def test_check_protocol_unknown_pipeline(self):
+        results, pipeline = check_protocol(protocol, "nothing")
+        self.assertIsNone(pipeline)
+        self.assertEqual(results[-1]["status"], FAIL)
+        self.assertIn("analysis, null", results[-1]["detail"])
+        results, pipeline = check_protocol(protocol, None)
+        self.assertIsNone(pipeline)
+        self.assertIn("-q/--pipeline", results[-1]["detail"])
+
+    def test_pipeline_tools(self):
+        tools = pipeline_tools(os.path.join(protocol, "rampart", "pipelines", "analyse_samples", "Snakefile"))
+        self.assertEqual(tools, ["snakemake", "binlorry", "mafft", "medaka_consensus", "minimap2", "racon"])
+
+    def test_check_tool(self):
+        bin_dir = os.path.join(self.tmp_dir.name, "bin")
+        os.mkdir(bin_dir)
+        path = os.path.join(bin_dir, "racon")
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\necho v1.4.3\n")
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        cache = Cache(os.path.join(self.tmp_dir.name, "cache"), namespace="tools")
+        original_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir
+        try:
+            self.assertEqual(check_tool("racon", cache)["detail"], "racon v1.4.3 (%s)" % path)
+            # while the executable keeps its size and modification time the version comes from the cache
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, "w") as f:
+                f.write("#!/bin/sh\necho v9.9.9\n")
+            os.utime(path, ns=(mtime, mtime))
+            self.assertEqual(check_tool("racon", cache)["detail"], "racon v1.4.3 (%s)" % path)
+            self.assertEqual(check_tool("mafft", cache)["status"], FAIL)
+        finally:
+            os.environ["PATH"] = original_path
+
+    def test_check_barcodes(self):
+        results, basecalled_path, sample_dict = check_run(self.arguments())
+        self.assertEqual(basecalled_path, os.path.join(self.run_directory, "fastq_pass"))
+        self.assertEqual([item["status"] for item in results], [OK, OK])
+        results = check_barcodes(basecalled_path, sample_dict)
+        self.assertEqual([item["status"] for item in results], [OK, FAIL, FAIL])
+        self.assertIn("South BC02: 1 fastq files with only 0 bytes", results[1]["detail"])
+        self.assertIn("South BC03: no fastq files", results[2]["detail"])
+
+    def test_check_barcodes_flat_directory(self):
+        basecalled_path = os.path.join(self.run_directory, "flat")
+        os.mkdir(basecalled_path)
+        with open(os.path.join(basecalled_path, "FAK_pass_0.fastq"), "w") as f:
+            f.write("@r1\nACGT\n+\n!!!!\n")
+        results = check_barcodes(basecalled_path, {"North": ["BC01"], "South": ["BC02"]})
+        self.assertEqual([item["status"] for item in results], [OK, OK])
+
+    def test_check_run_missing_basecalled_path(self):
+        results, basecalled_path, sample_dict = check_run(self.arguments("-i", "missing"))
+        self.assertIsNone(basecalled_path)
+        self.assertEqual(results[0]["status"], FAIL)
+        self.assertIn("Basecalled path", results[0]["detail"])
+
+    def test_main_exits_on_failure(self):
+        with self.assertRaises(SystemExit) as out:
+            main(["-p", protocol, "-q", "analysis", "-d", self.run_directory, "-i", "fastq_pass", "--no_cache",
+                  "--samples", "South", "--json"])
+        self.assertEqual(out.exception.code, 1)
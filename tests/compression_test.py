@@ -0,0 +1,76 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from postbox.compression import *
+
+TEXT = "read_name,read_len\n" + "".join("read%d,%d\n" % (i, i) for i in range(1000))
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.stats = os.path.join(self.tmp_dir.name, "compression.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def round_trip(self, name):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open_file(path, "w", threads=2, stage="test", stats=self.stats) as f:
+            f.write(TEXT)
+        with open_file(path) as f:
+            self.assertEqual(f.read(), TEXT)
+        return path
+
+    def test_extensions(self):
+        self.assertEqual(compression_of("reads.fastq.zst"), "zstd")
+        self.assertEqual(compression_of("reads.fastq.gz"), "gzip")
+        self.assertIsNone(compression_of("reads.fastq"))
+        self.assertEqual(extension("zstd"), ".zst")
+        self.assertEqual(extension(None), "")
+        self.assertEqual(tool_extension("zstd"), ".gz")
+        self.assertEqual(tool_extension(None), "")
+
+    def test_open_file_gzip(self):
+        path = self.round_trip("report.csv.gz")
+        with gzip.open(path, "rt") as f:
+            self.assertEqual(f.read(), TEXT)
+        summary = summarise_stats(self.stats)
+        self.assertEqual(summary["test"]["files"], 1)
+        self.assertEqual(summary["test"]["bytes_in"], len(TEXT))
+        self.assertEqual(summary["test"]["bytes_out"], os.path.getsize(path))
+
+    @unittest.skipUnless(shutil.which("zstd"), "needs the zstd command")
+    def test_open_file_zstd(self):
+        self.round_trip("report.csv.zst")
+        self.assertEqual(summarise_stats(self.stats)["test"]["files"], 1)
+
+    def test_open_file_uncompressed(self):
+        self.round_trip("report.csv")
+        self.assertEqual(summarise_stats(self.stats), {})
+
+    def test_compress_stream(self):
+        source = os.path.join(self.tmp_dir.name, "mapped.paf")
+        with open(source, "w") as f:
+            f.write(TEXT)
+        output = source + ".gz"
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            self.assertEqual(compress_stream(fd, output, stage="minimap2", stats=self.stats), len(TEXT))
+        finally:
+            os.close(fd)
+        with gzip.open(output, "rt") as f:
+            self.assertEqual(f.read(), TEXT)
+
+    def test_summarise_stats_since(self):
+        record_stats(self.stats, "merge", "a.fastq.gz", 1000, 100, 0.5)
+        record_stats(self.stats, "merge", "b.fastq.gz", 1000, 300, 0.25)
+        with open(self.stats, "a") as f:
+            f.write('{"truncated')
+        summary = summarise_stats(self.stats)
+        self.assertEqual(summary, {"merge": {"files": 2, "bytes_in": 2000, "bytes_out": 400, "cpu_seconds": 0.75}})
+        self.assertEqual(summarise_stats(self.stats, since=time.time() + 60), {})
+        self.assertIn("80.0%", format_summary(summary))
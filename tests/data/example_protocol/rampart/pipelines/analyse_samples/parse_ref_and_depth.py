@@ -1,9 +1,10 @@
 import argparse
-from Bio import SeqIO
 from collections import OrderedDict
 from collections import Counter
 from collections import defaultdict
-import pandas as pd
+from postbox.reads import ReadBins, split_reads
+from postbox.compression import open_file, tool_extension
+from postbox.references import ReferenceStore
 # import matplotlib.pyplot as plt
 # import seaborn as sns
 import sys
@@ -19,102 +20,120 @@ def parse_args():
     parser.add_argument("--sample", action="store", type=str, dest="sample")
     parser.add_argument("--min_reads", action="store", type=int, dest="min_reads")
     parser.add_argument("--min_pcent", action="store", type=float, dest="min_pcent")
+    parser.add_argument("--exclude", action="store", type=str, dest="exclude", default="",
+                        help="Comma separated display names to count but never analyse")
 
     parser.add_argument("--output_path", action="store", type=str, dest="output_path")
+    parser.add_argument("--read_index", action="store", type=str, dest="read_index",
+                        help="Also save the byte offset of every read here, for later stages to seek to. --reads must be "
+                             "uncompressed")
+    parser.add_argument("--reference_store", action="store", type=str, dest="reference_store", default=None,
+                        help="postbox's store of the references, read instead of parsing --references")
+    parser.add_argument("--compression", action="store", type=str, dest="compression", default=None,
+                        help="Write the reads of each reference compressed, gzip or zstd (as gzip, for the tools)")
+    parser.add_argument("--compression_threads", action="store", type=int, dest="compression_threads", default=1)
+    parser.add_argument("--compression_stats", action="store", type=str, dest="compression_stats", default=None)
 
     return parser.parse_args()
 
 def make_ref_dict(references):
+    from Bio import SeqIO
     refs = {}
+    display_names = []
     for record in SeqIO.parse(references,"fasta"):
         refs[record.id]=record.seq
-    return refs
+        display_name = record.id
+        for field in record.description.split()[1:]:
+            if field.startswith("display_name="):
+                display_name = field.split("=", 1)[1]
+        if display_name not in display_names:
+            display_names.append(display_name)
+    return refs, display_names
 
-def count_and_return_analysis_dict(report,csv_out,sample):
+def count_and_return_analysis_dict(report,csv_out,sample,display_names,exclude,min_reads,min_pcent):
 
+    # one column per display name of the protocol's references, then unmapped (*) and ambiguous (?) reads
     counts = OrderedDict()
-    counts["Sabin1"]=0
-    counts["Sabin2"]=0
-    counts["Sabin3"]=0
-    counts["Poliovirus1-wt"]=0
-    counts["Poliovirus2-wt"]=0
-    counts["Poliovirus3-wt"]=0
-    counts["NonPolioEV"]=0
+    for display_name in display_names:
+        counts[display_name]=0
     counts["*"]=0
     counts["?"]=0
 
-    detail_dict= {
-        "Sabin1": Counter(),
-        "Sabin2": Counter(),
-        "Sabin3": Counter(),
-        "Poliovirus1-wt": Counter(),
-        "Poliovirus2-wt": Counter(),
-        "Poliovirus3-wt": Counter(),
-        "NonPolioEV": Counter(),
-        "*": Counter(),
-        "?": Counter()
-    }
+    detail_dict = defaultdict(Counter)
+    read_bins = ReadBins()
 
     total = 0
 
-    with open(str(report),"r") as f:
-        reader = csv.DictReader(f)
+    with open_file(str(report),"r",newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        name_column = header.index("read_name")
+        display_column = header.index("display_name")
+        reference_column = header.index("best_reference")
         for row in reader:
+            if not row:
+                continue
             total +=1
-            detail_dict[row["display_name"]][row["best_reference"]]+=1
-            counts[row["display_name"]]+=1
+            display_name = row[display_column]
+            detail_dict[display_name][row[reference_column]]+=1
+            counts[display_name] = counts.get(display_name, 0) + 1
+            if display_name not in exclude:
+                read_bins.add(row[name_column], display_name)
 
-    count_str = f"{sample},"
-    for i in counts:
-        count_str += f"{counts[i]},"
-    count_str = count_str.rstrip(',') + '\n'
-    csv_out.write(count_str)
+    labels = {"*": "Unmapped", "?": "AmbiguousMapping"}
+    csv_out.write("Sample," + ",".join(labels.get(i, i) for i in counts) + "\n")
+    csv_out.write(f"{sample}," + ",".join(str(counts[i]) for i in counts) + "\n")
 
     analysis_dict = {}
     for key in counts:
-        if key not in ['*',"?","NonPolioEV"]:
-            if counts[key] > args.min_reads and 100*(counts[key]/total)> args.min_pcent:
+        if key not in exclude:
+            if counts[key] > min_reads and 100*(counts[key]/total)> min_pcent:
             
                 top = detail_dict[key].most_common()[0]
                 analysis_dict[key] = (top[0],f">{key} best_reference={top[0]} num_reads={counts[key]}")
 
-    read_dict = defaultdict(list)
-
-    with open(str(report),"r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["display_name"] in analysis_dict:
-                read_dict[row["display_name"]].append(row["read_name"])
+    read_bins.select(analysis_dict)
     print(','.join(analysis_dict.keys()))
 
-    return analysis_dict, read_dict
+    return analysis_dict, read_bins
     
 
 if __name__ == '__main__':
 
     args = parse_args()
 
-    ref_dict = make_ref_dict(str(args.references))
+    store = None
+    if args.reference_store:
+        store = ReferenceStore(args.reference_store)
+        display_names = store.display_names()
+        sequence = store.sequence
+    else:
+        ref_dict, display_names = make_ref_dict(str(args.references))
+        sequence = lambda ref: ref_dict[ref]
+    exclude = {"*", "?"} | {name for name in args.exclude.split(",") if name}
 
     csv_report = open(str(args.out_counts), "w")
 
-    analysis_dict,read_dict = count_and_return_analysis_dict(args.csv, csv_report, args.sample)
+    analysis_dict,read_bins = count_and_return_analysis_dict(args.csv, csv_report, args.sample, display_names, exclude,
+                                                             args.min_reads, args.min_pcent)
 
+    read_files = {}
     for ref in analysis_dict:
         ref_file = args.output_path + "/" + ref + ".fasta"
         best_ref = analysis_dict[ref][0]
         header = analysis_dict[ref][1]
         with open(ref_file,"w") as fw:
-            fw.write(f"{header}\n{ref_dict[best_ref]}\n")
+            fw.write(f"{header}\n{sequence(best_ref)}\n")
+        if store is not None:
+            # the first mapping round uses the minimap2 index kept in the store, when there is one
+            store.link_target_index(best_ref, args.output_path + "/" + ref + ".mmi")
         
-        read_file = args.output_path + "/" + ref + ".fastq"
-        with open(read_file,"w") as fw:
-            records = []
-            for record in SeqIO.parse(args.reads,"fastq"):
-                if record.id in read_dict[ref]:
-                    records.append(record)
-
-            SeqIO.write(records, fw, "fastq")
+        read_files[ref] = args.output_path + "/" + ref + ".fastq" + tool_extension(args.compression)
+
+    # one pass over the reads writes the fastq of every reference
+    if read_files or args.read_index:
+        split_reads(args.reads, read_bins, read_files, index_path=args.read_index,
+                    threads=args.compression_threads, stats=args.compression_stats)
 
     csv_report.close()
 
@@ -1,5 +1,5 @@
-from Bio import SeqIO
-from Bio import AlignIO
+from postbox.alignment import Alignment
+from postbox.compression import open_file
 import sys
 import argparse
 
@@ -15,46 +15,26 @@ if args.round:
     round_name = f" round_name={args.round}"
 
 def trim_trailing_gaps(alignment):
-    for col in range(alignment.get_alignment_length()):
-        if not "-" in alignment[:, col]:
-            start_position = col
-            break
+    start_position, end_position = alignment.trailing_gaps()
 
-    for col in range(alignment.get_alignment_length()):
-        end_index = col+1
-        if not "-" in alignment[:, -end_index]:
-            end_position = col
-            break
+    print(f"\nTrimming trailing gaps in alignment.\nAlignment now from {start_position} to {len(alignment)-end_position}.\n")   
 
-    print(f"\nTrimming trailing gaps in alignment.\nAlignment now from {start_position} to {alignment.get_alignment_length()-end_position}.\n")   
-
-    if end_position == 0:
-        return alignment[:,start_position:]
-    else:
-        return alignment[:,start_position:-end_position]
+    return alignment.trim_trailing_gaps()
 
 def remove_gaps(aln):
 
-    untrimmed_alignment = AlignIO.read(aln, "fasta")
+    untrimmed_alignment = Alignment.from_fasta(aln)
     trimmed = trim_trailing_gaps(untrimmed_alignment)
     
     print(f"Reading in {aln}.\n\nGaps found:")
-    cns_string = ""
-    for i in range(len(trimmed[0])):
-        col = trimmed[:,i]
-        if len(set(col))>1 and '-' in col:
-            print(f"Position {i+1}:\tReference:\t{col[0]}\tConsensus:\t{col[1]}")
-            if col[0] == '-':
-                pass
-            else:
-                cns_string += 'N'
-        else:
-            cns_string+= col[1]
-
-    return trimmed[1].id, cns_string
+    reference, consensus = trimmed.row(0), trimmed.row(1)
+    for i in trimmed.gap_positions():
+        print(f"Position {i+1}:\tReference:\t{reference[i]}\tConsensus:\t{consensus[i]}")
+
+    return trimmed.ids[1], trimmed.remove_gaps()
 
 #the rule is to replace a gap in the query with 'N' and to force delete a base that causes a gap in the reference
-with open(args.output_seq, "w") as fw:
+with open_file(args.output_seq, "w") as fw:
 
     cns_id, new_consensus = remove_gaps(args.alignment)
 
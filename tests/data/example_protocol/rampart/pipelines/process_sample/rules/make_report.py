@@ -1,5 +1,4 @@
-from Bio import SeqIO
-from Bio import AlignIO
+from postbox.alignment import Alignment
 import sys
 import argparse
 
@@ -13,20 +12,18 @@ def parse_args():
     return parser.parse_args()
 
 def get_snp_locs(aln, outfile):
-    alignment = AlignIO.read(aln, "fasta")
-    outfile.write(f"Closest reference in the database is:\t{alignment[0].id}\n")
+    alignment = Alignment.from_fasta(aln)
+    outfile.write(f"Closest reference in the database is:\t{alignment.ids[0]}\n")
     print(f"Reading in {aln}.")
-    outfile.write(f"Length of alignment is:\t{len(alignment[0])}\n\n")
+    outfile.write(f"Length of alignment is:\t{len(alignment)}\n\n")
     
+    reference, consensus = alignment.row(0), alignment.row(1)
     snps = 0
-    for i in range(len(alignment[0])):
-        col = alignment[:,i]
-        if len(set(col))>1:
-            if 'N' not in col and '-' not in col:
-                fw.write(f"Position {i+1}:\tReference:\t{col[0]}\tConsensus:\t{col[1]}\n")
-                snps+=1
+    for i in alignment.snp_positions():
+        outfile.write(f"Position {i+1}:\tReference:\t{reference[i]}\tConsensus:\t{consensus[i]}\n")
+        snps+=1
 
-    fw.write(f"\nTotal number of snps from {alignment[0].id}:\t{snps}\n\n")
+    outfile.write(f"\nTotal number of snps from {alignment.ids[0]}:\t{snps}\n\n")
 
 if __name__ == '__main__':
 
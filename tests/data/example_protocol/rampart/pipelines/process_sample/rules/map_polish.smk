@@ -1,16 +1,49 @@
+import os
+import shlex
+from postbox.compression import tool_extension
+
+# with postbox --compress, reads and mappings are gzip, the one compression minimap2, racon and medaka all read
+tool_ext = tool_extension(config.get("compression"))
+
+def write_output(stage):
+    '''
+    The end of a shell command writing its stdout to the rule's output, compressed when the output is.
+    '''
+    if not tool_ext:
+        return "> {output}"
+    command = "| python -m postbox.compression compress --output {output} --threads %d --stage %s" % (
+        config.get("compression_threads", 1), stage)
+    if config.get("compression_stats"):
+        command += " --stats %s" % shlex.quote(config["compression_stats"])
+    return command
+
+def reference_index(wildcards, input):
+    '''
+    The minimap2 index parse_ref_and_depth.py linked from postbox's reference store next to the reference of an
+    analysis stem, or the reference itself when there is none.
+    '''
+    index = os.path.splitext(str(input.ref))[0] + ".mmi"
+    return index if os.path.exists(index) else input.ref
+
 rule files:
     params:
         ref=config["output_path"] + "/binned_{sample}/{analysis_stem}.fasta",
-        reads=config["output_path"]+"/binned_{sample}/{analysis_stem}.fastq"
+        reads=config["output_path"]+"/binned_{sample}/{analysis_stem}.fastq" + tool_ext
 
 rule minimap2_racon0:
     input:
         reads=rules.files.params.reads,
         ref=rules.files.params.ref
+    params:
+        index=reference_index
     output:
-        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.paf"
+        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.paf" + tool_ext
+    threads:
+        config.get("minimap2_threads", 1)
+    resources:
+        mem_mb=config.get("minimap2_mem_mb", 600)
     shell:
-        "minimap2 -x map-ont {input.ref} {input.reads} > {output}"
+        "minimap2 -t {threads} -x map-ont {params.index} {input.reads} " + write_output("minimap2")
 
 rule racon1:
     input:
@@ -19,8 +52,12 @@ rule racon1:
         paf= rules.minimap2_racon0.output
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon1.fasta"
+    threads:
+        config.get("racon_threads", 1)
+    resources:
+        mem_mb=config.get("racon_mem_mb", 700)
     shell:
-        "racon --no-trimming -t 1 {input.reads} {input.paf} {input.fasta} > {output}"
+        "racon --no-trimming -t {threads} {input.reads} {input.paf} {input.fasta} > {output}"
 
 rule mafft1:
     input:
@@ -30,9 +67,13 @@ rule mafft1:
         temp_file = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/temp.racon1.fasta"
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon1.aln.fasta"
+    threads:
+        config.get("mafft_threads", 1)
+    resources:
+        mem_mb=config.get("mafft_mem_mb", 250)
     shell:
         "cat {input.ref} {input.fasta} > {params.temp_file} && "
-        "mafft {params.temp_file} > {output} && "
+        "mafft --thread {threads} {params.temp_file} > {output} && "
         "rm {params.temp_file}"
 
 rule clean1:
@@ -56,9 +97,13 @@ rule minimap2_racon1:
         reads=rules.files.params.reads,
         ref= rules.clean1.output
     output:
-        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon1.paf"
+        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon1.paf" + tool_ext
+    threads:
+        config.get("minimap2_threads", 1)
+    resources:
+        mem_mb=config.get("minimap2_mem_mb", 600)
     shell:
-        "minimap2 -x map-ont {input.ref} {input.reads} > {output}"
+        "minimap2 -t {threads} -x map-ont {input.ref} {input.reads} " + write_output("minimap2")
 
 rule racon2:
     input:
@@ -67,8 +112,12 @@ rule racon2:
         paf= rules.minimap2_racon1.output
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon2.fasta"
+    threads:
+        config.get("racon_threads", 1)
+    resources:
+        mem_mb=config.get("racon_mem_mb", 700)
     shell:
-        "racon --no-trimming -t 1 {input.reads} {input.paf} {input.fasta} > {output}"
+        "racon --no-trimming -t {threads} {input.reads} {input.paf} {input.fasta} > {output}"
 
 
 rule mafft2:
@@ -79,9 +128,13 @@ rule mafft2:
         temp_file = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/temp.racon2.fasta"
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon2.aln.fasta"
+    threads:
+        config.get("mafft_threads", 1)
+    resources:
+        mem_mb=config.get("mafft_mem_mb", 250)
     shell:
         "cat {input.ref} {input.fasta} > {params.temp_file} && "
-        "mafft {params.temp_file} > {output} && "
+        "mafft --thread {threads} {params.temp_file} > {output} && "
         "rm {params.temp_file}"
 
 rule clean2:
@@ -105,9 +158,13 @@ rule minimap2_racon2:
         reads=rules.files.params.reads,
         ref= rules.clean2.output
     output:
-        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon2.paf"
+        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon2.paf" + tool_ext
+    threads:
+        config.get("minimap2_threads", 1)
+    resources:
+        mem_mb=config.get("minimap2_mem_mb", 600)
     shell:
-        "minimap2 -x map-ont {input.ref} {input.reads} > {output}"
+        "minimap2 -t {threads} -x map-ont {input.ref} {input.reads} " + write_output("minimap2")
 
 rule racon3:
     input:
@@ -116,8 +173,12 @@ rule racon3:
         paf= rules.minimap2_racon2.output
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon3.fasta"
+    threads:
+        config.get("racon_threads", 1)
+    resources:
+        mem_mb=config.get("racon_mem_mb", 700)
     shell:
-        "racon --no-trimming -t 1 {input.reads} {input.paf} {input.fasta} > {output}"
+        "racon --no-trimming -t {threads} {input.reads} {input.paf} {input.fasta} > {output}"
 
 rule mafft3:
     input:
@@ -127,9 +188,13 @@ rule mafft3:
         temp_file = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/temp.racon3.fasta"
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon3.aln.fasta"
+    threads:
+        config.get("mafft_threads", 1)
+    resources:
+        mem_mb=config.get("mafft_mem_mb", 250)
     shell:
         "cat {input.ref} {input.fasta} > {params.temp_file} && "
-        "mafft {params.temp_file} > {output} && "
+        "mafft --thread {threads} {params.temp_file} > {output} && "
         "rm {params.temp_file}"
 
 rule clean3:
@@ -154,9 +219,13 @@ rule minimap2_racon3:
         reads=rules.files.params.reads,
         ref= rules.clean3.output
     output:
-        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon3.paf"
+        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon3.paf" + tool_ext
+    threads:
+        config.get("minimap2_threads", 1)
+    resources:
+        mem_mb=config.get("minimap2_mem_mb", 600)
     shell:
-        "minimap2 -x map-ont {input.ref} {input.reads} > {output}"
+        "minimap2 -t {threads} -x map-ont {input.ref} {input.reads} " + write_output("minimap2")
 
 rule racon4:
     input:
@@ -165,8 +234,12 @@ rule racon4:
         paf= rules.minimap2_racon3.output
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon4.fasta"
+    threads:
+        config.get("racon_threads", 1)
+    resources:
+        mem_mb=config.get("racon_mem_mb", 700)
     shell:
-        "racon --no-trimming -t 1 {input.reads} {input.paf} {input.fasta} > {output}"
+        "racon --no-trimming -t {threads} {input.reads} {input.paf} {input.fasta} > {output}"
 
 rule mafft4:
     input:
@@ -176,9 +249,13 @@ rule mafft4:
         temp_file = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/temp.racon4.fasta"
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/racon4.aln.fasta"
+    threads:
+        config.get("mafft_threads", 1)
+    resources:
+        mem_mb=config.get("mafft_mem_mb", 250)
     shell:
         "cat {input.ref} {input.fasta} > {params.temp_file} && "
-        "mafft {params.temp_file} > {output} && "
+        "mafft --thread {threads} {params.temp_file} > {output} && "
         "rm {params.temp_file}"
 
 rule clean4:
@@ -202,22 +279,54 @@ rule minimap2_racon4:
         reads=rules.files.params.reads,
         ref= rules.clean4.output
     output:
-        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon4.paf"
+        config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/mapped.racon4.paf" + tool_ext
+    threads:
+        config.get("minimap2_threads", 1)
+    resources:
+        mem_mb=config.get("minimap2_mem_mb", 600)
+    shell:
+        "minimap2 -t {threads} -x map-ont {input.ref} {input.reads} " + write_output("minimap2")
+
+rule polish:
+    input:
+        reads=rules.files.params.reads,
+        ref=rules.files.params.ref
+    params:
+        seq_name = "{analysis_stem}",
+        rounds = config.get("polish_rounds", 4),
+        index = reference_index
+    output:
+        fasta = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/polished.fasta",
+        manifest = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/manifest.json"
+    threads:
+        config.get("racon_threads", 1)
+    resources:
+        mem_mb=config.get("racon_mem_mb", 700)
     shell:
-        "minimap2 -x map-ont {input.ref} {input.reads} > {output}"
+        "python -m postbox.polish "
+        "--reads {input.reads} "
+        "--reference {input.ref} "
+        "--index {params.index} "
+        "--name {params.seq_name} "
+        "--rounds {params.rounds} "
+        "--threads {threads} "
+        "--output {output.fasta} "
+        "--manifest {output.manifest}"
 
 rule medaka:
     input:
         basecalls=rules.files.params.reads,
-        draft= rules.clean4.output
+        draft= rules.polish.output.fasta if config.get("polish_in_process") else rules.clean4.output
     params:
         outdir=config["output_path"] + "/binned_{sample}/medaka/{analysis_stem}"
     output:
         config["output_path"] + "/binned_{sample}/medaka/{analysis_stem}/consensus.fasta"
     threads:
-        2
+        config.get("medaka_threads", 2)
+    resources:
+        mem_mb=config.get("medaka_mem_mb", 5000)
     shell:
-        "medaka_consensus -i {input.basecalls} -d {input.draft} -o {params.outdir} -t 2 || touch {output}"
+        "medaka_consensus -i {input.basecalls} -d {input.draft} -o {params.outdir} -t {threads} || touch {output}"
 
 rule mafft5:
     input:
@@ -227,9 +336,13 @@ rule mafft5:
         temp_file = config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/temp.medaka.fasta"
     output:
         config["output_path"] + "/binned_{sample}/polishing/{analysis_stem}/medaka.aln.fasta"
+    threads:
+        config.get("mafft_threads", 1)
+    resources:
+        mem_mb=config.get("mafft_mem_mb", 250)
     shell:
         "cat {input.ref} {input.fasta} > {params.temp_file} && "
-        "mafft {params.temp_file} > {output} && "
+        "mafft --thread {threads} {params.temp_file} > {output} && "
         "rm {params.temp_file}"
 
 rule clean5:
@@ -250,9 +363,10 @@ rule clean5:
 
 rule gather_files:
     input:
-        expand(config["output_path"] +  "/binned_{{sample}}/{analysis_stem}.consensus.fasta", analysis_stem=config["analysis_stem"])
+        lambda wildcards: expand(config["output_path"] + "/binned_{sample}/{analysis_stem}.consensus.fasta",
+                                 sample=wildcards.sample, analysis_stem=analysis_stems(wildcards))
     output:
         config["output_path"] + "/consensus_sequences/{sample}.fasta"
     shell:
-        "cat {input} > {output}"
+        "cat /dev/null {input} > {output}"
 
@@ -0,0 +1,26 @@
+import os
+import unittest
+
+from postbox.engine import *
+
+try:
+    import snakemake
+    has_snakemake_api = hasattr(snakemake, "snakemake")
+except ImportError:
+    has_snakemake_api = False
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(this_dir, 'tests', 'data')
+
+@unittest.skipUnless(has_snakemake_api, "snakemake API not available")
+class TestEngine(unittest.TestCase):
+    def test_config_list_to_dict_matches_command_line_parsing(self):
+        config_list = ["basecalled_path=/path/to/fastq_pass", "min_reads=50", "min_pcent=0.01"]
+        expected = {"basecalled_path": "/path/to/fastq_pass", "min_reads": 50, "min_pcent": 0.01}
+        config = config_list_to_dict(config_list)
+        self.assertEqual(config, expected)
+
+    def test_run_api_fails_on_missing_snakefile(self):
+        pipeline_dict = {"path": "%s/idontexist/Snakefile" % data_dir, "config_file": None}
+        with self.assertRaises(Error):
+            run_api(pipeline_dict, [], 1, dry_run=True)
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from postbox.executors import *
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_submit_and_claim_in_order(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queue = JobQueue(os.path.join(tmp_dir, "queue.db"))
+            first = queue.submit(Job("North", "true", cwd=tmp_dir, cores=2))
+            second = queue.submit(Job("South", "true", cwd=tmp_dir, cores=2))
+            self.assertEqual(queue.job(first)["status"], QUEUED)
+            self.assertEqual(queue.job(first)["log_file"], os.path.join(tmp_dir, "queue.logs", "%d.log" % first))
+            self.assertEqual(queue.claim("node1", 4)["id"], first)
+            self.assertEqual(queue.claim("node2", 4)["id"], second)
+            self.assertIsNone(queue.claim("node3", 4))
+            self.assertEqual(queue.job(first)["worker"], "node1")
+
+    def test_claim_respects_resources(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queue = JobQueue(os.path.join(tmp_dir, "queue.db"))
+            big = queue.submit(Job("big", "true", cores=8, mem_mb=32000))
+            small = queue.submit(Job("small", "true", cores=2, mem_mb=4000))
+            self.assertEqual(queue.claim("node1", 4, 8000)["id"], small)
+            self.assertIsNone(queue.claim("node1", 2, 4000))
+            # an idle worker takes a job bigger than itself rather than leave it queued for ever
+            self.assertEqual(queue.claim("node2", 4, 8000, idle=True)["id"], big)
+
+    def test_finish_and_cancel(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queue = JobQueue(os.path.join(tmp_dir, "queue.db"))
+            done = queue.submit(Job("done", "true"))
+            queued = queue.submit(Job("queued", "true"))
+            queue.claim("node1", 1)
+            queue.finish(done, 3)
+            self.assertEqual((queue.job(done)["status"], queue.job(done)["return_code"]), (FAILED, 3))
+            queue.cancel(queued)
+            self.assertEqual(queue.job(queued)["status"], CANCELLED)
+
+            running = queue.submit(Job("running", "true"))
+            queue.claim("node1", 1)
+            queue.cancel(running)
+            self.assertEqual(queue.cancelled([running]), [running])
+            queue.finish(running, -15)
+            self.assertEqual(queue.job(running)["status"], CANCELLED)
+
+    def test_requeue_lost(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queue = JobQueue(os.path.join(tmp_dir, "queue.db"))
+            job_id = queue.submit(Job("North", "true"))
+            queue.heartbeat("node1", 4)
+            queue.claim("node1", 4)
+            self.assertEqual(queue.requeue_lost(60), 0)
+            self.assertEqual(queue.requeue_lost(-1), 1)
+            self.assertEqual(queue.job(job_id)["status"], QUEUED)
+            self.assertEqual(queue.claim("node2", 4)["attempts"], 1)
+            self.assertEqual(queue.job(job_id)["attempts"], 2)
+
+class TestWorker(unittest.TestCase):
+    def test_run_worker(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            queue = JobQueue(os.path.join(tmp_dir, "queue.db"))
+            ok = queue.submit(Job("North", "echo hello; pwd", cwd=tmp_dir, cores=2))
+            failed = queue.submit(Job("South", "echo oops; exit 2", cwd=tmp_dir, cores=2,
+                                      log_file=os.path.join(tmp_dir, "South.log")))
+            done = run_worker(queue, 4, poll_interval=0.05, exit_when_idle=True, name="node1")
+            self.assertEqual(sorted(done), [ok, failed])
+            self.assertEqual(queue.job(ok)["status"], SUCCESS)
+            self.assertEqual(read_log(queue.job(ok)["log_file"]), ["hello\n", os.path.realpath(tmp_dir) + "\n"])
+            self.assertEqual((queue.job(failed)["status"], queue.job(failed)["return_code"]), (FAILED, 2))
+            self.assertEqual(read_log(os.path.join(tmp_dir, "South.log")), ["oops\n"])
+
+class TestExecutors(unittest.TestCase):
+    def test_queue_executor(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            executor = QueueExecutor(os.path.join(tmp_dir, "queue.db"), poll_interval=0.05)
+            stop = threading.Event()
+            worker = threading.Thread(target=run_worker, args=(executor.queue, 2),
+                                      kwargs={"poll_interval": 0.05, "stop": stop})
+            log_file = os.path.join(tmp_dir, "North.log")
+            with open(log_file, "w") as f:
+                f.write("an earlier attempt\n")
+            lines = []
+            job = Job("North", "echo one; echo two", cwd=tmp_dir, log_file=log_file)
+            worker.start()
+            self.assertEqual(executor.run(job, line_callback=lines.append), 0)
+            self.assertEqual(lines, ["one", "two"])
+
+            with self.assertRaises(SnakemakeError):
+                executor.run(Job("South", "exit 1", cwd=tmp_dir))
+            stop.set()
+            worker.join()
+            self.assertEqual(executor.queue.jobs([QUEUED, RUNNING]), [])
+
+    def test_pool_executor(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            executor = PoolExecutor(2)
+            try:
+                lines = []
+                log_file = os.path.join(tmp_dir, "North.log")
+                self.assertEqual(executor.run(Job("North", "echo one", log_file=log_file),
+                                              line_callback=lines.append), 0)
+                self.assertEqual(lines, ["one"])
+                self.assertTrue(read_log(log_file)[-1].endswith(" one\n"))
+                with self.assertRaises(SnakemakeError):
+                    executor.run(Job("South", "exit 1"))
+            finally:
+                executor.close()
+
+    def test_local_executor(self):
+        lines = []
+        self.assertEqual(LocalExecutor().run(Job("North", "echo one"), line_callback=lines.append), 0)
+        self.assertEqual(lines, ["one"])
+        with self.assertRaises(SnakemakeError):
+            LocalExecutor().run(Job("South", "exit 1"))
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import unittest
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# generous enough for a loaded cluster node, but far below what pandas or pkg_resources cost on their own
+IMPORT_BUDGET_US = 200000
+
+
+def import_times(module):
+    '''
+    Run python -X importtime on module and return {imported module: cumulative microseconds}.
+    '''
+    command = [sys.executable, "-X", "importtime", "-c", "import %s" % module]
+    # the first run may have to write bytecode, so measure the second
+    for i in range(2):
+        result = subprocess.run(command, cwd=this_dir, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+class TestImportTime(unittest.TestCase):
+    def test_import_does_not_load_heavy_modules(self):
+        times = import_times("postbox.postbox")
+        for heavy in ["pandas", "numpy", "pkg_resources", "snakemake", "importlib.metadata"]:
+            self.assertNotIn(heavy, times)
+
+    def test_import_within_budget(self):
+        times = import_times("postbox.postbox")
+        total = times["postbox"] + times["postbox.postbox"]
+        self.assertLess(total, IMPORT_BUDGET_US)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from postbox.incremental import *
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(text)
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.run_directory = self.tmp_dir.name
+        self.basecalled_path = os.path.join(self.run_directory, "fastq_pass")
+        write("%s/barcode01/a.fastq" % self.basecalled_path, "@r1\nACGT\n+\n!!!!\n")
+        write("%s/barcode02/a.fastq" % self.basecalled_path, "@r2\nACGT\n+\n!!!!\n")
+        self.sample_dict = {"North": ["BC01"], "South": ["BC02"]}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_only_changed_samples_are_selected(self):
+        fingerprints = sample_fingerprints(self.basecalled_path, self.sample_dict)
+        self.assertEqual(changed_samples(fingerprints, load_fingerprints(self.run_directory)), ["North", "South"])
+        save_fingerprints(self.run_directory, fingerprints)
+
+        fingerprints = sample_fingerprints(self.basecalled_path, self.sample_dict)
+        self.assertEqual(changed_samples(fingerprints, load_fingerprints(self.run_directory)), [])
+
+        write("%s/barcode02/b.fastq" % self.basecalled_path, "@r3\nACGT\n+\n!!!!\n")
+        fingerprints = sample_fingerprints(self.basecalled_path, self.sample_dict)
+        self.assertEqual(changed_samples(fingerprints, load_fingerprints(self.run_directory)), ["South"])
+
+    def test_flat_directory_changes_every_sample(self):
+        basecalled_path = os.path.join(self.run_directory, "flat")
+        write("%s/FAK_pass_0.fastq" % basecalled_path, "@r1\nACGT\n+\n!!!!\n")
+        save_fingerprints(self.run_directory, sample_fingerprints(basecalled_path, self.sample_dict))
+
+        write("%s/FAK_pass_1.fastq" % basecalled_path, "@r2\nACGT\n+\n!!!!\n")
+        fingerprints = sample_fingerprints(basecalled_path, self.sample_dict)
+        self.assertEqual(changed_samples(fingerprints, load_fingerprints(self.run_directory)), ["North", "South"])
+
+    def test_save_fingerprints_keeps_other_samples(self):
+        save_fingerprints(self.run_directory, {"North": "a"})
+        save_fingerprints(self.run_directory, {"South": "b"})
+        self.assertEqual(load_fingerprints(self.run_directory), {"North": "a", "South": "b"})
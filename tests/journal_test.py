@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+
+from postbox.journal import *
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.run_directory = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_completed_samples(self):
+        journal = Journal(self.run_directory)
+        self.assertIsNone(journal.completed_samples())
+        journal.record("run_start", samples=["North", "South", "East"])
+        journal.record("sample_success", sample="North")
+        journal.record("sample_failure", sample="South", attempt=1, error="killed")
+        self.assertEqual(journal.completed_samples(), {"North"})
+
+        # a failed run can be resumed too, and the resume adds to what is finished
+        journal.record("run_end", status="failed")
+        journal.record("run_resume", samples=["South", "East"])
+        journal.record("sample_success", sample="East")
+        self.assertEqual(Journal(self.run_directory).completed_samples(), {"North", "East"})
+
+        journal.record("sample_success", sample="South")
+        journal.record("run_end", status="success")
+        self.assertIsNone(journal.completed_samples())
+
+    def test_truncated_line_is_skipped(self):
+        journal = Journal(self.run_directory)
+        journal.record("run_start", samples=["North"])
+        with open(journal.path, "a") as f:
+            f.write('{"event": "sample_succ')
+        self.assertEqual([entry["event"] for entry in journal.entries()], ["run_start"])
+
+    def test_stage_recorder(self):
+        journal = Journal(self.run_directory)
+        feed = journal.stage_recorder("North")
+        for line in ["", "rule racon1:", "    jobid: 4", "    wildcards: analysis_stem=Sabin1", "",
+                     "rule mafft1:", "    jobid: 5", "", "Finished job 4.", "Error in rule mafft1:", "    jobid: 5",
+                     ""]:
+            feed(line)
+        stages = [(entry["rule"], entry["status"], entry["wildcards"]) for entry in journal.entries()]
+        self.assertEqual(stages, [("racon1", "finished", "analysis_stem=Sabin1"), ("mafft1", "failed", "")])
+
+    def test_run_lock(self):
+        with RunLock(self.run_directory) as lock:
+            self.assertFalse(RunLock(self.run_directory).acquire())
+            with self.assertRaises(SystemExit) as out:
+                with RunLock(self.run_directory, timeout=0.1):
+                    pass
+            self.assertIn("pid %d" % os.getpid(), str(out.exception))
+        other = RunLock(self.run_directory)
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_retry(self):
+        calls, failures, delays = [], [], []
+
+        def flaky(attempt):
+            calls.append(attempt)
+            if attempt < 3:
+                raise RuntimeError("attempt %d" % attempt)
+            return "done"
+
+        self.assertEqual(retry(flaky, 3, 10, lambda attempt, e: failures.append(str(e)), sleep=delays.append),
+                         "done")
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual(failures, ["attempt 1", "attempt 2"])
+        self.assertEqual(delays, [10, 20])
+        with self.assertRaises(RuntimeError):
+            retry(flaky, 2, 0, sleep=delays.append)
+
+    def test_retry_only_given_errors(self):
+        calls = []
+
+        def broken(attempt):
+            calls.append(attempt)
+            raise ValueError("bad config")
+
+        with self.assertRaises(ValueError):
+            retry(broken, 3, 10, sleep=lambda delay: None, retry_on=RuntimeError)
+        self.assertEqual(calls, [1])
@@ -0,0 +1,98 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from postbox.manifest import *
+
+READ = "@r\nACGT\n+\n!!!!\n"
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.run_directory = self.tmp_dir.name
+        self.basecalled_path = os.path.join(self.run_directory, "fastq_pass")
+        write("%s/barcode01/a.fastq" % self.basecalled_path, READ * 3)
+        write("%s/barcode02/a.fastq" % self.basecalled_path, READ)
+        with gzip.open("%s/barcode02/b.fastq.gz" % self.basecalled_path, "wt") as f:
+            f.write(READ * 2)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_update_manifest(self):
+        entries, changed = update_manifest(self.basecalled_path, threads=2)
+        self.assertEqual(changed, 3)
+        self.assertEqual(entries["barcode01/a.fastq"]["reads"], 3)
+        self.assertEqual(entries["barcode02/b.fastq.gz"]["reads"], 2)
+        self.assertEqual(entries["barcode02/a.fastq"]["barcode"], "barcode02")
+
+        write("%s/barcode01/b.fastq" % self.basecalled_path, READ)
+        entries, changed = update_manifest(self.basecalled_path, entries)
+        self.assertEqual(changed, 1)
+        self.assertEqual(len(entries), 4)
+
+    def test_only_selected_barcodes_counted(self):
+        entries, changed = update_manifest(self.basecalled_path, barcodes=["BC02"])
+        self.assertEqual(changed, 3)
+        self.assertIsNone(entries["barcode01/a.fastq"]["reads"])
+        self.assertEqual(entries["barcode02/b.fastq.gz"]["reads"], 2)
+
+        # a later run selecting the other barcode counts its files then
+        entries, changed = update_manifest(self.basecalled_path, entries, barcodes=["BC01"])
+        self.assertEqual(changed, 1)
+        self.assertEqual(entries["barcode01/a.fastq"]["reads"], 3)
+        self.assertEqual(entries["barcode02/b.fastq.gz"]["reads"], 2)
+
+        path = manifest_path(self.run_directory)
+        save_manifest(path, self.basecalled_path, dict(entries, **{"barcode03/a.fastq": dict(
+            entries["barcode01/a.fastq"], barcode="barcode03", reads=None)}))
+        self.assertIsNone(load_manifest(path)[1]["barcode03/a.fastq"]["reads"])
+
+    def test_run_manifest_is_saved_and_reused(self):
+        path, entries = update_run_manifest(self.run_directory, self.basecalled_path)
+        self.assertEqual(path, os.path.join(self.run_directory, ".postbox", "manifest.tsv"))
+        self.assertEqual(load_manifest(path), (self.basecalled_path, entries))
+
+        # counts are taken from the manifest for unchanged files
+        entries["barcode01/a.fastq"]["reads"] = 30
+        save_manifest(path, self.basecalled_path, entries)
+        path, entries = update_run_manifest(self.run_directory, self.basecalled_path)
+        self.assertEqual(entries["barcode01/a.fastq"]["reads"], 30)
+        # but not if the manifest was built for another directory
+        save_manifest(path, "/elsewhere", entries)
+        path, entries = update_run_manifest(self.run_directory, self.basecalled_path)
+        self.assertEqual(entries["barcode01/a.fastq"]["reads"], 3)
+        self.assertEqual(load_manifest(os.path.join(self.run_directory, "missing.tsv")), (None, {}))
+
+    def test_link_barcode_files(self):
+        path, entries = update_run_manifest(self.run_directory, self.basecalled_path)
+        self.assertEqual(sorted(barcode_entries(entries, ["NB02"])), ["barcode02/a.fastq", "barcode02/b.fastq.gz"])
+        directory = os.path.join(self.run_directory, "binned", "temp", "reads")
+        self.assertEqual(link_barcode_files(path, ["BC02"], directory), 2)
+        self.assertEqual(os.listdir(directory), ["barcode02"])
+        self.assertEqual(os.path.realpath(os.path.join(directory, "barcode02", "a.fastq")),
+                         os.path.realpath("%s/barcode02/a.fastq" % self.basecalled_path))
+
+    def test_flat_directory_linked_whole(self):
+        # binlorry assigns the reads of a flat directory to barcodes from their annotations
+        basecalled_path = os.path.join(self.run_directory, "flat")
+        write("%s/FAK_pass_0.fastq" % basecalled_path, READ * 2)
+        write("%s/FAK_pass_1.fastq" % basecalled_path, READ)
+        path, entries = update_run_manifest(self.run_directory, basecalled_path, barcodes=["BC01"])
+        self.assertIsNone(entries["FAK_pass_0.fastq"]["barcode"])
+        self.assertEqual(entries["FAK_pass_0.fastq"]["reads"], 2)
+        directory = os.path.join(self.run_directory, "binned", "temp", "reads")
+        self.assertEqual(link_barcode_files(path, ["BC01"], directory), 2)
+        self.assertEqual(sorted(os.listdir(directory)), ["FAK_pass_0.fastq", "FAK_pass_1.fastq"])
+
+    def test_manifest_files(self):
+        path, entries = update_run_manifest(self.run_directory, self.basecalled_path)
+        files = manifest_files(self.basecalled_path, entries)
+        self.assertEqual(files["%s/barcode01/a.fastq" % self.basecalled_path][0], len(READ) * 3)
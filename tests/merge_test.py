@@ -0,0 +1,95 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from postbox.merge import *
+from postbox.compression import summarise_stats
+
+HEADER = "read_name,read_len,barcode\n"
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_prefix = os.path.join(self.tmp_dir.name, "binned")
+        self.output_prefix = os.path.join(self.tmp_dir.name, "sample")
+        for barcode in ["BC01", "BC02", "BC03"]:
+            write("%s_%s.fastq" % (self.input_prefix, barcode), "@%s\nACGT\n+\n!!!!\n" % barcode)
+            write("%s_%s.csv" % (self.input_prefix, barcode), HEADER + "%s,4,%s\n" % (barcode, barcode))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_copy_fd_offset(self):
+        source = os.path.join(self.tmp_dir.name, "source")
+        output = os.path.join(self.tmp_dir.name, "output")
+        write(source, "header\nbody\n")
+        in_fd, out_fd = os.open(source, os.O_RDONLY), open_output(output)
+        try:
+            copy_fd(in_fd, out_fd, 7, 5)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+        self.assertEqual(read(output), "body\n")
+
+    def test_merge_sample_single_barcode_is_linked(self):
+        self.assertEqual(merge_sample(self.input_prefix, self.output_prefix, "North", ["BC01"]), "link")
+        reads = "%s_North.fastq" % self.output_prefix
+        self.assertTrue(os.path.samefile(reads, "%s_BC01.fastq" % self.input_prefix))
+        # the link outlives the per barcode file, which snakemake deletes as a temp file
+        os.remove("%s_BC01.fastq" % self.input_prefix)
+        self.assertEqual(read(reads), "@BC01\nACGT\n+\n!!!!\n")
+        self.assertEqual(read("%s_North.csv" % self.output_prefix), HEADER + "BC01,4,BC01\n")
+
+    def test_merge_sample_pooled(self):
+        self.assertEqual(merge_sample(self.input_prefix, self.output_prefix, "South", ["BC02", "BC03"]), "merge")
+        self.assertEqual(read("%s_South.fastq" % self.output_prefix),
+                         "@BC02\nACGT\n+\n!!!!\n@BC03\nACGT\n+\n!!!!\n")
+        self.assertEqual(read("%s_South.csv" % self.output_prefix), HEADER + "BC02,4,BC02\nBC03,4,BC03\n")
+
+    def test_merge_sample_compressed(self):
+        stats = os.path.join(self.tmp_dir.name, "compression.jsonl")
+        self.assertEqual(merge_sample(self.input_prefix, self.output_prefix, "South", ["BC02", "BC03"], "gzip",
+                                      stats=stats), "compress")
+        with gzip.open("%s_South.csv.gz" % self.output_prefix, "rt") as f:
+            self.assertEqual(f.read(), HEADER + "BC02,4,BC02\nBC03,4,BC03\n")
+        self.assertEqual(merge_sample(self.input_prefix, self.output_prefix, "North", ["BC01"], "gzip"),
+                         "compress")
+        with gzip.open("%s_North.fastq.gz" % self.output_prefix, "rt") as f:
+            self.assertEqual(f.read(), "@BC01\nACGT\n+\n!!!!\n")
+        self.assertEqual(summarise_stats(stats)["merge"]["files"], 2)
+
+    def test_merge_csvs_without_trailing_newline_or_rows(self):
+        paths = [os.path.join(self.tmp_dir.name, name) for name in ["a.csv", "b.csv", "c.csv"]]
+        write(paths[0], HEADER + "a,1,BC01")
+        write(paths[1], HEADER)
+        write(paths[2], "")
+        output = os.path.join(self.tmp_dir.name, "merged.csv")
+        merge_csvs(paths + ["%s_BC02.csv" % self.input_prefix], output)
+        self.assertEqual(read(output), HEADER + "a,1,BC01\nBC02,4,BC02\n")
+
+    def test_merge_csvs_different_columns(self):
+        paths = [os.path.join(self.tmp_dir.name, name) for name in ["a.csv", "b.csv"]]
+        write(paths[0], "read_name,read_len\na,1\n")
+        write(paths[1], "read_name,barcode\nb,BC02\n")
+        output = os.path.join(self.tmp_dir.name, "merged.csv")
+        merge_csvs(paths, output)
+        self.assertEqual(read(output), "read_name,read_len,barcode\na,1,\nb,,BC02\n")
+
+    def test_main(self):
+        main(["--input_prefix", self.input_prefix, "--output_prefix", self.output_prefix,
+              "--sample", "North:BC01", "--sample", "South:BC02,BC03"])
+        self.assertTrue(os.path.exists("%s_North.csv" % self.output_prefix))
+        self.assertTrue(os.path.exists("%s_South.fastq" % self.output_prefix))
+        with self.assertRaises(SystemExit):
+            main(["--input_prefix", self.input_prefix, "--output_prefix", self.output_prefix,
+                  "--sample", "East:BC04"])
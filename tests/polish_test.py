@@ -0,0 +1,73 @@
+import json
+import os
+import stat
+import tempfile
+import unittest
+
+from postbox.polish import *
+
+# racon "polishes" by echoing the draft, mafft "aligns" by echoing its input, so every round is a no-op
+STUBS = {
+    "minimap2": "#!/bin/sh\nexit 0\n",
+    "racon": "#!/bin/sh\nfor last; do :; done\nsed 's/^>.*/>cns:racon/' \"$last\"\n",
+    "mafft": "#!/bin/sh\nfor last; do :; done\ncat \"$last\"\n",
+    "failing": "#!/bin/sh\necho broken >&2\nexit 3\n"
+}
+
+
+class TestPolish(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tools = {}
+        for tool, body in STUBS.items():
+            path = os.path.join(self.tmp_dir.name, tool)
+            with open(path, "w") as f:
+                f.write(body)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+            self.tools[tool] = path
+        self.reads = os.path.join(self.tmp_dir.name, "Sabin1.fastq")
+        with open(self.reads, "w") as f:
+            f.write("@read1\nACGTACGT\n+\n!!!!!!!!\n")
+        self.reference = os.path.join(self.tmp_dir.name, "Sabin1.fasta")
+        with open(self.reference, "w") as f:
+            f.write(">Sabin1 display_name=Sabin1\nacgtACGT\n")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_polish(self):
+        cleaned, steps = polish(self.reads, self.reference, "Sabin1", rounds=3, work_dir=self.tmp_dir.name,
+                                tools=self.tools)
+        self.assertEqual(cleaned, ">Sabin1 accession=cns round_name=3 length=8\nACGTACGT\n")
+        self.assertEqual([step["round"] for step in steps], [1, 2, 3])
+        self.assertEqual(steps[-1]["length"], 8)
+        # nothing is left behind in the scratch directory
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), sorted(list(STUBS) + ["Sabin1.fastq", "Sabin1.fasta"]))
+
+    def test_failing_tool(self):
+        tools = dict(self.tools, mafft=self.tools["failing"])
+        with self.assertRaises(Error) as context:
+            polish(self.reads, self.reference, "Sabin1", work_dir=self.tmp_dir.name, tools=tools)
+        self.assertIn("broken", str(context.exception))
+
+    def test_scratch_directory(self):
+        self.assertEqual(scratch_directory(self.tmp_dir.name), self.tmp_dir.name)
+        self.assertTrue(os.path.isdir(scratch_directory()))
+
+    def test_main_writes_manifest(self):
+        output = os.path.join(self.tmp_dir.name, "out", "polished.fasta")
+        manifest = os.path.join(self.tmp_dir.name, "out", "manifest.json")
+        os.makedirs(os.path.dirname(output))
+        path = os.environ["PATH"]
+        os.environ["PATH"] = self.tmp_dir.name + os.pathsep + path
+        try:
+            main(["--reads", self.reads, "--reference", self.reference, "--name", "Sabin1", "--rounds", "2",
+                  "--output", output, "--manifest", manifest, "--work_dir", self.tmp_dir.name])
+        finally:
+            os.environ["PATH"] = path
+        with open(output) as f:
+            self.assertTrue(f.read().startswith(">Sabin1 accession=cns round_name=2"))
+        with open(manifest) as f:
+            details = json.load(f)
+        self.assertEqual(details["rounds"], 2)
+        self.assertEqual(len(details["steps"]), 2)
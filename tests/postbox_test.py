@@ -5,6 +5,11 @@ mpl_logger.setLevel(logging.WARNING)
 import os
 import unittest
 import filecmp
+import shlex
+import shutil
+import tempfile
+import threading
+from argparse import Namespace
 
 from postbox.postbox import *
 
@@ -59,19 +64,29 @@ class TestPostbox(unittest.TestCase):
         protocol_path = "%s/example_protocol" %data_dir
         pipeline_name = None
         pipeline_dict = {}
-        self.assertRaises(AssertionError, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
+        self.assertRaises(Error, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
 
     def test_find_pipeline_pipeline_name_is_None_and_two_pipelines(self):
         protocol_path = "%s/example_protocol" %data_dir
         pipeline_name = None
         pipeline_dict = {}
-        self.assertRaises(AssertionError, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
+        self.assertRaises(Error, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
 
     def test_find_pipeline_pipeline_name_not_in_pipelines(self):
         protocol_path = "%s/example_protocol" %data_dir
         pipeline_name = "nonsense"
         pipeline_dict = {}
-        self.assertRaises(AssertionError, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
+        self.assertRaises(Error, find_pipeline, protocol_path, pipeline_name, pipeline_dict)
+
+    def test_find_pipeline_error_names_pipelines(self):
+        protocol_path = "%s/example_protocol" %data_dir
+        with self.assertRaises(Error) as out:
+            find_pipeline(protocol_path, "nonsense", {})
+        expected = "no pipeline nonsense in %s/rampart/pipelines.json, choose one of: analysis, null" % protocol_path
+        self.assertEqual(str(out.exception), expected)
+        with self.assertRaises(Error) as out:
+            find_pipeline(protocol_path, None, {})
+        self.assertEqual(str(out.exception), "-q/--pipeline is needed to choose one of: analysis, null")
 
     def test_find_pipeline_snakemake_does_not_exist(self):
         protocol_path = "%s/example_protocol" %data_dir
@@ -243,3 +258,179 @@ class TestPostbox(unittest.TestCase):
         self.assertEqual(command, expected)
 
 
+    def test_build_config_list(self):
+        pipeline_dict = {"path": "Snakefile", "config": " min_reads=50 min_pcent=0.01", "config_file": None}
+        config = {"basecalledPath": "/path/to/fastq_pass", "fast5Path": None}
+        sample_dict = {"North": ["NB03"], "South": ["NB05", "NB07"]}
+        remainder = ["output_path=binned"]
+        expected = ["samples={North: [NB03], South: [NB05,NB07]}", "basecalled_path=/path/to/fastq_pass",
+                    "min_reads=50", "min_pcent=0.01", "output_path=binned"]
+        config_list = build_config_list(pipeline_dict, config, sample_dict, remainder)
+        self.assertEqual(config_list, expected)
+
+    def test_build_command_matches_config_list(self):
+        pipeline_dict = {"path": "Snakefile", "config": None, "config_file": None}
+        config = {"basecalledPath": "/path/to/fastq_pass", "fast5Path": "/path/to/fast5"}
+        sample_dict = {"North": ["NB03"]}
+        expected = "snakemake --snakefile Snakefile --cores 2 --rerun-incomplete --nolock --dry-run --config " \
+                   "samples='{North: [NB03]}' basecalled_path=\"/path/to/fastq_pass\" fast5_path=\"/path/to/fast5\""
+        command = build_command(pipeline_dict, config, sample_dict, 2, [], dry_run=True)
+        self.assertEqual(command, expected)
+        self.assertEqual(shlex.split(command)[9:], build_config_list(pipeline_dict, config, sample_dict, []))
+
+    def test_build_command_with_resources(self):
+        pipeline_dict = {"path": "Snakefile", "config": None, "config_file": None}
+        config = {"basecalledPath": "/path/to/fastq_pass", "fast5Path": None}
+        resources = {"config": {"racon_threads": 4}, "mem_mb": 9000}
+        command = build_command(pipeline_dict, config, {"North": ["NB03"]}, 8, ["racon_threads=1"],
+                                resources=resources)
+        self.assertIn("--nolock --resources mem_mb=9000 --config", command)
+        # overrides come last so they win over the computed budgets
+        self.assertTrue(command.endswith("racon_threads=4 racon_threads=1"))
+        self.assertEqual(build_config_list(pipeline_dict, config, {}, [], resources)[-1], "racon_threads=4")
+
+    def test_build_command_with_input_manifest(self):
+        pipeline_dict = {"path": "Snakefile", "config": None, "config_file": None}
+        config = {"basecalledPath": "/run/fastq_pass", "fast5Path": None, "inputManifest": "/run/.postbox/manifest.tsv"}
+        command = build_command(pipeline_dict, config, {"North": ["NB03"]}, 1, [])
+        self.assertIn('basecalled_path="/run/fastq_pass" input_manifest="/run/.postbox/manifest.tsv"', command)
+        self.assertIn("input_manifest=/run/.postbox/manifest.tsv", build_config_list(pipeline_dict, config, {}, []))
+
+    def test_build_command_with_compression(self):
+        pipeline_dict = {"path": "Snakefile", "config": None, "config_file": None}
+        config = {"basecalledPath": "/run/fastq_pass", "fast5Path": None, "compression": "zstd",
+                  "compressionThreads": 4, "compressionStats": "/run/.postbox/compression.jsonl"}
+        command = build_command(pipeline_dict, config, {}, 1, [])
+        self.assertIn('compression="zstd" compression_threads="4" '
+                      'compression_stats="/run/.postbox/compression.jsonl"', command)
+        self.assertIn("compression=zstd", build_config_list(pipeline_dict, config, {}, []))
+        config["compression"] = None
+        self.assertNotIn("compression", build_command(pipeline_dict, config, {}, 1, []))
+
+    def test_build_command_with_reference_store(self):
+        pipeline_dict = {"path": "Snakefile", "config": None, "config_file": None}
+        config = {"basecalledPath": "/run/fastq_pass", "fast5Path": None, "referenceStore": "/cache/references/ab"}
+        self.assertIn('reference_store="/cache/references/ab"', build_command(pipeline_dict, config, {}, 1, []))
+        self.assertIn("reference_store=/cache/references/ab", build_config_list(pipeline_dict, config, {}, []))
+
+    def test_split_remainder_output_path(self):
+        remainder = ["min_reads=10", "output_path=results/"]
+        output_path, others = split_remainder_output_path(remainder)
+        self.assertEqual(output_path, "results")
+        self.assertEqual(others, ["min_reads=10"])
+        self.assertEqual(split_remainder_output_path([]), ("binned", []))
+
+    def test_sample_log_file(self):
+        self.assertEqual(sample_log_file("/run/postbox.log", "North"), "/run/postbox.North.log")
+        self.assertIsNone(sample_log_file(None, "North"))
+
+    def test_use_per_sample(self):
+        sample_dict = {"North": ["NB03"], "South": ["NB05", "NB07"]}
+        self.assertTrue(use_per_sample({"run_per_sample": True}, sample_dict))
+        self.assertFalse(use_per_sample({"run_per_sample": True}, sample_dict, single_run=True))
+        self.assertFalse(use_per_sample({"run_per_sample": True}, {"North": ["NB03"]}))
+        self.assertFalse(use_per_sample({}, sample_dict))
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_run_per_sample_dry_run(self):
+        protocol = "%s/example_protocol" %data_dir
+        pipeline_dict = find_pipeline(protocol, "analysis", {"path": None, "config": None, "config_file": None})
+        sample_dict = {"North": ["BC01"], "South": ["BC03", "BC04"]}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = {"basecalledPath": tmp_dir, "fast5Path": None}
+            args = Namespace(remainder=[], engine="subprocess", max_samples=None, threads=2, dry_run=True,
+                             log_file="%s/postbox.log" % tmp_dir, log_level="ERROR", log_max_bytes=1024 * 1024)
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                run_per_sample(args, pipeline_dict, config, sample_dict)
+            finally:
+                os.chdir(cwd)
+            with open("%s/postbox.South.log" % tmp_dir) as f:
+                log = f.read()
+        self.assertIn("output: binned/South/binned_South.fastq", log)
+        self.assertIn("rename_to_samples", log)
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_run_per_sample_queue_executor(self):
+        from postbox.executors import QueueExecutor, run_worker, SUCCESS
+        protocol = "%s/example_protocol" %data_dir
+        pipeline_dict = find_pipeline(protocol, "analysis", {"path": None, "config": None, "config_file": None})
+        sample_dict = {"North": ["BC01"], "South": ["BC03", "BC04"]}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = {"basecalledPath": tmp_dir, "fast5Path": None}
+            executor = QueueExecutor("%s/queue.db" % tmp_dir, poll_interval=0.1)
+            args = Namespace(remainder=[], engine="subprocess", max_samples=None, threads=2, dry_run=True,
+                             log_file="%s/postbox.log" % tmp_dir, log_level="ERROR", log_max_bytes=1024 * 1024,
+                             job_executor=executor)
+            stop = threading.Event()
+            worker = threading.Thread(target=run_worker, args=(executor.queue, 2),
+                                      kwargs={"poll_interval": 0.1, "stop": stop})
+            worker.start()
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                run_per_sample(args, pipeline_dict, config, sample_dict)
+            finally:
+                os.chdir(cwd)
+                stop.set()
+                worker.join()
+            jobs = executor.queue.jobs()
+            with open("%s/postbox.South.log" % tmp_dir) as f:
+                log = f.read()
+        self.assertEqual(sorted((job["name"], job["status"], job["cores"]) for job in jobs),
+                         [("North", SUCCESS, 1), ("South", SUCCESS, 1)])
+        self.assertIn("output: binned/South/binned_South.fastq", log)
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_one_selected_sample_keeps_per_sample_layout(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.mkdir("%s/fastq_pass" % tmp_dir)
+            args = get_arguments(["-p", "%s/example_protocol" % data_dir, "-q", "analysis", "-d", tmp_dir,
+                                  "-c", "%s/example_run_directory/barcodes.csv" % data_dir, "-i", "fastq_pass",
+                                  "--samples", "North", "--dry_run", "--no_cache", "--log_file", "postbox.log",
+                                  "--log_level", "ERROR"])
+            pipeline_dict, config, sample_dict = resolve_run(args.protocol, args.pipeline, args.run_directory,
+                                                             args.run_configuration, args.basecalled_path,
+                                                             args.fast5_path, args.csv)
+            cwd = os.getcwd()
+            os.chdir(tmp_dir)
+            try:
+                run_resolved(args, pipeline_dict, config, sample_dict)
+            finally:
+                os.chdir(cwd)
+            self.assertFalse(os.path.exists("%s/postbox.log" % tmp_dir))
+            with open("%s/postbox.North.log" % tmp_dir) as f:
+                log = f.read()
+        self.assertIn("output: binned/North/binned_North.fastq", log)
+
+    def test_run_lock_covers_work_directory(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["run1", "run2", "work"]:
+                os.mkdir("%s/%s" % (tmp_dir, name))
+            with run_lock("%s/run1" % tmp_dir, work_directory="%s/work" % tmp_dir):
+                # another run directory, but snakemake would write to the same place
+                with self.assertRaises(SystemExit):
+                    with run_lock("%s/run2" % tmp_dir, work_directory="%s/work" % tmp_dir):
+                        pass
+                with run_lock("%s/run2" % tmp_dir, dry_run=True, work_directory="%s/work" % tmp_dir):
+                    pass
+            with run_lock("%s/run2" % tmp_dir, work_directory="%s/run2" % tmp_dir):
+                self.assertFalse(RunLock("%s/run2" % tmp_dir).acquire())
+
+    def test_api_engine_cannot_use_queue(self):
+        with self.assertRaises(SystemExit):
+            get_arguments(["-p", "%s/example_protocol" % data_dir, "--engine", "api", "--executor", "queue",
+                           "--queue", "queue.db"])
+
+    def test_filter_sample_dict(self):
+        sample_dict = {"North": ["NB03"], "East": ["NB04"], "South": ["NB05", "NB07"], "Control": ["NB06"]}
+        self.assertEqual(filter_sample_dict(sample_dict), sample_dict)
+        self.assertEqual(filter_sample_dict(sample_dict, samples=["South", "North"]),
+                         {"North": ["NB03"], "South": ["NB05", "NB07"]})
+        self.assertEqual(filter_sample_dict(sample_dict, barcodes=["NB07", "NB06"]),
+                         {"South": ["NB05", "NB07"], "Control": ["NB06"]})
+        with self.assertRaises(SystemExit):
+            filter_sample_dict(sample_dict, samples=["West"])
+        with self.assertRaises(SystemExit):
+            filter_sample_dict(sample_dict, barcodes=["NB01"])
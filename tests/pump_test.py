@@ -0,0 +1,71 @@
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+
+from postbox.pump import *
+from postbox.postbox import syscall
+
+
+def run_pump(command, **kwargs):
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0)
+    console = io.StringIO()
+    output_pump = OutputPump(console=console, **kwargs)
+    output_pump.pump(process.stdout)
+    process.wait()
+    output_pump.close()
+    return output_pump, console.getvalue()
+
+class TestPump(unittest.TestCase):
+    def test_classify_line(self):
+        self.assertEqual(classify_line("rule racon1:"), "INFO")
+        self.assertEqual(classify_line("    jobid: 3"), "DEBUG")
+        self.assertEqual(classify_line("Warning: the following output files of rule x were not present"), "WARNING")
+        self.assertEqual(classify_line("Error in rule medaka:"), "ERROR")
+
+    def test_pump_drains_tail_after_exit(self):
+        output_pump, console = run_pump("seq 1 5000; printf 'no newline at end'", chunk_size=1024)
+        lines = console.split("\n")
+        self.assertEqual(lines[0], "1")
+        self.assertEqual(lines[4999], "5000")
+        self.assertEqual(lines[5000], "no newline at end")
+        self.assertEqual(output_pump.stats()["lines"], 5001)
+
+    def test_pump_log_level_filters_console_only(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "postbox.log")
+            output_pump, console = run_pump("echo 'rule a:'; echo '    jobid: 1'; echo 'Error in rule a:'",
+                                            log_level="WARNING", log_file=log_file)
+            with open(log_file) as f:
+                logged = f.read()
+        self.assertEqual(console, "Error in rule a:\n")
+        self.assertIn("INFO rule a:", logged)
+        self.assertIn("DEBUG     jobid: 1", logged)
+        self.assertIn("ERROR Error in rule a:", logged)
+
+    def test_pump_rotates_log_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "postbox.log")
+            run_pump("seq 1 2000", log_file=log_file, max_bytes=4096, backup_count=2)
+            files = sorted(os.listdir(tmp_dir))
+            sizes = [os.path.getsize(os.path.join(tmp_dir, f)) for f in files]
+        self.assertEqual(files, ["postbox.log", "postbox.log.1", "postbox.log.2"])
+        self.assertTrue(all(size <= 4096 for size in sizes))
+
+    def test_pump_splits_overlong_lines(self):
+        output_pump, console = run_pump("head -c 10000 /dev/zero | tr '\\0' 'a'", chunk_size=1024,
+                                        max_line_length=4096)
+        self.assertEqual(len(console.replace("\n", "")), 10000)
+        self.assertTrue(all(len(line) <= 4096 + 1024 for line in console.split("\n")))
+
+    def test_pump_prefix(self):
+        output_pump, console = run_pump("echo hi", prefix="[North] ")
+        self.assertEqual(console, "[North] hi\n")
+
+    def test_syscall_writes_log_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "postbox.log")
+            syscall("echo hi", log_file=log_file)
+            with open(log_file) as f:
+                self.assertIn("INFO hi", f.read())
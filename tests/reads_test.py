@@ -0,0 +1,93 @@
+import gzip
+import io
+import os
+import tempfile
+import unittest
+
+from postbox.reads import *
+
+fastq = b"@read1 runid=a ch=1\nACGT\n+\n5555\n@read2 runid=a\nGGGG\n+\n6666\n\n@read3\nTT\n+\n55\n"
+
+
+class TestReads(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.reads_path = os.path.join(self.tmp_dir.name, "reads.fastq")
+        with open(self.reads_path, "wb") as f:
+            f.write(fastq)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_fastq_records(self):
+        records = list(fastq_records(io.BytesIO(fastq)))
+        self.assertEqual([name for name, offset, record in records], ["read1", "read2", "read3"])
+        for name, offset, record in records:
+            self.assertEqual(fastq[offset:offset + len(record)], record)
+
+    def test_fastq_records_rejects_other_formats(self):
+        with self.assertRaises(ValueError):
+            list(fastq_records(io.BytesIO(b">read1\nACGT\n")))
+
+    def test_split_reads(self):
+        paths = {ref: os.path.join(self.tmp_dir.name, ref + ".fastq") for ref in ["Sabin1", "Sabin2"]}
+        counts = split_reads(self.reads_path, {"read1": "Sabin1", "read3": "Sabin1", "read2": "unused"}, paths)
+        self.assertEqual(counts, {"Sabin1": 2, "Sabin2": 0})
+        with open(paths["Sabin1"], "rb") as f:
+            self.assertEqual(f.read(), b"@read1 runid=a ch=1\nACGT\n+\n5555\n@read3\nTT\n+\n55\n")
+        with open(paths["Sabin2"], "rb") as f:
+            self.assertEqual(f.read(), b"")
+
+    def test_split_reads_compressed(self):
+        compressed_reads = os.path.join(self.tmp_dir.name, "reads.fastq.gz")
+        with open(self.reads_path, "rb") as f, gzip.open(compressed_reads, "wb") as fw:
+            fw.write(f.read())
+        path = os.path.join(self.tmp_dir.name, "Sabin1.fastq.gz")
+        stats = os.path.join(self.tmp_dir.name, "compression.jsonl")
+        counts = split_reads(compressed_reads, {"read1": "Sabin1", "read3": "Sabin1"}, {"Sabin1": path}, stats=stats)
+        self.assertEqual(counts, {"Sabin1": 2})
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), b"@read1 runid=a ch=1\nACGT\n+\n5555\n@read3\nTT\n+\n55\n")
+        with open(stats) as f:
+            self.assertIn('"stage": "split_reads"', f.read())
+
+    def test_read_index(self):
+        index_path = write_read_index(self.reads_path)
+        self.assertEqual(index_path, self.reads_path + ".idx")
+        index = load_read_index(index_path)
+        self.assertEqual(sorted(index), ["read1", "read2", "read3"])
+
+        output = io.BytesIO()
+        missing = fetch_reads(self.reads_path, index, ["read3", "read9", "read2"], output)
+        self.assertEqual(missing, ["read9"])
+        self.assertEqual(output.getvalue(), b"@read3\nTT\n+\n55\n@read2 runid=a\nGGGG\n+\n6666\n")
+
+    def test_read_index_refuses_compressed_reads(self):
+        compressed_reads = os.path.join(self.tmp_dir.name, "reads.fastq.gz")
+        with open(self.reads_path, "rb") as f, gzip.open(compressed_reads, "wb") as fw:
+            fw.write(f.read())
+        with self.assertRaises(ValueError):
+            write_read_index(compressed_reads)
+        self.assertFalse(os.path.exists(compressed_reads + ".idx.tmp"))
+        index = load_read_index(write_read_index(self.reads_path))
+        with self.assertRaises(ValueError):
+            fetch_reads(compressed_reads, index, ["read1"], io.BytesIO())
+
+    def test_read_bins(self):
+        read_bins = ReadBins()
+        for i in range(100):
+            read_bins.add("read%d" % i, "Sabin%d" % (i % 3 + 1))
+        self.assertEqual(read_bins.counts(), {"Sabin1": 34, "Sabin2": 33, "Sabin3": 33})
+        self.assertEqual(read_bins.get("read4"), "Sabin2")
+        self.assertIsNone(read_bins.get("read100"))
+
+        read_bins.select(["Sabin1", "NonPolioEV"])
+        self.assertEqual(read_bins.counts(), {"Sabin1": 34})
+        self.assertEqual(read_bins.get("read3"), "Sabin1")
+        self.assertEqual(read_bins.get("read4", "none"), "none")
+
+    def test_split_reads_with_read_bins(self):
+        read_bins = ReadBins()
+        read_bins.add("read2", "Sabin1")
+        path = os.path.join(self.tmp_dir.name, "Sabin1.fastq")
+        self.assertEqual(split_reads(self.reads_path, read_bins, {"Sabin1": path}), {"Sabin1": 1})
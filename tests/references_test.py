@@ -0,0 +1,118 @@
+import os
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from postbox.references import *
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+protocol = os.path.join(this_dir, 'tests', 'data', 'example_protocol')
+
+PANEL = ">Sabin1_vacc display_name=Sabin1\nACGT\nACG\n>Sabin2_vacc display_name=Sabin2\nTTTT\n>EV_1 note\nGG\n"
+# "indexes" a reference by copying it, like the benchmark stub
+MINIMAP2 = '''
+import shutil, sys
+if sys.argv[1:] == ["--version"]:
+    print("2.24-r1122")
+else:
+    shutil.copy(sys.argv[-1], sys.argv[sys.argv.index("-d") + 1])
+'''
+
+
+class TestReferences(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.panel = os.path.join(self.tmp_dir.name, "references.fasta")
+        with open(self.panel, "w") as f:
+            f.write(PANEL)
+        self.original_path = os.environ["PATH"]
+        os.environ["PATH"] = os.path.join(self.tmp_dir.name, "bin")
+
+    def tearDown(self):
+        os.environ["PATH"] = self.original_path
+        self.tmp_dir.cleanup()
+
+    def install_minimap2(self):
+        bin_dir = os.path.join(self.tmp_dir.name, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        path = os.path.join(bin_dir, "minimap2")
+        with open(path, "w") as f:
+            f.write("#!%s\n" % sys.executable + MINIMAP2)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def test_reference_store(self):
+        directory = reference_store(self.panel, self.cache_dir)
+        self.assertEqual(os.path.dirname(directory), os.path.join(self.cache_dir, "references"))
+        store = ReferenceStore(directory)
+        self.assertEqual(store.ids(), ["Sabin1_vacc", "Sabin2_vacc", "EV_1"])
+        self.assertEqual(store.display_names(), ["Sabin1", "Sabin2", "EV_1"])
+        self.assertEqual(store.sequence("Sabin1_vacc"), "ACGTACG")
+        self.assertEqual(store.sequence("EV_1"), "GG")
+        self.assertIsNone(store.panel_index())
+        with open(os.path.join(directory, "references.fasta.fai")) as f:
+            self.assertEqual(f.readline(), "Sabin1_vacc\t7\t33\t7\t8\n")
+
+    def test_store_is_keyed_by_content(self):
+        directory = reference_store(self.panel, self.cache_dir)
+        self.assertEqual(reference_store(self.panel, self.cache_dir), directory)
+        with open(self.panel, "a") as f:
+            f.write(">Sabin3_vacc display_name=Sabin3\nCC\n")
+        self.assertNotEqual(reference_store(self.panel, self.cache_dir), directory)
+
+    def test_minimap2_indexes(self):
+        self.install_minimap2()
+        store = ReferenceStore(reference_store(self.panel, self.cache_dir))
+        self.assertEqual(store.metadata["minimap2"], "2.24-r1122")
+        self.assertIsNotNone(store.panel_index())
+        # the index of each sequence names it as parse_ref_and_depth.py names the reference of an analysis stem
+        with open(store.target_index("Sabin2_vacc")) as f:
+            self.assertEqual(f.read(), ">Sabin2\nTTTT\n")
+        link = os.path.join(self.tmp_dir.name, "Sabin2.mmi")
+        self.assertTrue(store.link_target_index("Sabin2_vacc", link))
+        self.assertTrue(os.path.samefile(link, store.target_index("Sabin2_vacc")))
+
+    def test_indexes_added_to_an_existing_store(self):
+        directory = reference_store(self.panel, self.cache_dir)
+        self.assertFalse(ReferenceStore(directory).link_target_index("EV_1", os.path.join(self.tmp_dir.name, "x")))
+        self.install_minimap2()
+        self.assertEqual(reference_store(self.panel, self.cache_dir), directory)
+        self.assertIsNotNone(ReferenceStore(directory).target_index("EV_1"))
+
+    def test_known_store_remembered(self):
+        directory = reference_store(self.panel, self.cache_dir)
+        self.assertIn(directory, known_stores.values())
+        self.assertEqual(reference_store(self.panel, self.cache_dir), directory)
+        # a panel edited in place is a different store
+        with open(self.panel, "a") as f:
+            f.write(">EV_2\nCC\n")
+        self.assertNotEqual(reference_store(self.panel, self.cache_dir), directory)
+
+    def test_built_by_several_threads_at_once(self):
+        # as the runs of postbox batch do
+        self.install_minimap2()
+        directories, errors = [], []
+
+        def build():
+            try:
+                directories.append(reference_store(self.panel, self.cache_dir))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=build) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(directories)), 1)
+        self.assertIsNotNone(ReferenceStore(directories[0]).target_index("EV_1"))
+
+    def test_required_panel(self):
+        pipeline_dict = {"requires": [{"file": "references.fasta", "config_key": "references_file"}]}
+        self.assertEqual(required_panel(protocol, pipeline_dict),
+                         os.path.join(protocol, "rampart", "references.fasta"))
+        self.assertIsNone(required_panel(protocol, {}))
+        self.assertIsNone(required_panel(protocol, {"requires": [{"file": "primers.json"}]}))
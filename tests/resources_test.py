@@ -0,0 +1,35 @@
+import unittest
+
+from postbox.resources import *
+
+
+class TestResources(unittest.TestCase):
+    def test_threads_are_split_between_lanes(self):
+        config = rule_resources(32, lanes=1)["config"]
+        self.assertEqual(config["racon_threads"], 8)
+        self.assertEqual(config["medaka_threads"], 4)
+
+        config = rule_resources(32, lanes=16)["config"]
+        self.assertEqual(config["racon_threads"], 2)
+        self.assertEqual(config["mafft_threads"], 2)
+
+        config = rule_resources(4, lanes=96)["config"]
+        self.assertEqual(config["minimap2_threads"], 1)
+
+    def test_memory(self):
+        resources = rule_resources(8, lanes=2, memory_mb=16000)
+        self.assertEqual(resources["mem_mb"], 14400)
+        self.assertEqual(resources["config"]["medaka_mem_mb"], 4000 + 500 * 4)
+        self.assertIsNone(rule_resources(8)["mem_mb"])
+
+        # no job may ask for more than there is, or it would never run
+        resources = rule_resources(8, memory_mb=2000)
+        self.assertEqual(resources["config"]["medaka_mem_mb"], 1800)
+
+    def test_resources_config_list(self):
+        resources = {"config": {"racon_threads": 2, "medaka_mem_mb": 5000}, "mem_mb": None}
+        self.assertEqual(resources_config_list(resources), ["medaka_mem_mb=5000", "racon_threads=2"])
+
+    def test_available_memory_mb(self):
+        memory_mb = available_memory_mb()
+        self.assertTrue(memory_mb is None or memory_mb > 0)
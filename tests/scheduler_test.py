@@ -0,0 +1,44 @@
+import threading
+import time
+import unittest
+
+from postbox.scheduler import *
+
+
+class TestScheduler(unittest.TestCase):
+    def test_fair_share(self):
+        self.assertEqual(fair_share(64, 10, 64), 6)
+        self.assertEqual(fair_share(64, 3, 64), 21)
+        self.assertEqual(fair_share(64, 10, 2), 32)
+        self.assertEqual(fair_share(2, 10, 10), 1)
+
+    def test_run_fair_share_failure_does_not_stop_others(self):
+        def ok(cores):
+            return cores
+
+        def fail(cores):
+            raise RuntimeError("broken run")
+
+        results = run_fair_share([("a", ok), ("b", fail), ("c", ok)], 6)
+        self.assertEqual([name for name, result, exception in results], ["a", "b", "c"])
+        self.assertIsNone(results[0][2])
+        self.assertIsInstance(results[1][2], RuntimeError)
+        self.assertIsNone(results[2][2])
+
+    def test_run_fair_share_stays_within_budget(self):
+        lock = threading.Lock()
+        usage = {"current": 0, "peak": 0}
+
+        def job(cores):
+            with lock:
+                usage["current"] += cores
+                usage["peak"] = max(usage["peak"], usage["current"])
+            time.sleep(0.02)
+            with lock:
+                usage["current"] -= cores
+            return cores
+
+        results = run_fair_share([(str(i), job) for i in range(10)], 8, max_concurrent=4)
+        self.assertLessEqual(usage["peak"], 8)
+        self.assertTrue(all(result >= 1 for name, result, exception in results))
+        self.assertEqual(results[0][1], 2)
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from postbox.serve import *
+
+this_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(this_dir, 'tests', 'data')
+protocol = os.path.join(data_dir, "example_protocol")
+csv = os.path.join(data_dir, "example_run_directory", "barcodes.csv")
+
+
+def serve(args, socket_path, start=True):
+    daemon = Daemon(args)
+    server = make_server(daemon, socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    if start:
+        daemon.start()
+    return daemon, server
+
+def stop(daemon, server):
+    server.shutdown()
+    server.server_close()
+    daemon.stop()
+
+def wait_for(socket_path, run_id, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status, run, headers = call(socket_path, "GET", "/runs/%d" % run_id)
+        if run["status"] not in (QUEUED, RUNNING):
+            return run
+        time.sleep(0.1)
+    raise AssertionError("run %d did not finish" % run_id)
+
+class TestResolutions(unittest.TestCase):
+    def test_pipeline_reloaded_when_changed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy_protocol = os.path.join(tmp_dir, "protocol")
+            shutil.copytree(protocol, copy_protocol)
+            resolutions = Resolutions()
+            pipeline_dict = resolutions.pipeline(copy_protocol, "analysis")
+            pipeline_dict["path"] = "changed by a run"
+            self.assertNotEqual(resolutions.pipeline(copy_protocol, "analysis")["path"], "changed by a run")
+            self.assertEqual(resolutions.loaded(), ["%s:analysis" % copy_protocol])
+
+            pipelines_json = os.path.join(copy_protocol, "rampart", "pipelines.json")
+            with open(pipelines_json) as f:
+                content = f.read()
+            with open(pipelines_json, "w") as f:
+                f.write(content.replace('"analysis"', '"renamed"'))
+            with self.assertRaises(Error):
+                resolutions.pipeline(copy_protocol, "analysis")
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_directory = os.path.join(self.tmp_dir, "run")
+        os.makedirs(os.path.join(self.run_directory, "fastq_pass"))
+        self.socket_path = os.path.join(self.tmp_dir, "postbox.sock")
+        self.args = get_arguments(["-p", protocol, "-q", "analysis", "-t", "2", "--cache_dir",
+                                   os.path.join(self.tmp_dir, "cache"), "--socket", self.socket_path])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_arguments(self):
+        argv = run_arguments(self.args, {"run_directory": self.run_directory, "arguments": ["--dry_run"],
+                                         "overrides": ["min_reads=10"]}, 2)
+        self.assertEqual(argv[:6], ["-p", protocol, "-d", self.run_directory, "-t", "2"])
+        self.assertIn("analysis", argv)
+        self.assertEqual(argv[-2:], ["--dry_run", "min_reads=10"])
+
+    def test_rejected_submissions(self):
+        daemon, server = serve(self.args, self.socket_path, start=False)
+        try:
+            for request in [{"run_directory": "run"}, {"run_directory": os.path.join(self.tmp_dir, "missing")},
+                            {"run_directory": self.run_directory, "pipeline": "nonsense"},
+                            {"run_directory": self.run_directory, "arguments": ["--engine", "nonsense"]},
+                            {"run_directory": self.run_directory, "overrides": "min_reads=10"}, []]:
+                status, body, headers = call(self.socket_path, "POST", "/runs", request)
+                self.assertEqual(status, 400, request)
+                self.assertIn("error", body)
+            self.assertEqual(call(self.socket_path, "GET", "/runs/1")[0], 404)
+            self.assertEqual(call(self.socket_path, "GET", "/nonsense")[0], 404)
+        finally:
+            stop(daemon, server)
+
+    def test_cancel_queued_run(self):
+        # without runners nothing leaves the queue
+        daemon, server = serve(self.args, self.socket_path, start=False)
+        try:
+            status, run, headers = call(self.socket_path, "POST", "/runs", {"run_directory": self.run_directory})
+            self.assertEqual((status, run["status"], run["threads"]), (202, QUEUED, 2))
+            status, run, headers = call(self.socket_path, "DELETE", "/runs/%d" % run["id"])
+            self.assertEqual((status, run["status"]), (200, CANCELLED))
+            self.assertEqual(call(self.socket_path, "DELETE", "/runs/%d" % run["id"])[0], 409)
+            self.assertEqual(call(self.socket_path, "GET", "/status")[1]["runs"], {CANCELLED: 1})
+        finally:
+            stop(daemon, server)
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_relative_protocol(self):
+        # snakemake runs inside the run directory, not where the daemon started
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            relative = os.path.relpath(protocol)
+            args = get_arguments(["-p", relative, "-q", "analysis", "--cache_dir", "cache", "--socket", "postbox.sock"])
+            self.assertEqual((args.protocol, args.cache_dir), (protocol, os.path.join(self.tmp_dir, "cache")))
+            self.assertEqual(args.socket, self.socket_path)
+            daemon, server = serve(args, self.socket_path)
+            try:
+                request = {"run_directory": self.run_directory, "protocol": relative,
+                           "arguments": ["-c", csv, "-i", "fastq_pass", "--dry_run"]}
+                status, run, headers = call(self.socket_path, "POST", "/runs", request)
+                self.assertEqual(status, 202)
+                self.assertEqual(run["protocol"], protocol)
+                run = wait_for(self.socket_path, run["id"])
+                self.assertEqual(run["status"], SUCCESS, run["error"])
+            finally:
+                stop(daemon, server)
+        finally:
+            os.chdir(cwd)
+
+    def test_port_replaces_socket(self):
+        self.assertIsNone(get_arguments(["-p", protocol, "--port", "8642"]).socket)
+
+    @unittest.skipUnless(shutil.which("snakemake"), "snakemake not installed")
+    def test_dry_run(self):
+        daemon, server = serve(self.args, self.socket_path)
+        try:
+            request = {"run_directory": self.run_directory, "arguments": ["-c", csv, "-i", "fastq_pass", "--dry_run"]}
+            status, run, headers = call(self.socket_path, "POST", "/runs", request)
+            self.assertEqual(status, 202)
+            run = wait_for(self.socket_path, run["id"])
+            self.assertEqual(run["status"], SUCCESS, run["error"])
+            self.assertIn("North", run["logs"])
+            status, log, headers = call(self.socket_path, "GET", "/runs/%d/log?sample=North" % run["id"])
+            self.assertEqual(status, 200)
+            self.assertIn(b"binned/North/binned_North.fastq", log)
+            self.assertEqual(int(headers["X-Log-Size"]), len(log))
+            status, tail, headers = call(self.socket_path, "GET", "/runs/%d/log?sample=North&offset=%d" % (
+                run["id"], len(log) - 10))
+            self.assertEqual(tail, log[-10:])
+
+            # the second submission of the same run is resolved from memory
+            status, run, headers = call(self.socket_path, "POST", "/runs", request)
+            self.assertEqual(wait_for(self.socket_path, run["id"])["status"], SUCCESS)
+            self.assertEqual(len(daemon.resolutions.runs), 1)
+            self.assertEqual([run["id"] for run in call(self.socket_path, "GET", "/runs")[1]], [1, 2])
+        finally:
+            stop(daemon, server)
@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from postbox.telemetry import *
+from postbox.postbox import syscall
+
+LOG = """Building DAG of jobs...
+[Sun Oct 18 02:20:13 2026]
+rule racon1:
+    input: binned/North/binned_North/Sabin1.fastq
+    output: binned/North/polishing/Sabin1/racon1.fasta
+    jobid: 4
+    wildcards: sample=North, analysis_stem=Sabin1
+    resources: tmpdir=/tmp
+
+[Sun Oct 18 02:20:14 2026]
+localrule all:
+    input: binned/North/consensus_sequences/North.fasta
+    jobid: 0
+
+Finished job 4.
+[Sun Oct 18 02:20:15 2026]
+rule medaka:
+    output: binned/North/medaka/Sabin1/consensus.fasta
+    jobid: 7
+
+[Sun Oct 18 02:20:16 2026]
+Error in rule medaka:
+    jobid: 7
+    output: binned/North/medaka/Sabin1/consensus.fasta
+"""
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_log_parser(self):
+        events = []
+        parser = SnakemakeLogParser(on_start=lambda block, now: events.append(("start", block["jobid"],
+                                                                               block["rule"], block["output"])),
+                                    on_finish=lambda jobid, status, now: events.append((status, jobid)))
+        for line in LOG.splitlines():
+            parser.feed(line)
+        parser.close_block(0)
+        expected = [
+            ("start", "4", "racon1", ["binned/North/polishing/Sabin1/racon1.fasta"]),
+            ("start", "0", "all", []),
+            ("finished", "4"),
+            ("start", "7", "medaka", ["binned/North/medaka/Sabin1/consensus.fasta"]),
+            ("failed", "7")
+        ]
+        self.assertEqual(events, expected)
+
+    def test_monitor_attributes_cpu_to_job(self):
+        telemetry = RunTelemetry()
+        busy = "import time\nt = time.time()\nwhile time.time() - t < 1.2: pass"
+        command = "printf 'rule busy:\\n    output: out/busy.txt\\n    jobid: 1\\n\\n'; " \
+                  "%s -c '%s' out/busy.txt; echo 'Finished job 1.'" % (sys.executable, busy)
+        syscall(command, monitor=telemetry.monitor("North"))
+        self.assertEqual(len(telemetry.jobs), 1)
+        job = telemetry.jobs[0]
+        self.assertEqual((job["label"], job["rule"], job["status"]), ("North", "busy", "finished"))
+        self.assertGreater(job["wall_seconds"], 1.0)
+        self.assertGreater(job["cpu_seconds"], 0.4)
+        self.assertGreater(job["peak_rss_mb"], 1)
+
+    def test_output_pattern(self):
+        pattern = output_pattern(["binned/North/Sabin1", "out/busy.txt"])
+        self.assertTrue(pattern.search("racon -t 2 binned/North/Sabin1/reads.fastq"))
+        self.assertTrue(pattern.search("minimap2 -o /run/binned/North/Sabin1.paf"))
+        self.assertTrue(pattern.search("python busy.py out/busy.txt"))
+        self.assertFalse(pattern.search("racon -t 2 binned/North/Sabin10/reads.fastq"))
+        self.assertFalse(pattern.search("python busy.py about/busy.txt"))
+        self.assertIsNone(output_pattern([]))
+
+    def test_monitor_counts_children_waited_for(self):
+        # the busy child is over before it can be sampled, but the shell it belongs to waits for it
+        telemetry = RunTelemetry()
+        busy = "import time\nt = time.time()\nwhile time.time() - t < 0.3: pass"
+        command = "printf 'rule short:\\n    output: out/short.txt\\n    jobid: 1\\n\\n'; sleep 0.6; " \
+                  "sh -c \"%s -c '%s'; sleep 1\" out/short.txt; echo 'Finished job 1.'" % (sys.executable, busy)
+        syscall(command, monitor=telemetry.monitor("North"))
+        self.assertEqual(len(telemetry.jobs), 1)
+        self.assertGreater(telemetry.jobs[0]["cpu_seconds"], 0.2)
+
+    def test_write_json_and_prometheus(self):
+        telemetry = RunTelemetry()
+        monitor = telemetry.monitor("North")
+        for line in LOG.splitlines():
+            monitor.feed_line(line)
+        monitor.finish(1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            telemetry.write_json("%s/postbox_metrics.json" % tmp_dir)
+            telemetry.write_prometheus("%s/postbox_metrics.prom" % tmp_dir)
+            with open("%s/postbox_metrics.json" % tmp_dir) as f:
+                metrics = json.load(f)
+            with open("%s/postbox_metrics.prom" % tmp_dir) as f:
+                prometheus = f.read()
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["postbox_metrics.json", "postbox_metrics.prom"])
+        self.assertEqual(metrics["rules"]["medaka"]["failed"], 1)
+        self.assertEqual(metrics["rules"]["racon1"]["jobs"], 1)
+        self.assertEqual([job["status"] for job in metrics["jobs"]], ["finished", "incomplete", "failed"])
+        self.assertIn('postbox_rule_jobs_total{rule="racon1"} 1', prometheus)
+        self.assertIn("# TYPE postbox_rule_peak_rss_bytes gauge", prometheus)
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from postbox.watch import *
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.sample_dict = {"North": ["BC01"], "South": ["BC02", "BC03"], "East": ["BC04"]}
+
+    def test_scheduler_debounces_changes(self):
+        scheduler = WatchScheduler(self.sample_dict, settle=10, min_interval=0, max_concurrent=2)
+        samples = scheduler.note_changes(["barcode02/a.fastq", "barcode03/a.fastq", "unclassified/a.fastq"], 0)
+        self.assertEqual(samples, {"South"})
+        self.assertEqual(scheduler.ready(5), [])
+        scheduler.note_changes(["barcode02/b.fastq"], 8)
+        self.assertEqual(scheduler.ready(15), [])
+        self.assertEqual(scheduler.ready(18), ["South"])
+        self.assertFalse(scheduler.idle())
+        scheduler.finished("South")
+        self.assertTrue(scheduler.idle())
+
+    def test_scheduler_min_interval_and_concurrency(self):
+        scheduler = WatchScheduler(self.sample_dict, settle=0, min_interval=100, max_concurrent=1)
+        scheduler.note_changes(["barcode01/a.fastq", "barcode04/a.fastq"], 0)
+        self.assertEqual(scheduler.ready(1), ["North"])
+        self.assertEqual(scheduler.ready(2), [])
+        scheduler.finished("North")
+        self.assertEqual(scheduler.ready(3), ["East"])
+        scheduler.finished("East")
+        scheduler.note_changes(["barcode01/b.fastq"], 4)
+        self.assertEqual(scheduler.ready(50), [])
+        self.assertEqual(scheduler.ready(101), ["North"])
+
+    def test_scheduler_flat_directory_changes_every_sample(self):
+        scheduler = WatchScheduler(self.sample_dict, settle=0, min_interval=0, max_concurrent=3)
+        self.assertEqual(scheduler.note_changes(["FAK_pass_0.fastq"], 0), {"North", "South", "East"})
+        self.assertEqual(scheduler.ready(1), ["North", "South", "East"])
+
+    def test_polling_watcher_reports_new_and_grown_files(self):
+        with tempfile.TemporaryDirectory() as basecalled_path:
+            os.mkdir(os.path.join(basecalled_path, "barcode01"))
+            first = os.path.join(basecalled_path, "barcode01", "a.fastq")
+            with open(first, "w") as f:
+                f.write("@r1\nA\n+\n!\n")
+            watcher = PollingWatcher(basecalled_path, poll_interval=0)
+            self.assertEqual(watcher.wait(0), [])
+
+            second = os.path.join(basecalled_path, "barcode01", "b.fastq")
+            with open(second, "w") as f:
+                f.write("@r2\nA\n+\n!\n")
+            with open(first, "a") as f:
+                f.write("@r3\nA\n+\n!\n")
+            self.assertEqual(sorted(watcher.wait(0)), [first, second])
+
+    def test_polling_watcher_scans_once_per_interval(self):
+        with tempfile.TemporaryDirectory() as basecalled_path:
+            watcher = PollingWatcher(basecalled_path, poll_interval=0.5)
+            path = os.path.join(basecalled_path, "a.fastq")
+            with open(path, "w") as f:
+                f.write("@r1\nA\n+\n!\n")
+            # waits shorter than the interval do not scan
+            self.assertEqual(watcher.wait(0.1), [])
+            self.assertEqual(watcher.wait(1.0), [path])